@@ -1,31 +1,57 @@
-import time
 import re
+from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, Request
+from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.staticfiles import StaticFiles
 from starlette.routing import Route
-from starlette.middleware.sessions import SessionMiddleware
 
 from .utils.common import get_settings
 from .resources import router as resources_router
 from .front import router as front_router
-from .utils.front import FlashMessageMiddleware
+from .utils.counter import download_counters
+from .utils.file_index import file_index
+from .utils.front import AdminSessionMiddleware
+from .utils.invalidation import invalidation_bus
+from .utils.loop_monitor import loop_monitor
+from .utils.workers import worker_commands
+from .utils.middleware import MetricsMiddleware, ProfileMiddleware, TracingMiddleware
+from .utils.redis import create_async_client
 
 
 # from .models import database
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One pool per worker process, created after gunicorn forks
+    app.state.redis = create_async_client(0)
+    app.state.redis_feedback = create_async_client(1)
+    download_counters.start(app.state.redis)
+    invalidation_bus.start(app.state.redis)
+    worker_commands.start(app.state.redis)
+    await file_index.start()
+    loop_monitor.start()
+    yield
+    await loop_monitor.stop()
+    await file_index.stop()
+    await invalidation_bus.stop()
+    await download_counters.stop()
+    await app.state.redis.aclose()
+    await app.state.redis_feedback.aclose()
+
+
 def get_app() -> FastAPI:
-    app = FastAPI()
+    app = FastAPI(lifespan=lifespan)
 
     origins = [
         "http://localhost",
         "http://localhost:8080",
     ]
 
-    app.add_middleware(FlashMessageMiddleware)
+    # Pure ASGI middleware, none of them runs the app in another task
+    app.add_middleware(AdminSessionMiddleware, secret_key='testkey', path_prefix='/admin')
 
     app.add_middleware(
         CORSMiddleware,
@@ -40,18 +66,11 @@ def get_app() -> FastAPI:
         minimum_size=500
     )
 
-    @app.middleware("http")
-    async def add_process_time_header(request: Request, call_next):
-        start_time = time.time()
-        response = await call_next(request)
-        process_time = time.time() - start_time
-        response.headers["X-Process-Time"] = str(process_time)
-        return response
+    app.add_middleware(ProfileMiddleware)
 
-    app.add_middleware(
-        SessionMiddleware,
-        secret_key='testkey'
-    )
+    app.add_middleware(TracingMiddleware)
+
+    app.add_middleware(MetricsMiddleware)
 
     app.include_router(resources_router)
     app.include_router(front_router)
@@ -11,10 +11,15 @@ class Settings(BaseSettings):
     app_name: str = "XLWebServices-fastapi"
     root_path: str = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
     file_cache_dir: str = "cache"
+    file_cache_link_mode: str = 'auto'  # auto (reflink, then hardlink, then copy), reflink or copy
     repo_cache_dir: str = "repo"
     redis_host: str = 'localhost'
     redis_port: str = '6379'
     redis_prefix: str = 'xlweb-fastapi|'
+    redis_max_connections: int = 64  # per pool, one async pool per worker and one sync pool for regen
+    redis_pool_timeout: float = 5  # seconds to wait for a free connection
+    redis_socket_timeout: float = 5
+    redis_socket_connect_timeout: float = 2
     hosted_url: str = 'https://aonyx.ffxiv.wang'
     github_token: str = ''
     cache_clear_key: str = ''
@@ -30,12 +35,66 @@ class Settings(BaseSettings):
     plugin_api_level: int = 7
     plugin_api_level_test: int = 8
     api_namespace: Dict[int, str] = Field(default_factory=lambda: {7: 'plugin-PluginDistD17-main'})
+    # Regen
+    regen_process_workers: int = 0  # processes for manifest parsing and hashing, 0 = CPU count, 1 = no pool
+    regen_worker_concurrency: int = 4  # jobs one `main.py worker` process runs at the same time
+    regen_lock_timeout: int = 3600  # seconds a task lock is held at most
+    regen_pending_ttl: int = 3600  # seconds a queued job keeps absorbing duplicate requests
+    regen_job_ttl: int = 86400  # seconds a job status is kept
+    # Download counters
+    counter_flush_interval_ms: int = 500
+    counter_flush_threshold: int = 1000  # flush early once this many increments are buffered
+    # Invalidation bus
+    invalidation_check_interval: int = 30  # seconds between version checks that catch missed events
+    # File downloads
+    file_index_watch: bool = True  # apply changes of the cache dir as they happen (needs watchfiles)
+    file_memory_cache_size: int = 64 * 1024 * 1024  # bytes of small files kept in memory per worker
+    file_memory_max_size: int = 1024 * 1024  # larger files are always read from disk
+    file_offload_mode: str = ''  # x-accel (nginx), x-sendfile (apache, lighttpd), pathsend (ASGI server), '' to stream
+    file_offload_prefix: str = '/cache-internal'  # internal nginx location of the cache dir, for x-accel
+    download_origin: str = 'local'  # where download endpoints redirect to: local (/File/Get), cdn or s3
+    download_cdn_url: str = ''  # base URL of the cached files on the CDN, for cdn
+    # Download resolution
+    resolution_check_interval: int = 60  # seconds between version checks of the local tables, events invalidate them earlier
+    # Materialized responses
+    response_check_interval: int = 60  # seconds between version checks of the local copy, events invalidate it earlier
+    xivlauncher_meta_refresh_interval: int = 60  # seconds before launch counts are rebuilt into /Proxy/Meta
+    # PluginMaster snapshot
+    pluginmaster_snapshot_check_interval: int = 60  # seconds between version checks of the local copy, events invalidate it earlier
+    pluginmaster_count_refresh_interval: int = 300  # seconds before download counts are rebuilt into it
+    pluginmaster_delta_history: int = 20  # versions kept for /Plugin/PluginMaster/Delta
+    pluginmaster_encodings: List[str] = Field(default_factory=lambda: ['gzip'])  # also 'br' (brotli), 'zstd' (zstandard)
+    # Metrics
+    metrics_dir: str = 'logs/metrics'  # values of all processes for /metrics (prometheus_client multiprocess mode), empty for this process only
+    loop_monitor: bool = False  # measure the event loop lag and log the stacks that block it
+    loop_monitor_interval: float = 0.1  # seconds between lag measurements
+    loop_block_threshold: float = 0.1  # seconds the loop must be stuck before its stack is logged
+    # Profiling
+    profile_key: str = ''  # signs X-Profile headers for per-request profiles, empty disables them
+    profile_interval: float = 0.005  # seconds between stack samples
+    profile_max_seconds: int = 60
+    # Tracing
+    trace_exporter: str = ''  # jsonl or otlp, empty disables tracing
+    trace_sample_rate: float = 0.01  # share of HTTP requests traced, requests with a sampled traceparent always are
+    trace_regen_sample_rate: float = 1  # share of regen runs traced that no traced request queued
+    trace_file: str = 'logs/traces.jsonl'  # for jsonl
+    trace_otlp_endpoint: str = 'http://127.0.0.1:4318/v1/traces'  # OTLP/HTTP collector taking JSON, for otlp
+    trace_export_interval: float = 2  # seconds between exports of the finished spans
     # CDN
     cdn_list: List[str] = Field(default_factory=lambda: [])
+    cdn_tag_purge: bool = True  # purge by Cache-Tag on CDNs that support it, by URL otherwise
+    cdn_timeout: float = 30  # seconds per API request
+    cdn_retries: int = 3  # retries of an API request after a connection error, 429 or 5xx
+    cdn_retry_backoff: float = 1  # base seconds of the jittered exponential backoff between retries
+    cdn_warmup: bool = True  # prefetch changed routes and hot new files after a purge, on CDNs that can
+    cdn_warmup_files: int = 20  # most downloaded of the newly published files to prefetch
+    cdn_warmup_rate: float = 1  # prefetch requests per second and CDN
     cf_token: str = ''
     cf_zone_id: str = ''
+    cf_api_base: str = 'https://api.cloudflare.com/client/v4'
     ctcdn_ak: str = ''
     ctcdn_sk: str = ''
+    ctcdn_api_host: str = 'open.ctcdn.cn'  # with a scheme for a stand-in, e.g. http://127.0.0.1:8790, same for ottercloud_cdn_host
     # Crowdin
     crowdin_token: str = ''
     crowdin_project_name: str = 'Dalamud Plugins'
@@ -78,6 +137,7 @@ SENSITIVE_FIELDS = [
     'ottercloud_cdn_id',
     'ottercloud_cdn_key',
     'admin_user_pwd',
+    'profile_key',
     'xivlauncher_s3_access_key',
     'xivlauncher_s3_secret_key',
 ]
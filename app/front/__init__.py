@@ -2,12 +2,13 @@
 # cython:language_level=3
 import secrets
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Response
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 
 from .admin import router as admin_router
 from ..config import Settings
 from ..utils.common import get_settings
+from ..utils.metrics import render_metrics
 
 router = APIRouter()
 security = HTTPBasic()
@@ -28,3 +29,12 @@ async def verify_admin(settings: Settings = Depends(get_settings), credentials:
 
 
 router.include_router(admin_router, prefix='/admin', dependencies=[Depends(verify_admin)])
+
+
+@router.get('/metrics', dependencies=[Depends(verify_admin)])
+async def metrics():
+    rendered = render_metrics()
+    if rendered is None:
+        raise HTTPException(status_code=404, detail="Metrics are disabled, prometheus_client is not installed")
+    (content, media_type) = rendered
+    return Response(content=content, media_type=media_type)
@@ -2,10 +2,12 @@
 # cython:language_level=3
 import asyncio
 import json
+import os
 from datetime import datetime, timezone, timedelta
 from io import BytesIO
 
 from fastapi import APIRouter, HTTPException, Depends, Request, Form, UploadFile
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import RedirectResponse, PlainTextResponse, HTMLResponse, FileResponse, Response, JSONResponse
 from fastapi.templating import Jinja2Templates
 
@@ -14,8 +16,13 @@ from app.utils.cdn.ottercloudcdn import OtterCloudCDN
 from app.utils.common import get_settings, get_apilevel_namespace_map
 from app.utils.dalamud_log_analysis import analysis
 from app.utils.front import flash
-from app.utils.redis import RedisFeedBack, Redis
-from app.utils.tasks import regen, flush_stg_code
+from app.utils.pluginmaster import publish_pluginmaster_snapshots
+from app.utils.profiler import get_profile_key, prefix_collapsed, profiler, sign_profile_header
+from app.utils.redis import AsyncRedis, get_redis, get_redis_feedback
+from app.utils.jobs import enqueue_regen
+from app.utils import memory  # noqa: F401, registers the memory worker command
+from app.utils.tasks import flush_stg_code
+from app.utils.workers import worker_commands
 
 router = APIRouter()
 template = Jinja2Templates("templates")
@@ -70,10 +77,9 @@ async def front_admin_update():
 
 
 @router.get('/stg_code')
-async def front_admin_stg_code(request: Request):
-    r = Redis.create_client()
+async def front_admin_stg_code(request: Request, r: AsyncRedis = Depends(get_redis)):
     settings = get_settings()
-    stg_code = r.hget(f'{settings.redis_prefix}settings', 'stg_code')
+    stg_code = await r.hget(f'{settings.redis_prefix}settings', 'stg_code')
     flash(request, 'info', f'Stg Code为 {stg_code}')
     return RedirectResponse(url=request.app.url_path_for("front_admin_index"), status_code=303)
 
@@ -82,9 +88,8 @@ async def front_admin_stg_code(request: Request):
 
 # region feedback
 @router.get('/feedback', response_class=HTMLResponse)
-async def front_admin_feedback_get(request: Request):
-    r_fb = RedisFeedBack.create_client()
-    feedback_list = r_fb.keys('feedback|*')
+async def front_admin_feedback_get(request: Request, r_fb: AsyncRedis = Depends(get_redis_feedback)):
+    feedback_list = await r_fb.keys('feedback|*')
     return_list = []
     for i in feedback_list:
         temp_list = i.replace('feedback|', '').split('|')
@@ -93,15 +98,14 @@ async def front_admin_feedback_get(request: Request):
 
 
 @router.get('/feedback/export', response_class=HTMLResponse)
-async def front_admin_feedback_export_get(request: Request):
-    r_fb = RedisFeedBack.create_client()
-    feedback_list = r_fb.keys('feedback|*')
+async def front_admin_feedback_export_get(request: Request, r_fb: AsyncRedis = Depends(get_redis_feedback)):
+    feedback_list = await r_fb.keys('feedback|*')
     return_dict = {}
     for i in feedback_list:
         dhash, plugin_name, order_id = i.replace('feedback|', '').split('|')
         if plugin_name not in return_dict:
             return_dict[plugin_name] = []
-        feedback = r_fb.hgetall(f'feedback|{dhash}|{plugin_name}|{order_id}')
+        feedback = await r_fb.hgetall(f'feedback|{dhash}|{plugin_name}|{order_id}')
         create_time = datetime.fromtimestamp(float(feedback.get('create_time', 0)), tz=timezone(timedelta(hours=8))).strftime('%Y-%m-%d %H:%M:%S')
         return_dict[plugin_name].append({
             "order_id": order_id,
@@ -118,9 +122,8 @@ async def front_admin_feedback_export_get(request: Request):
 
 
 @router.get('/feedback/detail/{plugin_name}/{feedback_id}', response_class=HTMLResponse)
-async def front_admin_feedback_detail_get(request: Request, plugin_name: str, feedback_id: int, dhash: str | None = None):
-    r_fb = RedisFeedBack.create_client()
-    feedback = r_fb.hgetall(f'feedback|{dhash}|{plugin_name}|{feedback_id}')
+async def front_admin_feedback_detail_get(request: Request, plugin_name: str, feedback_id: int, dhash: str | None = None, r_fb: AsyncRedis = Depends(get_redis_feedback)):
+    feedback = await r_fb.hgetall(f'feedback|{dhash}|{plugin_name}|{feedback_id}')
     if not feedback:
         raise HTTPException(status_code=404, detail="Feedback not found")
     feedback['reply_log'] = json.loads(feedback['reply_log'])
@@ -129,11 +132,10 @@ async def front_admin_feedback_detail_get(request: Request, plugin_name: str, fe
 
 
 @router.get('/feedback/solve/{feedback_id}', response_class=RedirectResponse)
-async def front_admin_feedback_solve_get(request: Request, feedback_id: int, referer: str | None = None):
-    r_fb = RedisFeedBack.create_client()
-    feedback_list = r_fb.keys(f'feedback|*|{feedback_id}')
+async def front_admin_feedback_solve_get(request: Request, feedback_id: int, referer: str | None = None, r_fb: AsyncRedis = Depends(get_redis_feedback)):
+    feedback_list = await r_fb.keys(f'feedback|*|{feedback_id}')
     if len(feedback_list) == 1:
-        r_fb.delete(feedback_list[0])
+        await r_fb.delete(feedback_list[0])
         if referer == "export":
             return RedirectResponse(request.app.url_path_for('front_admin_feedback_export_get'))
         else:
@@ -174,27 +176,20 @@ async def front_admin_flush_post(request: Request, action: str = Form(...), task
 
 
 @router.get('/flush_cache')
-async def front_admin_flush_cache_get(request: Request, task: str | None = None):
+async def front_admin_flush_cache_get(request: Request, task: str | None = None, r: AsyncRedis = Depends(get_redis)):
     if task:
         match task:
             case 'dalamud':
-                regen(['dalamud', 'dalamud_changelog'])
-            case 'asset':
-                regen(['asset'])
-            case 'plugin':
-                regen(['plugin'])
-            case 'xivlauncher':
-                regen(['xivlauncher'])
-            case 'updater':
-                regen(['updater'])
-            case 'xlassets':
-                regen(['xlassets'])
+                task_list = ['dalamud', 'dalamud_changelog']
+            case 'asset' | 'plugin' | 'xivlauncher' | 'updater' | 'xlassets':
+                task_list = [task]
             case 'all':
-                regen(['dalamud', 'dalamud_changelog', 'asset', 'plugin', 'xivlauncher', 'updater', 'xlassets'])
+                task_list = ['dalamud', 'dalamud_changelog', 'asset', 'plugin', 'xivlauncher', 'updater', 'xlassets']
             case _:
                 flash(request, 'error', '任务不存在', )
                 return RedirectResponse(url=request.app.url_path_for("front_admin_flush_get"))
-        flash(request, 'success', f'刷新{task if task != "all" else "全部"}任务已完成')
+        job_id = await enqueue_regen(r, task_list)
+        flash(request, 'success', f'刷新{task if task != "all" else "全部"}任务已提交，任务ID {job_id}')
     else:
         raise HTTPException(status_code=400, detail="No task specified.")
     if request.headers.get('referer') and 'flush' in request.headers.get('referer'):
@@ -205,7 +200,7 @@ async def front_admin_flush_cache_get(request: Request, task: str | None = None)
 
 @router.get('/flush_stg_code')
 async def front_admin_flush_stg_code(request: Request):
-    stg_code = flush_stg_code()
+    stg_code = await run_in_threadpool(flush_stg_code)
     flash(request, 'success', f'刷新Stg Code已完成，新的key为 {stg_code}')
     if request.headers.get('referer') and 'flush' in request.headers.get('referer'):
         return RedirectResponse(url=request.app.url_path_for("front_admin_flush_get"), status_code=303)
@@ -231,28 +226,27 @@ async def front_admin_log_analytics_post(request: Request, file: UploadFile = Fo
 # endregion
 
 # region plugin translations
-def _load_pluginmaster():
-    r = Redis.create_client()
+async def _load_pluginmaster(r: AsyncRedis):
     settings = get_settings()
     apilevel_namespace_map = get_apilevel_namespace_map()
     plugin_namespace = apilevel_namespace_map.get(settings.plugin_api_level)
-    pluginmaster_str = r.hget(f'{settings.redis_prefix}{plugin_namespace}', 'pluginmaster')
+    pluginmaster_str = await r.hget(f'{settings.redis_prefix}{plugin_namespace}', 'pluginmaster')
     return json.loads(pluginmaster_str) if pluginmaster_str else []
 
 
 @router.get('/plugins', response_class=HTMLResponse)
-async def front_admin_plugins_get(request: Request, settings: Settings = Depends(get_settings)):
-    r = Redis.create_client()
+async def front_admin_plugins_get(request: Request, settings: Settings = Depends(get_settings), r: AsyncRedis = Depends(get_redis)):
     lang = settings.default_pm_lang
-    pluginmaster = _load_pluginmaster()
-    name_tr = json.loads(r.hget(f'{settings.redis_prefix}crowdin', f'plugin-name-{lang}') or '{}')
-    desc_tr = json.loads(r.hget(f'{settings.redis_prefix}crowdin', f'plugin-description-{lang}') or '{}')
-    punch_tr = json.loads(r.hget(f'{settings.redis_prefix}crowdin', f'plugin-punchline-{lang}') or '{}')
+    pluginmaster = await _load_pluginmaster(r)
+    name_tr = json.loads(await r.hget(f'{settings.redis_prefix}crowdin', f'plugin-name-{lang}') or '{}')
+    desc_tr = json.loads(await r.hget(f'{settings.redis_prefix}crowdin', f'plugin-description-{lang}') or '{}')
+    punch_tr = json.loads(await r.hget(f'{settings.redis_prefix}crowdin', f'plugin-punchline-{lang}') or '{}')
+    download_counts = await r.hgetall(f'{settings.redis_prefix}plugin-count')
     plugins = []
     for p in pluginmaster:
         internal_name = p.get('InternalName', '')
         last_update = int(p.get('LastUpdate', 0) or 0)
-        download_count = r.hget(f'{settings.redis_prefix}plugin-count', internal_name)
+        download_count = download_counts.get(internal_name)
         download_count = int(download_count) if download_count else int(p.get('DownloadCount', 0) or 0)
         last_update_str = ''
         if last_update:
@@ -291,9 +285,9 @@ async def front_admin_plugins_get(request: Request, settings: Settings = Depends
 
 
 @router.get('/plugins/download_all')
-async def front_admin_plugins_download_all():
+async def front_admin_plugins_download_all(r: AsyncRedis = Depends(get_redis)):
     items = []
-    for p in _load_pluginmaster():
+    for p in await _load_pluginmaster(r):
         items.append({
             'InternalName': p.get('InternalName', ''),
             'Name': p.get('Name', ''),
@@ -309,14 +303,13 @@ async def front_admin_plugins_download_all():
 
 
 @router.get('/plugins/download_all_translated')
-async def front_admin_plugins_download_all_translated(settings: Settings = Depends(get_settings)):
-    r = Redis.create_client()
+async def front_admin_plugins_download_all_translated(settings: Settings = Depends(get_settings), r: AsyncRedis = Depends(get_redis)):
     lang = settings.default_pm_lang
-    name_tr = json.loads(r.hget(f'{settings.redis_prefix}crowdin', f'plugin-name-{lang}') or '{}')
-    desc_tr = json.loads(r.hget(f'{settings.redis_prefix}crowdin', f'plugin-description-{lang}') or '{}')
-    punch_tr = json.loads(r.hget(f'{settings.redis_prefix}crowdin', f'plugin-punchline-{lang}') or '{}')
+    name_tr = json.loads(await r.hget(f'{settings.redis_prefix}crowdin', f'plugin-name-{lang}') or '{}')
+    desc_tr = json.loads(await r.hget(f'{settings.redis_prefix}crowdin', f'plugin-description-{lang}') or '{}')
+    punch_tr = json.loads(await r.hget(f'{settings.redis_prefix}crowdin', f'plugin-punchline-{lang}') or '{}')
     items = []
-    for p in _load_pluginmaster():
+    for p in await _load_pluginmaster(r):
         internal_name = p.get('InternalName', '')
         items.append({
             'InternalName': internal_name,
@@ -338,7 +331,7 @@ async def front_admin_plugins_download_all_translated(settings: Settings = Depen
 
 
 @router.post('/plugins/upload_all')
-async def front_admin_plugins_upload_all(request: Request, lang: str = Form(...), file: UploadFile = Form(...), settings: Settings = Depends(get_settings)):
+async def front_admin_plugins_upload_all(request: Request, lang: str = Form(...), file: UploadFile = Form(...), settings: Settings = Depends(get_settings), r: AsyncRedis = Depends(get_redis)):
     lang = lang.strip()
     if not lang:
         flash(request, 'error', '语言不能为空')
@@ -359,13 +352,13 @@ async def front_admin_plugins_upload_all(request: Request, lang: str = Form(...)
                 value = item.get(src_key)
                 if value:
                     field_maps[field][internal] = value
-        r = Redis.create_client()
         counts = {}
         for field, new_map in field_maps.items():
-            existing = json.loads(r.hget(f'{settings.redis_prefix}crowdin', f'plugin-{field}-{lang}') or '{}')
+            existing = json.loads(await r.hget(f'{settings.redis_prefix}crowdin', f'plugin-{field}-{lang}') or '{}')
             existing.update(new_map)
-            r.hset(f'{settings.redis_prefix}crowdin', f'plugin-{field}-{lang}', json.dumps(existing, ensure_ascii=False))
+            await r.hset(f'{settings.redis_prefix}crowdin', f'plugin-{field}-{lang}', json.dumps(existing, ensure_ascii=False))
             counts[field] = len(new_map)
+        await run_in_threadpool(publish_pluginmaster_snapshots)
         flash(request, 'success', f'已上传 {lang} 整合翻译：Name {counts["name"]} 条、Punchline {counts["punchline"]} 条、Description {counts["description"]} 条')
     except Exception as e:
         flash(request, 'error', f'上传失败：{e}')
@@ -373,28 +366,107 @@ async def front_admin_plugins_upload_all(request: Request, lang: str = Form(...)
 
 
 @router.post('/plugins/edit')
-async def front_admin_plugins_edit(request: Request, internal_name: str = Form(...), lang: str = Form(...), name: str = Form(''), punchline: str = Form(''), description: str = Form(''), settings: Settings = Depends(get_settings)):
+async def front_admin_plugins_edit(request: Request, internal_name: str = Form(...), lang: str = Form(...), name: str = Form(''), punchline: str = Form(''), description: str = Form(''), settings: Settings = Depends(get_settings), r: AsyncRedis = Depends(get_redis)):
     lang = lang.strip()
     if not lang:
         return JSONResponse({'ok': False, 'error': '语言为空'}, status_code=400)
     if not internal_name:
         return JSONResponse({'ok': False, 'error': '缺少 InternalName'}, status_code=400)
     try:
-        r = Redis.create_client()
         hkey = f'{settings.redis_prefix}crowdin'
         result = {}
         for field, value in (('name', name), ('punchline', punchline), ('description', description)):
             value = value.strip()
             fkey = f'plugin-{field}-{lang}'
-            field_map = json.loads(r.hget(hkey, fkey) or '{}')
+            field_map = json.loads(await r.hget(hkey, fkey) or '{}')
             if value:
                 field_map[internal_name] = value
             else:
                 field_map.pop(internal_name, None)
-            r.hset(hkey, fkey, json.dumps(field_map, ensure_ascii=False))
+            await r.hset(hkey, fkey, json.dumps(field_map, ensure_ascii=False))
             result[field] = value
+        await run_in_threadpool(publish_pluginmaster_snapshots)
         return JSONResponse({'ok': True, **result})
     except Exception as e:
         return JSONResponse({'ok': False, 'error': str(e)}, status_code=500)
 
 # endregion
+
+
+# region profile
+@router.get('/profile', response_class=PlainTextResponse)
+async def front_admin_profile(seconds: float = 10, workers: str = 'all', r: AsyncRedis = Depends(get_redis)):
+    """Sampled stacks of this worker or all workers in the collapsed format, for flamegraph.pl or speedscope."""
+    settings = get_settings()
+    if not 0 < seconds <= settings.profile_max_seconds:
+        raise HTTPException(status_code=400, detail=f"seconds must be in (0, {settings.profile_max_seconds}]")
+    if workers == 'all':
+        results = await worker_commands.run_all(r, 'profile', {'seconds': seconds, 'interval': settings.profile_interval}, seconds)
+        # A root frame per worker, failed workers are left out
+        return ''.join(prefix_collapsed(x['result'], f'worker {pid}') for (pid, x) in results.items() if 'result' in x)
+    collapsed = await profiler.profile(seconds, settings.profile_interval)
+    if collapsed is None:
+        raise HTTPException(status_code=409, detail="A profile is running already")
+    return collapsed
+
+
+@router.get('/profile/sign', response_class=PlainTextResponse)
+async def front_admin_profile_sign(path: str, ttl: int = 300):
+    """An X-Profile header value for requests to `path`."""
+    if not get_settings().profile_key:
+        raise HTTPException(status_code=400, detail="profile_key is not set")
+    return sign_profile_header(path, ttl)
+
+
+@router.get('/profile/{profile_id}', response_class=PlainTextResponse)
+async def front_admin_profile_get(profile_id: str, r: AsyncRedis = Depends(get_redis)):
+    results = await r.hgetall(get_profile_key(profile_id))
+    if not results:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return ''.join(results.values())
+
+# endregion
+
+
+# region memory
+async def run_memory_command(r: AsyncRedis, workers: str, action: str, **params) -> JSONResponse:
+    """Results by pid, of every worker or of the one handling the request."""
+    if workers == 'all':
+        results = await worker_commands.run_all(r, 'memory', {'action': action, **params}, timeout=60)
+    else:
+        results = {str(os.getpid()): await worker_commands.run_local('memory', {'action': action, **params})}
+    return JSONResponse(results)
+
+
+@router.get('/memory')
+async def front_admin_memory(workers: str = 'all', r: AsyncRedis = Depends(get_redis)):
+    """RSS, GC statistics and the tracemalloc state."""
+    return await run_memory_command(r, workers, 'stats')
+
+
+@router.post('/memory/tracemalloc/start')
+async def front_admin_memory_start(frames: int = 1, workers: str = 'all', r: AsyncRedis = Depends(get_redis)):
+    return await run_memory_command(r, workers, 'start', frames=frames)
+
+
+@router.post('/memory/tracemalloc/stop')
+async def front_admin_memory_stop(workers: str = 'all', r: AsyncRedis = Depends(get_redis)):
+    return await run_memory_command(r, workers, 'stop')
+
+
+@router.post('/memory/snapshot')
+async def front_admin_memory_snapshot(name: str, workers: str = 'all', r: AsyncRedis = Depends(get_redis)):
+    return await run_memory_command(r, workers, 'snapshot', name=name)
+
+
+@router.get('/memory/top')
+async def front_admin_memory_top(name: str = '', group_by: str = 'lineno', limit: int = 25, workers: str = 'all', r: AsyncRedis = Depends(get_redis)):
+    return await run_memory_command(r, workers, 'top', name=name, group_by=group_by, limit=limit)
+
+
+@router.get('/memory/diff')
+async def front_admin_memory_diff(before: str, after: str = '', group_by: str = 'lineno', limit: int = 25, workers: str = 'all', r: AsyncRedis = Depends(get_redis)):
+    """Top allocation sites by growth between the snapshot `before` and `after`, or the heap now."""
+    return await run_memory_command(r, workers, 'diff', before=before, after=after, group_by=group_by, limit=limit)
+
+# endregion
@@ -12,6 +12,7 @@ from .launcher import router as router_launcher
 from .plogon import router as router_plogon
 from .faq import router as router_faq
 from .updater import router as router_updater
+from .job import router as router_job
 from app.utils.common import get_settings
 
 router = APIRouter()
@@ -24,6 +25,7 @@ router.include_router(router_launcher, tags=["launcher"], prefix="/Launcher")
 router.include_router(router_plogon, tags=["plogon"], prefix="/Plogon")
 router.include_router(router_faq, tags=["faq"], prefix="/faq")
 router.include_router(router_updater, tags=["updater"], prefix="/Updater")
+router.include_router(router_job, tags=["job"], prefix="/Job")
 
 # @router.get("/", response_class=HTMLResponse)
 # async def home():
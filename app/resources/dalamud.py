@@ -1,18 +1,21 @@
 import asyncio
 import hashlib
-import json
 
 import httpx
 import orjson
 from pydantic import BaseModel, Field
-from fastapi import APIRouter, HTTPException, Depends, Query, BackgroundTasks
-from fastapi.responses import RedirectResponse, PlainTextResponse
+from fastapi import APIRouter, HTTPException, Depends, Query, Request
+from fastapi.responses import PlainTextResponse
 from app.utils import httpx_client
 from app.config import Settings
+from app.utils.changes import get_resolution_tag
 from app.utils.common import get_settings, get_tos_content, get_tos_hash
-from app.utils.redis import Redis
+from app.utils.downloads import download_redirect
+from app.utils.materialized import materialized_response
+from app.utils.redis import AsyncRedis, get_redis
+from app.utils.resolution import resolution_tables
 
-from app.utils.tasks import regen
+from app.utils.jobs import enqueue_regen
 
 router = APIRouter()
 
@@ -35,48 +38,36 @@ class Analytics(BaseModel):
 
 
 @router.get("/Asset/Meta")
-async def dalamud_assets(settings: Settings = Depends(get_settings)):
-    r = Redis.create_client()
-    asset_str = r.hget(f'{settings.redis_prefix}asset', 'meta')
-    if not asset_str:
+async def dalamud_assets(request: Request, r: AsyncRedis = Depends(get_redis)):
+    response = await materialized_response(request, r, 'asset', 'meta')
+    if not response:
         raise HTTPException(status_code=404, detail="Asset meta not found")
-    asset_json = json.loads(asset_str)
-    return asset_json
+    return response
 
 
 @router.get("/Release/VersionInfo")
-async def dalamud_release(settings: Settings = Depends(get_settings), track: str = "release"):
+async def dalamud_release(request: Request, r: AsyncRedis = Depends(get_redis), track: str = "release"):
     if track == "staging":
         track = "stg"
     if not track:
         track = "release"
-    r = Redis.create_client()
-    version_str = r.hget(f'{settings.redis_prefix}dalamud', f'dist-{track}')
-    if not version_str:
+    response = await materialized_response(request, r, 'dalamud', f'versioninfo-{track}')
+    if not response:
         raise HTTPException(status_code=400, detail="Invalid track")
-    version_json = json.loads(version_str)
-    return version_json
+    return response
 
 
 @router.get("/Release/Meta")
-async def dalamud_release_meta(settings: Settings = Depends(get_settings)):
-    meta_json = {}
-    r = Redis.create_client()
-    for track in ['release', 'stg', 'canary']:
-        version_str = r.hget(f'{settings.redis_prefix}dalamud', f'dist-{track}')
-        if not version_str:
-            continue
-        version_json = json.loads(version_str)
-        meta_json[track] = version_json
-    return meta_json
+async def dalamud_release_meta(request: Request, r: AsyncRedis = Depends(get_redis)):
+    response = await materialized_response(request, r, 'dalamud', 'meta')
+    return response or {}
 
 
 @router.get("/Release/Runtime/{kind_version:path}")
-async def dalamud_runtime(kind_version: str, settings: Settings = Depends(get_settings)):
+async def dalamud_runtime(kind_version: str, settings: Settings = Depends(get_settings), r: AsyncRedis = Depends(get_redis)):
     if len(kind_version.split('/')) != 2:
         return HTTPException(status_code=400, detail="Invalid path")
     kind, version = kind_version.split('/')
-    r = Redis.create_client()
     kind_map = {
         'WindowsDesktop': 'desktop',
         'DotNet': 'dotnet',
@@ -84,26 +75,28 @@ async def dalamud_runtime(kind_version: str, settings: Settings = Depends(get_se
     }
     if kind not in kind_map:
         raise HTTPException(status_code=400, detail="Invalid kind")
-    hashed_name = r.hget(f'{settings.redis_prefix}runtime', f'{kind_map[kind]}-{version}')
+    hashed_name = await resolution_tables.resolve(r, 'runtime', f'{kind_map[kind]}-{version}')
     if not hashed_name:
         raise HTTPException(status_code=400, detail="Invalid version")
-    return RedirectResponse(f"/File/Get/{hashed_name}", status_code=302)
+    return download_redirect(hashed_name, get_resolution_tag('runtime', f'{kind_map[kind]}-{version}'))
 
 
 @router.post("/Release/ClearCache")
-async def release_clear_cache(background_tasks: BackgroundTasks, key: str = Query(), settings: Settings = Depends(get_settings)):
+async def release_clear_cache(key: str = Query(), settings: Settings = Depends(get_settings),
+                              r: AsyncRedis = Depends(get_redis)):
     if key != settings.cache_clear_key:
         raise HTTPException(status_code=400, detail="Cache clear key not match")
-    background_tasks.add_task(regen, ['dalamud', 'dalamud_changelog'])
-    return {'message': 'Background task was started.'}
+    job_id = await enqueue_regen(r, ['dalamud', 'dalamud_changelog'])
+    return {'message': 'Background task was queued.', 'job_id': job_id}
 
 
 @router.post("/Asset/ClearCache")
-async def asset_clear_cache(background_tasks: BackgroundTasks, key: str = Query(), settings: Settings = Depends(get_settings)):
+async def asset_clear_cache(key: str = Query(), settings: Settings = Depends(get_settings),
+                            r: AsyncRedis = Depends(get_redis)):
     if key != settings.cache_clear_key:
         raise HTTPException(status_code=400, detail="Cache clear key not match")
-    background_tasks.add_task(regen, ['asset'])
-    return {'message': 'Background task was started.'}
+    job_id = await enqueue_regen(r, ['asset'])
+    return {'message': 'Background task was queued.', 'job_id': job_id}
 
 
 async def _analytics_post(url: str, payload: dict):
@@ -123,14 +116,13 @@ async def _analytics_post(url: str, payload: dict):
 
 
 @router.post("/Analytics/Start")
-async def analytics_start(analytics: Analytics, settings: Settings = Depends(get_settings)):
+async def analytics_start(analytics: Analytics, settings: Settings = Depends(get_settings), r: AsyncRedis = Depends(get_redis)):
     ga_url = f"https://www.google-analytics.com/mp/collect?measurement_id={measurement_id}&api_secret={api_secret}"
-    r = Redis.create_client()
-    cheatplugin_hash = r.hget(f'{settings.redis_prefix}asset', 'cheatplugin_hash')
-    cheatplugin_hash_sha256 = r.hget(f'{settings.redis_prefix}asset', 'cheatplugin_hash_sha256')
+    cheatplugin_hash = await r.hget(f'{settings.redis_prefix}asset', 'cheatplugin_hash')
+    cheatplugin_hash_sha256 = await r.hget(f'{settings.redis_prefix}asset', 'cheatplugin_hash_sha256')
     cheat_banned_hash_valid = analytics.cheat_banned_hash and \
                               (cheatplugin_hash == analytics.cheat_banned_hash or cheatplugin_hash_sha256 == analytics.cheat_banned_hash)
-    plugin_name_list = r.lrange(f'{settings.redis_prefix}plugin_name_list', 0, -1)
+    plugin_name_list = await r.lrange(f'{settings.redis_prefix}plugin_name_list', 0, -1)
     plugin_3rd_list = list(set(analytics.plugin_list) - set(plugin_name_list))
     user_id = hashlib.blake2s(analytics.user_id.encode(), digest_size=8).hexdigest()
     user_props_base = {
@@ -185,8 +177,7 @@ class StgCode(BaseModel):
 
 
 @router.post("/Check/StgCode")
-async def check_stg_code(StgCode: StgCode, settings: Settings = Depends(get_settings)):
-    r = Redis.create_client()
-    if StgCode.code != r.hget(f'{settings.redis_prefix}settings', 'stg_code'):
+async def check_stg_code(StgCode: StgCode, settings: Settings = Depends(get_settings), r: AsyncRedis = Depends(get_redis)):
+    if StgCode.code != await r.hget(f'{settings.redis_prefix}settings', 'stg_code'):
         raise HTTPException(status_code=400, detail="Invalid code")
     return {'message': 'OK'}
@@ -1,22 +1,58 @@
-import os
-import re
-from fastapi import APIRouter, HTTPException, Path
+from email.utils import formatdate
+from mimetypes import guess_type
+from urllib.parse import quote
+
+from fastapi import APIRouter, HTTPException, Path, Request, Response
 from fastapi.responses import FileResponse
 
+from app.utils.common import get_settings
+from app.utils.file_index import FILENAME_REGEX, file_index
+from app.utils.responses import etag_matches
+
 router = APIRouter()
 
-FILENAME_REGEX = r"(?P<name>.*?)\.(?P<hash>.{64})\.(?P<ext>.*)"
+# The content of a hashed name never changes
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+def get_content_disposition(filename: str) -> str:
+    """The header FileResponse sends for a download of this name."""
+    quoted_filename = quote(filename)
+    if quoted_filename != filename:
+        return f"attachment; filename*=utf-8''{quoted_filename}"
+    return f'attachment; filename="{filename}"'
+
+
+def supports_pathsend(request: Request) -> bool:
+    return 'http.response.pathsend' in request.scope.get('extensions', {})
+
 
 @router.get("/Get/{file_name}")
-async def file_get(file_name: str = Path(regex=FILENAME_REGEX)):
-    cache_dir = os.getenv('CACHE_DIR', 'cache')
-    if not os.path.isdir(cache_dir):
-        os.mkdir(cache_dir)
-    match = re.match(FILENAME_REGEX, file_name)
-    if not match:
-        raise HTTPException(status_code=400, detail="File name format mismatch")
-    clean_file_name = f"{match.group('name')}.{match.group('ext')}"
-    file_path = os.path.join(cache_dir, file_name)
-    if not os.path.isfile(file_path):
+async def file_get(request: Request, file_name: str = Path(regex=FILENAME_REGEX)):
+    settings = get_settings()
+    entry = await file_index.lookup(file_name)
+    if not entry:
         raise HTTPException(status_code=404, detail="File not found")
-    return FileResponse(file_path, filename=clean_file_name)
+    headers = {'ETag': f'"{entry.hash}"', 'Cache-Control': IMMUTABLE_CACHE_CONTROL}
+    if etag_matches(request.headers.get('if-none-match'), headers['ETag']):
+        return Response(status_code=304, headers=headers)
+    file_headers = {
+        **headers,
+        'Content-Disposition': get_content_disposition(entry.name),
+        'Last-Modified': formatdate(entry.stat.st_mtime, usegmt=True),
+    }
+    media_type = guess_type(entry.name)[0] or 'text/plain'
+    # The web server in front sends the file, ranges included
+    if settings.file_offload_mode == 'x-accel':
+        file_headers['X-Accel-Redirect'] = f"{settings.file_offload_prefix.rstrip('/')}/{quote(file_name)}"
+        return Response(media_type=media_type, headers=file_headers)
+    if settings.file_offload_mode == 'x-sendfile':
+        file_headers['X-Sendfile'] = entry.path
+        return Response(media_type=media_type, headers=file_headers)
+    # FileResponse hands the path to an ASGI server that supports it instead of reading the file
+    offload = settings.file_offload_mode == 'pathsend' and supports_pathsend(request)
+    if not offload and 'range' not in request.headers:
+        content = await file_index.get_content(file_name, entry)
+        if content is not None:
+            return Response(content=content, media_type=media_type, headers=file_headers)
+    return FileResponse(entry.path, headers=headers, filename=entry.name, stat_result=entry.stat)
@@ -0,0 +1,19 @@
+from fastapi import APIRouter, HTTPException, Depends, Query
+
+from app.config import Settings
+from app.utils.common import get_settings
+from app.utils.jobs import get_job
+from app.utils.redis import AsyncRedis, get_redis
+
+router = APIRouter()
+
+
+@router.get("/{job_id}")
+async def job_status(job_id: str, key: str = Query(), settings: Settings = Depends(get_settings),
+                     r: AsyncRedis = Depends(get_redis)):
+    if key != settings.cache_clear_key:
+        raise HTTPException(status_code=400, detail="Cache clear key not match")
+    job = await get_job(r, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
@@ -1,13 +1,17 @@
 from datetime import datetime, timedelta
 from typing import Union
 
-from fastapi import APIRouter, HTTPException, Depends, Query, BackgroundTasks, Header
-from fastapi.responses import RedirectResponse
+from fastapi import APIRouter, HTTPException, Depends, Query, Header
+from fastapi.responses import RedirectResponse, Response
 
 from app.config import Settings
+from app.utils.changes import get_resolution_tag, surrogate_key_headers
 from app.utils.common import get_settings
-from app.utils.redis import Redis
-from app.utils.tasks import regen
+from app.utils.counter import download_counters
+from app.utils.downloads import download_redirect
+from app.utils.redis import AsyncRedis, get_redis
+from app.utils.resolution import resolution_tables
+from app.utils.jobs import enqueue_regen
 
 router = APIRouter()
 
@@ -16,6 +20,7 @@ SEMVER_REGEX = r"^(0|[1-9]\d*)\.(0|[1-9]\d*)\.(0|[1-9]\d*)(\.(0|[1-9]\d*))?(?:-(
 
 @router.get("/GetLease")
 async def launcher(
+        response: Response,
         user_agent: Union[str, None] = Header(default="XIVLauncher"),
         x_xl_track: Union[str, None] = Header(default="Release"),
         x_xl_lv: Union[str, None] = Header(default="0"),
@@ -24,20 +29,21 @@ async def launcher(
         x_xl_firststart: Union[str, None] = Header(default="no", regex=r"yes|no"),
         x_xl_havewine: Union[str, None] = Header(default="no", regex=r"yes|no"),
         accept: Union[str, None] = Header(default="*/*"),
-        settings: Settings = Depends(get_settings)
+        settings: Settings = Depends(get_settings),
+        r: AsyncRedis = Depends(get_redis)
 ):
-    r = Redis.create_client()
     if x_xl_track == 'Release':
         release_type = 'release'
     elif x_xl_track == 'Prerelease':
         release_type = 'prerelease'
     else:
         raise HTTPException(status_code=400, detail="Invalid track")
-    releases_list = r.hget(f'{settings.redis_prefix}xivlauncher', f'{release_type}-releaseslist')
+    releases_list = await resolution_tables.resolve(r, 'xivlauncher', f'{release_type}-releaseslist')
+    response.headers.update(surrogate_key_headers(get_resolution_tag('xivlauncher', f'{release_type}-releaseslist')))
 
     if x_xl_firststart == 'yes' or not x_xl_haveversion:
-        r.hincrby(f'{settings.redis_prefix}xivlauncher-count', 'XLUniqueInstalls')
-    r.hincrby(f'{settings.redis_prefix}xivlauncher-count', 'XLStarts')
+        download_counters.incr(f'{settings.redis_prefix}xivlauncher-count', 'XLUniqueInstalls')
+    download_counters.incr(f'{settings.redis_prefix}xivlauncher-count', 'XLStarts')
 
     return {
         "success": True,
@@ -60,16 +66,16 @@ async def launcher_file(
         x_xl_firststart: Union[str, None] = Header(default="no", regex=r"yes|no"),
         x_xl_havewine: Union[str, None] = Header(default="no", regex=r"yes|no"),
         accept: Union[str, None] = Header(default="*/*"),
-        settings: Settings = Depends(get_settings)
+        settings: Settings = Depends(get_settings),
+        r: AsyncRedis = Depends(get_redis)
 ):
-    r = Redis.create_client()
     if x_xl_track == 'Release':
         release_type = 'release'
     elif x_xl_track == 'Prerelease':
         release_type = 'prerelease'
     else:
         raise HTTPException(status_code=400, detail="Invalid track")
-    tag_name = r.hget(f'{settings.redis_prefix}xivlauncher', f'{release_type}-tag')
+    tag_name = await resolution_tables.resolve(r, 'xivlauncher', f'{release_type}-tag')
     valid_files = [
         'Setup.exe',
         f'XIVLauncherCN-{tag_name}-delta.nupkg',
@@ -78,18 +84,21 @@ async def launcher_file(
         f'XIVLauncher-{tag_name}-full.nupkg',
         'CHANGELOG.txt'
     ]
-    hashed_name = r.hget(f'{settings.redis_prefix}xivlauncher', f'{release_type}-{file}')
-    if file not in valid_files or not hashed_name:
+    if file not in valid_files:
         raise HTTPException(status_code=400, detail="Invalid file name")
-    return RedirectResponse(f"/File/Get/{hashed_name}", status_code=302)
+    hashed_name = await resolution_tables.resolve(r, 'xivlauncher', f'{release_type}-{file}')
+    if not hashed_name:
+        raise HTTPException(status_code=400, detail="Invalid file name")
+    return download_redirect(hashed_name, get_resolution_tag('xivlauncher', f'{release_type}-{file}'))
 
 
 @router.post("/ClearCache")
-async def clear_cache(background_tasks: BackgroundTasks, key: str = Query(), settings: Settings = Depends(get_settings)):
+async def clear_cache(key: str = Query(), settings: Settings = Depends(get_settings),
+                      r: AsyncRedis = Depends(get_redis)):
     if key != settings.cache_clear_key:
         raise HTTPException(status_code=400, detail="Cache clear key not match")
-    background_tasks.add_task(regen, ['xivlauncher'])
-    return {'message': 'Background task was started.'}
+    job_id = await enqueue_regen(r, ['xivlauncher'])
+    return {'message': 'Background task was queued.', 'job_id': job_id}
 
 
 @router.get("/Download")
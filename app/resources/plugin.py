@@ -1,101 +1,130 @@
 import re
 import json
 import time
+from typing import Union
 from app.config import Settings
 from app.utils import httpx_client
+from app.utils.changes import get_pluginmaster_tag, get_resolution_tag, surrogate_key_headers
 from app.utils.common import get_settings, get_apilevel_namespace_map
-from app.utils.responses import PrettyJSONResponse
-from app.utils.redis import Redis, RedisFeedBack
-from app.utils.tasks import regen
-from fastapi import APIRouter, HTTPException, Depends, Query, BackgroundTasks
-from fastapi.responses import RedirectResponse
+from app.utils.compression import choose_encoding
+from app.utils.counter import download_counters
+from app.utils.downloads import download_redirect
+from app.utils.materialized import materialized_response, publish_cold
+from app.utils.pluginmaster import pluginmaster_snapshots, publish_pluginmaster_snapshot
+from app.utils.resolution import resolution_tables
+from app.utils.responses import PrettyJSONResponse, etag_matches
+from app.utils.redis import AsyncRedis, get_redis, get_redis_feedback
+from app.utils.jobs import enqueue_regen
+from fastapi import APIRouter, HTTPException, Depends, Query, BackgroundTasks, Header, Request
+from fastapi.responses import Response
 from pydantic import BaseModel
 
 router = APIRouter()
 
+API_LEVEL_RE = re.compile(r'api(?P<level>\d+)')
+
 
 @router.get("/Download/{plugin}")
-async def plugin_download(plugin: str, isUpdate: bool = False, isTesting: bool = False, branch: str = '', settings: Settings = Depends(get_settings)):
-    r = Redis.create_client()
-    try:
-        api_level = re.search(r'api(?P<level>\d+)', branch).group('level')
-    except AttributeError:
+async def plugin_download(plugin: str, isUpdate: bool = False, isTesting: bool = False, branch: str = '', settings: Settings = Depends(get_settings), r: AsyncRedis = Depends(get_redis)):
+    match = API_LEVEL_RE.search(branch)
+    if not match:
         raise HTTPException(status_code=400, detail="Miss API level")
-    if not api_level:
-        api_level = settings.plugin_api_level
-    else:
-        api_level = int(api_level)
+    api_level = int(match.group('level'))
     apilevel_namespace_map = get_apilevel_namespace_map()
     if api_level not in apilevel_namespace_map:
         return HTTPException(status_code=400, detail="API level not supported")
     plugin_namespace = apilevel_namespace_map[api_level]
     plugin_name = plugin + '-testing' if isTesting else plugin
-    plugin_hashed_name = r.hget(f'{settings.redis_prefix}{plugin_namespace}', plugin_name)
+    plugin_hashed_name = await resolution_tables.resolve(r, plugin_namespace, plugin_name)
     if not plugin_hashed_name and isTesting:  # use stable if testing not exists
-        plugin_hashed_name = r.hget(f'{settings.redis_prefix}{plugin_namespace}', plugin)
+        plugin_hashed_name = await resolution_tables.resolve(r, plugin_namespace, plugin)
     if not plugin_hashed_name:
         raise HTTPException(status_code=404, detail="Plugin not found")
-    r.hincrby(f'{settings.redis_prefix}plugin-count', plugin)
-    r.hincrby(f'{settings.redis_prefix}plugin-count', 'accumulated')
-    return RedirectResponse(f"/File/Get/{plugin_hashed_name}", status_code=302)
+    download_counters.incr(f'{settings.redis_prefix}plugin-count', plugin)
+    download_counters.incr(f'{settings.redis_prefix}plugin-count', 'accumulated')
+    return download_redirect(plugin_hashed_name, get_resolution_tag(plugin_namespace, plugin))
+
+
+async def get_pluginmaster_snapshot(background_tasks: BackgroundTasks, r: AsyncRedis, plugin_namespace: str) -> dict:
+    snapshot = await pluginmaster_snapshots.get(r, plugin_namespace)
+    if not snapshot:  # not published yet, e.g. right after an upgrade
+        snapshot = await publish_cold(r, f'pluginmaster|{plugin_namespace}',
+                                      lambda: publish_pluginmaster_snapshot(None, plugin_namespace),
+                                      lambda: pluginmaster_snapshots.get(r, plugin_namespace, force=True))
+    if not snapshot:
+        raise HTTPException(status_code=404, detail="Pluginmaster not found")
+    if await pluginmaster_snapshots.claim_refresh(r, plugin_namespace, snapshot):
+        background_tasks.add_task(publish_pluginmaster_snapshot, None, plugin_namespace)
+    return snapshot
 
 
 @router.get("/PluginMaster", response_class=PrettyJSONResponse)
-async def pluginmaster(apiLevel: int = 0, settings: Settings = Depends(get_settings)):
-    r = Redis.create_client()
+async def pluginmaster(
+        request: Request,
+        background_tasks: BackgroundTasks,
+        apiLevel: int = 0,
+        accept_encoding: Union[str, None] = Header(default=''),
+        settings: Settings = Depends(get_settings),
+        r: AsyncRedis = Depends(get_redis)
+):
     if not apiLevel:
         apiLevel = settings.plugin_api_level
     apilevel_namespace_map = get_apilevel_namespace_map()
     if apiLevel not in apilevel_namespace_map:
         return HTTPException(status_code=400, detail="API level not supported")
     plugin_namespace = apilevel_namespace_map[apiLevel]
-    pluginmaster_str = r.hget(f'{settings.redis_prefix}{plugin_namespace}', 'pluginmaster')
-    if not pluginmaster_str:
-        raise HTTPException(status_code=404, detail="Pluginmaster not found")
-    pluginmaster = json.loads(pluginmaster_str)
-    translations = {}
-    if settings.default_pm_lang != 'en-US':
-        name_str = r.hget(f'{settings.redis_prefix}crowdin', f'plugin-name-{settings.default_pm_lang}') or '{}'
-        desc_str = r.hget(f'{settings.redis_prefix}crowdin', f'plugin-description-{settings.default_pm_lang}') or '{}'
-        punchline_str = r.hget(f'{settings.redis_prefix}crowdin', f'plugin-punchline-{settings.default_pm_lang}') or '{}'
-        translations = {
-            'name': json.loads(name_str),
-            'description': json.loads(desc_str),
-            'punchline': json.loads(punchline_str)
-        }
-    # print(translations)
-    for plugin in pluginmaster:
-        plugin_name = plugin['InternalName']
-        download_count = r.hget(f'{settings.redis_prefix}plugin-count', plugin_name) or 0
-        plugin["DownloadCount"] = int(download_count)
-        if translations:
-            for tkey, src_key, tr_field in (
-                ('NameLoc', 'Name', 'name'),
-                ('PunchlineLoc', 'Punchline', 'punchline'),
-                ('DescriptionLoc', 'Description', 'description'),
-            ):
-                translated = translations[tr_field].get(plugin_name, '')
-                original = plugin.get(src_key, '')
-                plugin[tkey] = translated if (translated and translated != original) else ''
-    return pluginmaster
+    snapshot = await get_pluginmaster_snapshot(background_tasks, r, plugin_namespace)
+    encoding = choose_encoding(accept_encoding, snapshot['encodings'])
+    (body, encoding) = await pluginmaster_snapshots.get_body(r, plugin_namespace, snapshot, encoding)
+    etag = f'"{snapshot["etag"]}"' if encoding == 'identity' else f'"{snapshot["etag"]}.{encoding}"'
+    headers = {
+        'Vary': 'Accept-Encoding',
+        'X-PluginMaster-Version': snapshot['version'],
+        'ETag': etag,
+        **surrogate_key_headers(get_pluginmaster_tag(plugin_namespace)),
+    }
+    if etag_matches(request.headers.get('if-none-match'), etag):
+        return Response(status_code=304, headers=headers)
+    if encoding != 'identity':
+        headers['Content-Encoding'] = encoding
+    return Response(content=body, media_type='application/json', headers=headers)
+
+
+@router.get("/PluginMaster/Delta", response_class=PrettyJSONResponse)
+async def pluginmaster_delta(
+        background_tasks: BackgroundTasks,
+        since: str = Query(),
+        apiLevel: int = 0,
+        settings: Settings = Depends(get_settings),
+        r: AsyncRedis = Depends(get_redis)
+):
+    if not apiLevel:
+        apiLevel = settings.plugin_api_level
+    apilevel_namespace_map = get_apilevel_namespace_map()
+    if apiLevel not in apilevel_namespace_map:
+        raise HTTPException(status_code=400, detail="API level not supported")
+    plugin_namespace = apilevel_namespace_map[apiLevel]
+    snapshot = await get_pluginmaster_snapshot(background_tasks, r, plugin_namespace)
+    body = await pluginmaster_snapshots.get_delta(r, plugin_namespace, snapshot, since)
+    return Response(content=body, media_type='application/json', headers={
+        'X-PluginMaster-Version': snapshot['version'],
+        **surrogate_key_headers(get_pluginmaster_tag(plugin_namespace)),
+    })
 
 
 @router.get("/CoreChangelog")
-async def core_changelog(settings: Settings = Depends(get_settings)):
-    r = Redis.create_client()
-    changelog_str = r.hget(f'{settings.redis_prefix}dalamud', 'changelog')
-    if not changelog_str:
-        return []
-    changelog = json.loads(changelog_str)
-    return changelog
+async def core_changelog(request: Request, r: AsyncRedis = Depends(get_redis)):
+    response = await materialized_response(request, r, 'dalamud_changelog', 'changelog')
+    return response or []
 
 
 @router.post("/ClearCache")
-async def clear_cache(background_tasks: BackgroundTasks, key: str = Query(), settings: Settings = Depends(get_settings)):
+async def clear_cache(key: str = Query(), settings: Settings = Depends(get_settings),
+                      r: AsyncRedis = Depends(get_redis)):
     if key != settings.cache_clear_key:
         raise HTTPException(status_code=400, detail="Cache clear key not match")
-    background_tasks.add_task(regen, ['plugin'])
-    return {'message': 'Background task was started.'}
+    job_id = await enqueue_regen(r, ['plugin'])
+    return {'message': 'Background task was queued.', 'job_id': job_id}
 
 
 # class FeedBack(BaseModel):
@@ -116,9 +145,7 @@ class FeedBack(BaseModel):
 
 
 @router.post('/Feedback')
-async def feedback(feedback: FeedBack, settings: Settings = Depends(get_settings)):
-    r = Redis.create_client()
-    r_fb = RedisFeedBack.create_client()
+async def feedback(feedback: FeedBack, settings: Settings = Depends(get_settings), r: AsyncRedis = Depends(get_redis), r_fb: AsyncRedis = Depends(get_redis_feedback)):
     reporter = feedback.reporter
     # if not re.match(r'^[a-zA-Z0-9_-]+@[a-zA-Z0-9_-]+(\.[a-zA-Z0-9_-]+)+$', email):
     #     email = ''
@@ -139,9 +166,9 @@ async def feedback(feedback: FeedBack, settings: Settings = Depends(get_settings
         'reply_log': json.dumps([]),  # 回复记录
         'create_time': time.time()
     }
-    order_id = r.incr(f'{settings.redis_prefix}feedback-order-id')  # 自增生成唯一id
-    r_fb.hincrby(f'{settings.redis_prefix}feedback-count', name)  # 记录每个插件现有的反馈数
-    r_fb.hmset(f'feedback|{dhash}|{name}|{order_id}', feedback_dict)
+    order_id = await r.incr(f'{settings.redis_prefix}feedback-order-id')  # 自增生成唯一id
+    await r_fb.hincrby(f'{settings.redis_prefix}feedback-count', name)  # 记录每个插件现有的反馈数
+    await r_fb.hset(f'feedback|{dhash}|{name}|{order_id}', mapping=feedback_dict)
     await httpx_client.post('https://xn--v9x.net/dalamud/feedback', json={'content': content, 'name': name, 'dhash': dhash, 'version': version, 'reporter': reporter})
     return {'message': 'Feedback was submitted.', 'status': 'success', 'order_id': order_id}
 
@@ -3,14 +3,17 @@
 # cython:language_level=3
 # @Time    : 2023/9/13 8:25
 # @File    : updater.py
-import json
 from typing import Union
 from app.config import Settings
+from app.utils.changes import get_resolution_tag
 from app.utils.common import get_settings
-from app.utils.redis import Redis
-from app.utils.tasks import regen
-from fastapi import APIRouter, HTTPException, Depends, Query, BackgroundTasks, Header
-from fastapi.responses import RedirectResponse,PlainTextResponse
+from app.utils.downloads import download_redirect
+from app.utils.materialized import materialized_response
+from app.utils.redis import AsyncRedis, get_redis
+from app.utils.resolution import resolution_tables
+from app.utils.jobs import enqueue_regen
+from fastapi import APIRouter, HTTPException, Depends, Query, Header, Request
+from fastapi.responses import PlainTextResponse
 from datetime import datetime, timedelta
 
 router = APIRouter()
@@ -20,45 +23,41 @@ SEMVER_REGEX = r"^(0|[1-9]\d*)\.(0|[1-9]\d*)\.(0|[1-9]\d*)(\.(0|[1-9]\d*))?(?:-(
 
 @router.get("/Release/VersionInfo")
 async def updater_version_info(
+        request: Request,
         user_agent: Union[str, None] = Header(default="Injector"),
         accept: Union[str, None] = Header(default="*/*"),
         x_updater_track: Union[str, None] = Header(default="Release"),
-        settings: Settings = Depends(get_settings)
+        r: AsyncRedis = Depends(get_redis)
 ):
-    r = Redis.create_client()
     if x_updater_track == 'Release':
         release_type = 'release'
     elif x_updater_track == 'Prerelease':
         release_type = 'prerelease'
     else:
         raise HTTPException(status_code=400, detail="Invalid track")
-    hashed_name = r.hget(f'{settings.redis_prefix}updater', f'{release_type}-asset')
-    version_dict = json.loads(r.hget(f'{settings.redis_prefix}updater', 'version'))
     # if x_xl_firststart == 'yes' or not x_xl_haveversion:
     #     r.hincrby(f'{settings.redis_prefix}xivlauncher-count', 'XLUniqueInstalls')
     # r.hincrby(f'{settings.redis_prefix}xivlauncher-count', 'XLStarts')
-    return {
-        "version": version_dict[f'{release_type}'],
-        "downloadurl": f"https://aonyx.ffxiv.wang/File/Get/{hashed_name}",
-        "changelog": 'https://aonyx.ffxiv.wang/Updater/ChangeLog',
-        "config":{
-            "SafeMode": settings.updater_safe_mode,
-        }
-    }
+    response = await materialized_response(request, r, 'updater', f'versioninfo-{release_type}')
+    if not response:
+        raise HTTPException(status_code=404, detail="Updater version not found")
+    return response
 
 @router.post("/ClearCache")
-async def clear_cache(background_tasks: BackgroundTasks, key: str = Query(), settings: Settings = Depends(get_settings)):
+async def clear_cache(key: str = Query(), settings: Settings = Depends(get_settings),
+                      r: AsyncRedis = Depends(get_redis)):
     if key != settings.cache_clear_key:
         raise HTTPException(status_code=400, detail="Cache clear key not match")
-    background_tasks.add_task(regen, ['updater'])
-    return {'message': 'Background task was started.'}
+    job_id = await enqueue_regen(r, ['updater'])
+    return {'message': 'Background task was queued.', 'job_id': job_id}
 
 
 @router.get("/Download")
-async def updater_download(settings: Settings = Depends(get_settings)):
-    r = Redis.create_client()
-    hashed_name = r.hget(f'{settings.redis_prefix}updater', 'release-asset')
-    return RedirectResponse(f"/File/Get/{hashed_name}", status_code=302)
+async def updater_download(settings: Settings = Depends(get_settings), r: AsyncRedis = Depends(get_redis)):
+    hashed_name = await resolution_tables.resolve(r, 'updater', 'release-asset')
+    if not hashed_name:
+        raise HTTPException(status_code=404, detail="Updater asset not found")
+    return download_redirect(hashed_name, get_resolution_tag('updater', 'release-asset'))
 
 
 @router.get("/ChangeLog")
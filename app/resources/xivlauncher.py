@@ -1,12 +1,16 @@
 import re
-import json
 from typing import Union
 from app.config import Settings
+from app.utils.changes import get_resolution_tag, surrogate_key_headers
 from app.utils.common import get_settings
-from app.utils.redis import Redis
-from app.utils.tasks import regen
-from fastapi import APIRouter, HTTPException, Depends, Query, BackgroundTasks
-from fastapi.responses import RedirectResponse, PlainTextResponse
+from app.utils.counter import download_counters
+from app.utils.downloads import download_redirect
+from app.utils.materialized import materialized_response
+from app.utils.redis import AsyncRedis, get_redis
+from app.utils.resolution import resolution_tables
+from app.utils.jobs import enqueue_regen
+from fastapi import APIRouter, HTTPException, Depends, Query, Request, BackgroundTasks
+from fastapi.responses import PlainTextResponse
 
 router = APIRouter()
 
@@ -14,37 +18,27 @@ SEMVER_REGEX = r"^(0|[1-9]\d*)\.(0|[1-9]\d*)\.(0|[1-9]\d*)(\.(0|[1-9]\d*))?(?:-(
 
 
 @router.get("/Meta")
-async def xivlauncher_meta(settings: Settings = Depends(get_settings)):
-    r = Redis.create_client()
-    release_meta_str = r.hget(f'{settings.redis_prefix}xivlauncher', 'release-meta')
-    release_meta = json.loads(release_meta_str) if release_meta_str else {}
-    prerelease_meta_str = r.hget(f'{settings.redis_prefix}xivlauncher', 'prerelease-meta')
-    prerelease_meta = json.loads(prerelease_meta_str) if prerelease_meta_str else {}
-    total_downloads = r.hget(f'{settings.redis_prefix}xivlauncher-count', 'XLStarts') or 0
-    unique_installs = r.hget(f'{settings.redis_prefix}xivlauncher-count', 'XLUniqueInstalls') or 0
-    version_info = {
-        'totalDownloads': int(total_downloads),
-        'uniqueInstalls': int(unique_installs),
-        'releaseVersion': release_meta,
-        'prereleaseVersion': prerelease_meta,
-    }
-    return version_info
+async def xivlauncher_meta(request: Request, background_tasks: BackgroundTasks, settings: Settings = Depends(get_settings),
+                           r: AsyncRedis = Depends(get_redis)):
+    # Launch counts change all the time, they are rebuilt into the response every few seconds
+    response = await materialized_response(request, r, 'xivlauncher', 'meta', background_tasks,
+                                           settings.xivlauncher_meta_refresh_interval)
+    return response or {}
 
 
 @router.get("/Update/{track_file:path}")
-async def xivlauncher(track_file: str, localVersion: Union[str, None] = None, settings: Settings = Depends(get_settings)):
+async def xivlauncher(track_file: str, localVersion: Union[str, None] = None, settings: Settings = Depends(get_settings), r: AsyncRedis = Depends(get_redis)):
     if len(track_file.split('/')) != 2:
         return HTTPException(status_code=400, detail="Invalid path")
     track, file = track_file.split('/')
-    r = Redis.create_client()
     if localVersion:
         if not re.match(SEMVER_REGEX, localVersion):
             raise HTTPException(status_code=400, detail="Invalid local version")
         if (file == "RELEASES"):
-            r.hincrby(f'{settings.redis_prefix}xivlauncher-count', 'XLStarts')
+            download_counters.incr(f'{settings.redis_prefix}xivlauncher-count', 'XLStarts')
     else:
         if (file == "RELEASES"):
-            r.hincrby(f'{settings.redis_prefix}xivlauncher-count', 'XLUniqueInstalls')
+            download_counters.incr(f'{settings.redis_prefix}xivlauncher-count', 'XLUniqueInstalls')
     if track == 'Release':
         release_type = 'release'
     elif track == 'Prerelease':
@@ -53,9 +47,11 @@ async def xivlauncher(track_file: str, localVersion: Union[str, None] = None, se
         raise HTTPException(status_code=400, detail="Invalid track")
 
     if file == 'RELEASES':
-        releases_list = r.hget(f'{settings.redis_prefix}xivlauncher', f'{release_type}-releaseslist')
-        return PlainTextResponse(releases_list)
-    tag_name = r.hget(f'{settings.redis_prefix}xivlauncher', f'{release_type}-tag')
+        releases_list = await resolution_tables.resolve(r, 'xivlauncher', f'{release_type}-releaseslist')
+        return PlainTextResponse(releases_list, headers=surrogate_key_headers(
+            get_resolution_tag('xivlauncher', f'{release_type}-releaseslist')
+        ))
+    tag_name = await resolution_tables.resolve(r, 'xivlauncher', f'{release_type}-tag')
 
     valid_files = [
         'Setup.exe',
@@ -65,26 +61,26 @@ async def xivlauncher(track_file: str, localVersion: Union[str, None] = None, se
         f'XIVLauncher-{tag_name}-full.nupkg',
         'CHANGELOG.txt'
     ]
-    hashed_name = r.hget(f'{settings.redis_prefix}xivlauncher', f'{release_type}-{file}')
-    if file not in valid_files or not hashed_name:
+    if file not in valid_files:
         raise HTTPException(status_code=400, detail="Invalid file name")
-    return RedirectResponse(f"/File/Get/{hashed_name}", status_code=302)
+    hashed_name = await resolution_tables.resolve(r, 'xivlauncher', f'{release_type}-{file}')
+    if not hashed_name:
+        raise HTTPException(status_code=400, detail="Invalid file name")
+    return download_redirect(hashed_name, get_resolution_tag('xivlauncher', f'{release_type}-{file}'))
 
 
 @router.get("/XLAssets/integrity/{ff_client_version}.json")
-async def xivlauncher_assets(ff_client_version: str, settings: Settings = Depends(get_settings)):
-    r = Redis.create_client()
-    assets_version = r.hget(f'{settings.redis_prefix}xlassets', 'version')
-    if ff_client_version == assets_version:
-        result = r.hget(f'{settings.redis_prefix}xlassets', 'json')
-        return json.loads(result)
-    else:
+async def xivlauncher_assets(request: Request, ff_client_version: str, r: AsyncRedis = Depends(get_redis)):
+    response = await materialized_response(request, r, 'xlassets', f'integrity-{ff_client_version}')
+    if not response:
         raise HTTPException(status_code=404, detail="XLAssets not found")
+    return response
 
 
 @router.post("/ClearCache")
-async def clear_cache(background_tasks: BackgroundTasks, key: str = Query(), settings: Settings = Depends(get_settings)):
+async def clear_cache(key: str = Query(), settings: Settings = Depends(get_settings),
+                      r: AsyncRedis = Depends(get_redis)):
     if key != settings.cache_clear_key:
         raise HTTPException(status_code=400, detail="Cache clear key not match")
-    background_tasks.add_task(regen, ['xivlauncher', 'xlassets'])
-    return {'message': 'Background task was started.'}
+    job_id = await enqueue_regen(r, ['xivlauncher', 'xlassets'])
+    return {'message': 'Background task was queued.', 'job_id': job_id}
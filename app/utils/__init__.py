@@ -1,3 +1,5 @@
 import httpx
 
-httpx_client = httpx.AsyncClient()  # 初始化一个异步的httpx客户端，方便后续使用。
+from .tracing import TracedTransport
+
+httpx_client = httpx.AsyncClient(transport=TracedTransport())  # 初始化一个异步的httpx客户端，方便后续使用。
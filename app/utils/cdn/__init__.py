@@ -1,14 +1,87 @@
 import abc
+import random
+import time
 import traceback
+from functools import cache
 from typing import Union, List
 
+import requests
+from requests.adapters import HTTPAdapter
+
 from logs import logger
+from ..changes import ChangeSet
 from ..common import get_settings
+from ..tracing import span, strip_query
+
+# API responses worth another try
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def chunked(items: list, size: int):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def get_api_base(host: str) -> str:
+    """`host` as a base URL, https unless it has a scheme already, e.g. a local stand-in server."""
+    host = host.rstrip('/')
+    return host if '://' in host else f'https://{host}'
+
+
+@cache
+def get_session(name: str) -> requests.Session:
+    """A pooled session per provider, shared by every client of the process."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
 
 class CDN(metaclass=abc.ABCMeta):
     name = 'Unknown'
     config = get_settings()
-    
+    supports_tags = False  # purge by surrogate key
+    supports_prefetch = False
+    # Most keys a single purge or prefetch request takes
+    max_urls = 1000
+    max_prefixes = 50
+    max_tags = 30
+    max_prefetch_urls = 50
+    # Counted over the lifetime of the client
+    request_count = 0
+    retry_count = 0
+
+    @property
+    def session(self) -> requests.Session:
+        return get_session(self.name)
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """Send an API request, retried after connection errors, 429 and 5xx with jittered exponential backoff."""
+        retries = self.config.cdn_retries
+        kwargs.setdefault('timeout', self.config.cdn_timeout)
+        with span(f'{self.name} {method}', kind='client', **{'http.method': method, 'http.url': strip_query(url)}) as current:
+            for attempt in range(retries + 1):
+                self.request_count += 1
+                retry_after = 0
+                try:
+                    response = self.session.request(method, url, **kwargs)
+                    if response.status_code not in RETRY_STATUS_CODES or attempt == retries:
+                        if current is not None:
+                            current.attributes.update({'http.status_code': response.status_code, 'retries': attempt})
+                        return response
+                    error = f'HTTP {response.status_code}'
+                    if response.headers.get('Retry-After', '').isdigit():
+                        retry_after = int(response.headers['Retry-After'])
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    if attempt == retries:
+                        raise
+                    error = e
+                delay = max(retry_after, random.uniform(0, self.config.cdn_retry_backoff * 2 ** attempt))
+                logger.warning(f"{self} API request to {url} failed ({error}), retrying in {delay:.2f}s.")
+                self.retry_count += 1
+                time.sleep(delay)
+
     def path_to_url(self, path):
         if not path:
             raise RuntimeError(f'Path cannot be null.')
@@ -25,16 +98,72 @@ class CDN(metaclass=abc.ABCMeta):
         ]
         logger.info(f"Purging urls of {self}: {url_list}")
         try:
-            self.purge_urls(url_list)
+            for chunk in chunked(url_list, self.max_urls):
+                self.purge_urls(chunk)
         except Exception as e:
             traceback.print_exc()
             logger.error("Purging failed.")
             raise e
         logger.info("Purging finished.")
 
+    def purge_changes(self, change_set: ChangeSet) -> dict:
+        """Purge what a regen changed, by surrogate key where the CDN can and by URL otherwise.
+
+        Returns the seconds taken and the API requests sent, retries included.
+        """
+        start = time.perf_counter()
+        (request_count, retry_count) = (self.request_count, self.retry_count)
+        paths = set(change_set.urls)
+        if self.supports_tags and self.config.cdn_tag_purge:
+            if change_set.routes:
+                tags = sorted(change_set.routes)
+                logger.info(f"Purging tags of {self}: {tags}")
+                for chunk in chunked(tags, self.max_tags):
+                    self.purge_tags(chunk)
+        else:
+            paths = change_set.get_paths()
+        urls = sorted(x for x in paths if not x.endswith('*'))
+        if urls:
+            self.purge(urls)
+        prefixes = sorted(self.path_to_url(x[:-1]) for x in paths if x.endswith('*'))
+        if prefixes:
+            logger.info(f"Purging prefixes of {self}: {prefixes}")
+            for chunk in chunked(prefixes, self.max_prefixes):
+                self.purge_prefixes(chunk)
+        return {
+            'seconds': time.perf_counter() - start,
+            'requests': self.request_count - request_count,
+            'retries': self.retry_count - retry_count,
+        }
+
+    def warm(self, paths: List[str]) -> dict:
+        """Prefetch paths after a purge, so that the origin sees a trickle instead of every client at once.
+
+        Sent in batches of the provider limit, at most `cdn_warmup_rate` batches a second.
+        """
+        start = time.perf_counter()
+        request_count = self.request_count
+        urls = [self.path_to_url(x) for x in paths]
+        logger.info(f"Prefetching urls of {self}: {urls}")
+        for (i, chunk) in enumerate(chunked(urls, self.max_prefetch_urls)):
+            if i:
+                time.sleep(1 / self.config.cdn_warmup_rate)
+            self.prefetch_urls(chunk)
+        return {'seconds': time.perf_counter() - start, 'requests': self.request_count - request_count}
+
     @abc.abstractmethod
     def purge_urls(self, url: List[str]):
         raise NotImplementedError
 
+    def purge_tags(self, tags: List[str]):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def purge_prefixes(self, urls: List[str]):
+        raise NotImplementedError
+
+    def prefetch_urls(self, urls: List[str]):
+        raise NotImplementedError
+
     def __str__(self):
         return f'{self.name}'
@@ -1,12 +1,25 @@
-import CloudFlare
-from . import CDN
+import threading
+import time
 from typing import List
 
+from . import CDN
+
+# Seconds a looked up zone id is used before it is looked up again
+ZONE_ID_TTL = 3600
+
+
 class CloudFlareCDN(CDN):
+    supports_tags = True
+    # Limits of a purge request on the Free to Business plans
+    max_urls = 30
+    max_prefixes = 30
+    max_tags = 30
+    _zone_ids = {}  # host name -> (zone id, expiry), shared by the clients of the process
+    _zone_lock = threading.Lock()
+
     def __init__(self):
         self.name = 'CloudFlare'
-        self.cf = CloudFlare.CloudFlare(token=self.config.cf_token)
-        self.client = self.cf
+        self.api_base = self.config.cf_api_base.rstrip('/')
 
 
     @staticmethod
@@ -19,20 +32,43 @@ class CloudFlareCDN(CDN):
         host_name = host_name.split('/')[0]
         return host_name
 
-    
+    def _api(self, method: str, path: str, **kwargs):
+        headers = {'Authorization': f'Bearer {self.config.cf_token}'}
+        response = self.request(method, f'{self.api_base}{path}', headers=headers, **kwargs)
+        try:
+            body = response.json()
+        except ValueError:
+            raise RuntimeError(f'CloudFlare API returned HTTP {response.status_code}: {response.text[:200]}')
+        if not body.get('success'):
+            raise RuntimeError(f"CloudFlare API failed: {body.get('errors')}")
+        return body['result']
+
     def get_zone_id(self, url: str):
         if self.config.cf_zone_id:
             return self.config.cf_zone_id
         host_name = CloudFlareCDN.get_host_name(url)
-        zones = self.client.zones.get(params = {'per_page':100})
-        if not zones:
-            raise RuntimeError('Cannot get zones.')
-        for zone in zones:
-            if zone['name'] in host_name:
-                return zone['id']
+        with self._zone_lock:
+            cached = self._zone_ids.get(host_name)
+            if cached and cached[1] > time.monotonic():
+                return cached[0]
+            zones = self._api('GET', '/zones', params={'per_page': 100})
+            if not zones:
+                raise RuntimeError('Cannot get zones.')
+            for zone in zones:
+                if zone['name'] in host_name:
+                    self._zone_ids[host_name] = (zone['id'], time.monotonic() + ZONE_ID_TTL)
+                    return zone['id']
         raise RuntimeError(f'Cannot get zone name for \"{host_name}\".')
 
+    def _purge_cache(self, url: str, data: dict):
+        self._api('POST', f'/zones/{self.get_zone_id(url)}/purge_cache', json=data)
 
     def purge_urls(self, urls: List[str]):
-        zone_id = self.get_zone_id(urls[0])
-        self.client.zones.purge_cache.post(zone_id, data={'files':urls})
+        self._purge_cache(urls[0], {'files': urls})
+
+    def purge_tags(self, tags: List[str]):
+        self._purge_cache(self.config.hosted_url, {'tags': tags})
+
+    def purge_prefixes(self, urls: List[str]):
+        # Prefixes are given without the scheme
+        self._purge_cache(urls[0], {'prefixes': [url.split('://', 1)[-1] for url in urls]})
@@ -2,18 +2,30 @@ import base64
 import hashlib
 import hmac
 import json
+import re
 import time
-import requests
 from typing import List
-from . import CDN
+from urllib.parse import urlsplit
+from . import CDN, get_api_base
+
+def get_prefix_regex(url: str) -> str:
+    """A regex refresh value for the URLs starting with `url`, the domain is left as it is."""
+    parts = urlsplit(url)
+    return f'{parts.scheme}://{parts.netloc}{re.escape(parts.path)}.*'
+
 
 class CTCDN(CDN):
+    supports_prefetch = True
+    max_urls = 1000
+    max_prefixes = 50  # regex rules
+    max_prefetch_urls = 50
+
     def __init__(self):
         self.name = 'CTCDN'
         self.ak = self.config.ctcdn_ak
         self.sk = self.config.ctcdn_sk
         self.ac = 'app'
-        self.api_root = 'open.ctcdn.cn'
+        self.api_root = get_api_base(self.config.ctcdn_api_host)
 
     @staticmethod
     def get_zone_name(url: str):
@@ -26,8 +38,22 @@ class CTCDN(CDN):
         return zone_name
 
 
+    @staticmethod
+    def _check(result: tuple):
+        (msg, level) = result
+        if level == 'error':
+            raise RuntimeError(f'CTCDN API failed: {msg}')
+
     def purge_urls(self, urls: List[str]):
-        self.refresh(1, urls)
+        self._check(self.refresh(1, urls))
+
+    def purge_prefixes(self, urls: List[str]):
+        # A directory refresh would purge every sibling of the prefix, e.g. all of /Plugin/Download/,
+        # so each prefix is refreshed as a regex matching only the URLs that start with it
+        self._check(self.refresh(3, [get_prefix_regex(url) for url in urls]))
+
+    def prefetch_urls(self, urls: List[str]):
+        self._check(self.preload(urls))
 
 
     def _encode(self, key, content):
@@ -67,8 +93,8 @@ class CTCDN(CDN):
             "x-alogic-signature": signature,
             "x-alogic-ac": self.ac
         }
-        url = "https://{}{}".format(self.api_root, path)
-        response = requests.get(url, headers=headers, verify=False)
+        url = "{}{}".format(self.api_root, path)
+        response = self.request('GET', url, headers=headers)
         msg = response.json()["message"]
         if msg == 'success':
             return (msg, 'info')
@@ -95,9 +121,8 @@ class CTCDN(CDN):
             "x-alogic-signature": signature,
             "x-alogic-ac": self.ac
         }
-        url = "https://{}{}".format(self.api_root, path)
-        response = requests.post(url, data=json.dumps(
-            params), headers=headers, verify=False)
+        url = "{}{}".format(self.api_root, path)
+        response = self.request('POST', url, data=json.dumps(params), headers=headers)
         msg = response.json()["message"]
         if msg == 'success':
             return (msg, 'message')
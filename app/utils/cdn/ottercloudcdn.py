@@ -4,15 +4,24 @@
 # @Time    : 2023/6/7 15:38
 # @File    : ottercloudcdn.py
 
-import requests
+import threading
+import time
 
-from . import CDN
+from . import CDN, get_api_base
+
+# Seconds before its expiry an access token is replaced
+TOKEN_EXPIRY_MARGIN = 60
 
 
 class OtterCloudCDN(CDN):
+    supports_prefetch = True
+    max_prefetch_urls = 1000
+    _tokens = {}  # (host, access key id) -> (token, expiry), shared by the clients of the process
+    _token_lock = threading.Lock()
+
     def __init__(self):
         self.name = 'OtterCloudCDN'
-        self.cdn_host = self.config.ottercloud_cdn_host
+        self.cdn_host = get_api_base(self.config.ottercloud_cdn_host)
         self.id = self.config.ottercloud_cdn_id
         self.key = self.config.ottercloud_cdn_key
 
@@ -26,24 +35,37 @@ class OtterCloudCDN(CDN):
         host_name = host_name.split('/')[0]
         return host_name
 
-    def _get_token(self):
-        url = f'https://{self.cdn_host}/APIAccessTokenService/getAPIAccessToken'
-        data = {
-            "type": "user",
-            "accessKeyId": self.id,
-            "accessKey": self.key
-        }
-        response = requests.post(url, json=data)
-        if response.status_code != 200:
-            raise RuntimeError(f'Cannot get token. {response.text}')
-        return response.json()['data']['token']
+    def _get_token(self, renew: bool = False):
+        """An access token, reused until shortly before it expires."""
+        cache_key = (self.cdn_host, self.id)
+        with self._token_lock:
+            cached = self._tokens.get(cache_key)
+            if cached and not renew and cached[1] > time.time():
+                return cached[0]
+            url = f'{self.cdn_host}/APIAccessTokenService/getAPIAccessToken'
+            data = {
+                "type": "user",
+                "accessKeyId": self.id,
+                "accessKey": self.key
+            }
+            response = self.request('POST', url, json=data)
+            if response.status_code != 200:
+                raise RuntimeError(f'Cannot get token. {response.text}')
+            token_data = response.json()['data']
+            expires_at = token_data.get('expiresAt') or time.time() + 3600
+            self._tokens[cache_key] = (token_data['token'], expires_at - TOKEN_EXPIRY_MARGIN)
+            return token_data['token']
 
-    def _do_get(self, api_path):
-        headers = {
-            'X-Edge-Access-Token': self._get_token()
-        }
-        url = "https://{}{}".format(self.cdn_host, api_path)
-        response = requests.get(url, headers=headers, verify=False)
+    def _do_request(self, method: str, api_path: str, **kwargs):
+        url = "{}{}".format(self.cdn_host, api_path)
+        response = None
+        for renew in (False, True):
+            headers = {
+                'X-Edge-Access-Token': self._get_token(renew=renew)
+            }
+            response = self.request(method, url, headers=headers, **kwargs)
+            if response.status_code != 401 and response.json()['code'] != 401:
+                break  # a token revoked before its expiry is renewed once
         status_code = response.json()['code']
         msg = response.json()['message']
         if status_code == 200:
@@ -51,18 +73,11 @@ class OtterCloudCDN(CDN):
         else:
             return (msg, 'error')
 
+    def _do_get(self, api_path):
+        return self._do_request('GET', api_path)
+
     def _do_post(self, api_path, params: dict):
-        headers = {
-            'X-Edge-Access-Token': self._get_token()
-        }
-        url = "https://{}{}".format(self.cdn_host, api_path)
-        response = requests.post(url, headers=headers, json=params, verify=False)
-        status_code = response.json()['code']
-        msg = response.json()['message']
-        if status_code == 200:
-            return (msg, 'info')
-        else:
-            return (msg, 'error')
+        return self._do_request('POST', api_path, json=params)
 
     def refresh(self, type: int, urls: list):
         """刷新任务创建
@@ -104,5 +119,17 @@ class OtterCloudCDN(CDN):
         }
         return self._do_post(path, params)
 
+    @staticmethod
+    def _check(result: tuple):
+        (msg, level) = result
+        if level == 'error':
+            raise RuntimeError(f'OtterCloudCDN API failed: {msg}')
+
     def purge_urls(self, urls: list[str]):
-        self.refresh(1, urls)
+        self._check(self.refresh(1, urls))
+
+    def purge_prefixes(self, urls: list[str]):
+        self._check(self.refresh(2, urls))
+
+    def prefetch_urls(self, urls: list[str]):
+        self._check(self.prefetch(1, urls))
@@ -0,0 +1,118 @@
+from .common import get_settings
+
+# Resolution tables that are not plugin namespaces
+DOWNLOAD_TABLES = ('runtime', 'xivlauncher', 'updater')
+RUNTIME_KINDS = {
+    'desktop': 'WindowsDesktop',
+    'dotnet': 'DotNet',
+    'hashes': 'Hashes',
+}
+
+
+class ChangeSet:
+    """What a regen changed, so that only those responses are purged from the CDNs.
+
+    Responses carry surrogate keys (`Cache-Tag` / `Surrogate-Key`); `routes` maps each changed key to
+    the paths of its responses, for CDNs that purge by URL. A path ending with `*` is a prefix.
+    """
+
+    def __init__(self):
+        self.routes = {}  # surrogate key -> paths
+        self.urls = set()  # URLs without a surrogate key, e.g. files on S3
+        self.files = set()  # hashed names of newly published files
+        self.plugins = set()  # plugins whose entry or download changed
+
+    def add_route(self, tag: str, paths):
+        self.routes.setdefault(tag, set()).update(paths)
+
+    def update(self, other: 'ChangeSet'):
+        for (tag, paths) in other.routes.items():
+            self.add_route(tag, paths)
+        self.urls |= other.urls
+        self.files |= other.files
+        self.plugins |= other.plugins
+
+    def get_paths(self) -> set[str]:
+        paths = set(self.urls)
+        for route_paths in self.routes.values():
+            paths |= route_paths
+        return paths
+
+    def __bool__(self):
+        return bool(self.routes or self.urls)
+
+    def __str__(self):
+        return f'{len(self.routes)} keys, {len(self.urls)} urls, {len(self.files)} files, {len(self.plugins)} plugins'
+
+
+def surrogate_key_headers(*tags: str) -> dict:
+    """Cloudflare reads Cache-Tag, Fastly and most others Surrogate-Key."""
+    return {'Cache-Tag': ','.join(tags), 'Surrogate-Key': ' '.join(tags)}
+
+
+def get_response_tag(group: str, item: str) -> str:
+    return f'{group}:{item}'
+
+
+def get_response_paths(group: str, item: str) -> list[str]:
+    """Paths serving a materialized response item."""
+    if group == 'asset':
+        return ['/Dalamud/Asset/Meta']
+    if group == 'dalamud':
+        if item == 'meta':
+            return ['/Dalamud/Release/Meta']
+        track = item.removeprefix('versioninfo-')
+        paths = [f'/Dalamud/Release/VersionInfo?track={track}']
+        if track == 'release':
+            paths.append('/Dalamud/Release/VersionInfo')
+        if track == 'stg':
+            paths.append('/Dalamud/Release/VersionInfo?track=staging')
+        return paths
+    if group == 'dalamud_changelog':
+        return ['/Plugin/CoreChangelog']
+    if group == 'xivlauncher':
+        return ['/Proxy/Meta']
+    if group == 'xlassets':
+        return [f"/Proxy/XLAssets/integrity/{item.removeprefix('integrity-')}.json"]
+    if group == 'updater':
+        return ['/Updater/Release/VersionInfo']
+    return []
+
+
+def get_pluginmaster_tag(plugin_namespace: str) -> str:
+    return f'pluginmaster:{plugin_namespace}'
+
+
+def get_pluginmaster_paths(plugin_namespace: str) -> list[str]:
+    settings = get_settings()
+    paths = ['/Plugin/PluginMaster/Delta*']
+    for (api_level, namespace) in settings.api_namespace.items():
+        if namespace == plugin_namespace:
+            paths.append(f'/Plugin/PluginMaster?apiLevel={api_level}')
+            if api_level == settings.plugin_api_level:
+                paths.append('/Plugin/PluginMaster')
+    return paths
+
+
+def get_resolution_tag(table: str, field: str) -> str:
+    if table in DOWNLOAD_TABLES:
+        return f'{table}:{field}'
+    return f"plugin:{field.removesuffix('-testing')}"  # a plugin namespace
+
+
+def get_resolution_paths(table: str, field: str) -> list[str]:
+    """Paths redirecting to the file of a resolution table field, empty for fields that are not files."""
+    if table == 'runtime':
+        (kind, _, version) = field.partition('-')
+        return [f'/Dalamud/Release/Runtime/{RUNTIME_KINDS[kind]}/{version}'] if kind in RUNTIME_KINDS else []
+    if table == 'xivlauncher':
+        (release_type, _, name) = field.partition('-')
+        track = release_type.capitalize()
+        if name in ('tag', 'meta'):
+            return []
+        if name == 'releaseslist':
+            return [f'/Proxy/Update/{track}/RELEASES*', '/Launcher/GetLease']
+        return [f'/Proxy/Update/{track}/{name}*', f'/Launcher/GetFile/{name}']
+    if table == 'updater':
+        return ['/Updater/Download'] if field == 'release-asset' else []
+    return [f"/Plugin/Download/{field.removesuffix('-testing')}*"]
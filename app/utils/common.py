@@ -1,8 +1,6 @@
 import codecs
 import hashlib
 import os
-import re
-import shutil
 from functools import cache
 from urllib.parse import unquote, urlparse
 
@@ -51,27 +49,8 @@ def get_tos_hash():
     return tos_hash
 
 
-def cache_file(file_path: str):
-    settings = get_settings()
-    file_cache_dir = os.path.join(settings.root_path, settings.file_cache_dir)
-    if not os.path.exists(file_cache_dir):
-        os.makedirs(file_cache_dir, exist_ok=True)
-    try:
-        with open(file_path, "rb") as f:
-            bs = f.read()
-    except FileNotFoundError:
-        logger.error("File not found: " + file_path)
-        return None
-    sha256_hash = hashlib.sha256(bs).hexdigest()
-    s = re.search(r'(?P<name>[^/\\&\?]+)\.(?P<ext>\w+)', file_path)
-    hashed_name = f"{s.group('name')}.{sha256_hash}.{s.group('ext')}"
-    hashed_path = os.path.join(file_cache_dir, hashed_name)
-    logger.info(f"Caching {file_path} -> {hashed_path}")
-    shutil.copy(file_path, hashed_path)
-    return hashed_name, hashed_path
-
-
 def download_file(url, dst="", force: bool = False, filename: str = "", timeout: float = 60):
+    from .tracing import span, strip_query  # tracing reads the settings from this module
     settings = get_settings()
     file_cache_dir = os.path.join(settings.root_path, settings.file_cache_dir)
     if not dst:
@@ -87,9 +66,13 @@ def download_file(url, dst="", force: bool = False, filename: str = "", timeout:
         logger.info(f"File {filepath} exists, skipping download")
         return filepath
     logger.info(f"Downloading {url} -> {filepath}")
-    with requests.get(url, stream=True, timeout=timeout, headers=DOWNLOAD_HEADERS) as r:
+    tmp_path = f'{filepath}.{os.getpid()}.tmp'
+    with span('download', kind='client', **{'http.url': strip_query(url)}), \
+            requests.get(url, stream=True, timeout=timeout, headers=DOWNLOAD_HEADERS) as r:
         r.raise_for_status()
-        with open(filepath, 'wb') as f:
+        with open(tmp_path, 'wb') as f:
             for chunk in r.iter_content(chunk_size=8192):
                 f.write(chunk)
+    # Replace instead of rewriting in place, the content store may hold hardlinks to the old file
+    os.replace(tmp_path, filepath)
     return filepath
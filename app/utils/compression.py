@@ -0,0 +1,60 @@
+import gzip
+
+from logs import logger
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Preferred first when a client accepts several with the same weight
+ENCODING_PREFERENCE = ['br', 'zstd', 'gzip']
+
+
+def compress(body: bytes, encoding: str) -> bytes | None:
+    """Compress a body once at publish time; slow but strong levels are fine here."""
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=9, mtime=0)
+    if encoding == 'br':
+        if brotli is None:
+            logger.warning("brotli is not installed, skipping br encoding.")
+            return None
+        return brotli.compress(body, quality=9)
+    if encoding == 'zstd':
+        if zstandard is None:
+            logger.warning("zstandard is not installed, skipping zstd encoding.")
+            return None
+        return zstandard.ZstdCompressor(level=15).compress(body)
+    logger.warning(f"Unknown encoding {encoding} in pluginmaster_encodings, skipping it.")
+    return None
+
+
+def choose_encoding(accept_encoding: str, available) -> str:
+    """Pick the best of the available encodings for an Accept-Encoding header, 'identity' if none fits."""
+    weights = {}
+    for item in (accept_encoding or '').split(','):
+        (coding, _, params) = item.strip().partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[coding] = q
+    best = 'identity'
+    best_q = 0.0
+    for encoding in ENCODING_PREFERENCE:
+        if encoding not in available:
+            continue
+        q = weights.get(encoding, weights.get('*', 0.0))
+        if q > best_q:
+            (best, best_q) = (encoding, q)
+    return best
@@ -0,0 +1,116 @@
+import hashlib
+import os
+import re
+import shutil
+import sqlite3
+import threading
+from functools import cache
+
+from logs import logger
+from .common import get_settings
+from .downloads import publish_download_file
+from .tracing import span
+
+try:
+    import fcntl
+except ImportError:  # Windows has no fcntl
+    fcntl = None
+
+HASH_CHUNK_SIZE = 1024 * 1024
+FICLONE = 0x40049409  # linux/fs.h
+
+
+class ContentStore:
+    """Content-addressed copies of source files in the file cache dir.
+
+    A persistent (path, size, mtime, inode) -> sha256 index lets unchanged sources skip hashing, and a
+    hashed name that already exists is never copied again. New entries are reflinked or hardlinked when
+    the filesystem allows it, so sources must be replaced rather than rewritten in place.
+    """
+
+    def __init__(self, cache_dir: str, link_mode: str = 'auto'):
+        self.cache_dir = cache_dir
+        self.link_mode = link_mode
+        self.index_path = os.path.join(cache_dir, '.content-index.sqlite3')
+        self._local = threading.local()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _db(self) -> sqlite3.Connection:
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.index_path, timeout=30)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS files ('
+                'path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER, sha256 TEXT)'
+            )
+            self._local.db = db
+        return db
+
+    def hash_file(self, file_path: str) -> str:
+        path = os.path.abspath(file_path)
+        st = os.stat(path)
+        db = self._db()
+        row = db.execute('SELECT size, mtime_ns, inode, sha256 FROM files WHERE path = ?', (path,)).fetchone()
+        if row and row[:3] == (st.st_size, st.st_mtime_ns, st.st_ino):
+            return row[3]
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            while chunk := f.read(HASH_CHUNK_SIZE):
+                sha256.update(chunk)
+        digest = sha256.hexdigest()
+        with db:
+            db.execute(
+                'INSERT OR REPLACE INTO files (path, size, mtime_ns, inode, sha256) VALUES (?, ?, ?, ?, ?)',
+                (path, st.st_size, st.st_mtime_ns, st.st_ino, digest)
+            )
+        return digest
+
+    def add(self, file_path: str):
+        try:
+            sha256 = self.hash_file(file_path)
+        except FileNotFoundError:
+            logger.error("File not found: " + file_path)
+            return None
+        s = re.search(r'(?P<name>[^/\\&\?]+)\.(?P<ext>\w+)', file_path)
+        hashed_name = f"{s.group('name')}.{sha256}.{s.group('ext')}"
+        hashed_path = os.path.join(self.cache_dir, hashed_name)
+        if os.path.isfile(hashed_path):
+            logger.info(f"Cached {file_path} -> {hashed_path} (unchanged)")
+            return hashed_name, hashed_path
+        logger.info(f"Caching {file_path} -> {hashed_path}")
+        tmp_path = f'{hashed_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        self._link_or_copy(file_path, tmp_path)
+        os.replace(tmp_path, hashed_path)  # never expose a partially written file
+        return hashed_name, hashed_path
+
+    def _link_or_copy(self, src: str, dst: str):
+        if self.link_mode in ('auto', 'reflink') and fcntl is not None:
+            try:
+                with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                return
+            except OSError:
+                if os.path.exists(dst):
+                    os.remove(dst)
+        if self.link_mode == 'auto':
+            try:
+                os.link(src, dst)
+                return
+            except OSError:
+                pass
+        shutil.copyfile(src, dst)
+
+
+@cache
+def get_content_store() -> ContentStore:
+    settings = get_settings()
+    return ContentStore(os.path.join(settings.root_path, settings.file_cache_dir), settings.file_cache_link_mode)
+
+
+def cache_file(file_path: str):
+    with span('cache_file', path=file_path):
+        cached = get_content_store().add(file_path)
+    if cached:
+        publish_download_file(*cached)
+    return cached
@@ -0,0 +1,81 @@
+import asyncio
+from collections import defaultdict
+
+from logs import logger
+from .common import get_settings
+from .metrics import set_counter_pending
+
+
+class CounterBuffer:
+    """Write-behind buffer for the Redis download counters.
+
+    `incr` only adds to an in-process table; a background task sends the accumulated increments as
+    HINCRBY calls in one pipeline every `counter_flush_interval_ms`, or as soon as
+    `counter_flush_threshold` increments are waiting. Whatever is left is flushed on shutdown.
+    """
+
+    def __init__(self):
+        self.counts = defaultdict(int)
+        self.pending = 0  # increments not yet written to Redis
+        self.redis_client = None
+        self._flush_needed = None
+        self._task = None
+
+    def incr(self, key: str, field: str, amount: int = 1):
+        self.counts[(key, field)] += amount
+        self.pending += amount
+        set_counter_pending(self.pending)
+        if self._flush_needed and self.pending >= get_settings().counter_flush_threshold:
+            self._flush_needed.set()
+
+    async def flush(self):
+        if not self.counts:
+            return
+        (counts, pending) = (self.counts, self.pending)
+        self.counts = defaultdict(int)
+        self.pending = 0
+        set_counter_pending(0)
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            for ((key, field), amount) in counts.items():
+                pipe.hincrby(key, field, amount)
+            await pipe.execute()
+        except (Exception, asyncio.CancelledError) as e:
+            # Put them back, the next flush will retry
+            for (key_field, amount) in counts.items():
+                self.counts[key_field] += amount
+            self.pending += pending
+            set_counter_pending(self.pending)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            logger.error(f"Flushing {pending} counter increments failed: {e}")
+
+    async def _run(self):
+        interval = get_settings().counter_flush_interval_ms / 1000
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_needed.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_needed.clear()
+            await self.flush()
+
+    def start(self, redis_client):
+        self.redis_client = redis_client
+        self._flush_needed = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        if self.pending:
+            logger.error(f"{self.pending} counter increments were lost on shutdown.")
+
+
+download_counters = CounterBuffer()
@@ -0,0 +1,52 @@
+from functools import cache
+
+from botocore.exceptions import ClientError
+from fastapi.responses import RedirectResponse
+
+from .changes import surrogate_key_headers
+from .common import get_settings
+from .s3 import create_client as create_s3_client, upload_file
+
+# Object key prefix of the cached files in the download bucket
+S3_KEY_PREFIX = 'files/'
+
+
+def get_download_url(hashed_name: str) -> str:
+    """Where a client downloads a cached file from, according to `download_origin`."""
+    settings = get_settings()
+    if settings.download_origin == 'cdn' and settings.download_cdn_url:
+        return f"{settings.download_cdn_url.rstrip('/')}/{hashed_name}"
+    if settings.download_origin == 's3' and settings.xivlauncher_s3_redirect_url:
+        return f"{settings.xivlauncher_s3_redirect_url.rstrip('/')}/{S3_KEY_PREFIX}{hashed_name}"
+    return f"/File/Get/{hashed_name}"
+
+
+def download_redirect(hashed_name: str, tag: str = '') -> RedirectResponse:
+    """Redirect to a cached file, tagged with the surrogate key `tag` for purges."""
+    return RedirectResponse(get_download_url(hashed_name), status_code=302, headers=surrogate_key_headers(tag) if tag else None)
+
+
+@cache
+def get_s3_client():
+    return create_s3_client(get_settings())
+
+
+def publish_download_file(hashed_name: str, hashed_path: str):
+    """Upload a cached file to the download bucket if it is the download origin and lacks the file.
+
+    Runs before the hashed name is stored, so a redirect never points to a missing object.
+    """
+    settings = get_settings()
+    if settings.download_origin != 's3':
+        return
+    client = get_s3_client()
+    if not client or not settings.xivlauncher_s3_bucket:
+        raise RuntimeError("download_origin is s3, but the S3 config or xivlauncher_s3_bucket is empty")
+    object_key = f'{S3_KEY_PREFIX}{hashed_name}'
+    try:
+        client.head_object(Bucket=settings.xivlauncher_s3_bucket, Key=object_key)
+        return  # content-addressed, an existing object is the same file
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('404', 'NoSuchKey', 'NotFound'):
+            raise
+    upload_file(client, hashed_path, settings.xivlauncher_s3_bucket, object_key)
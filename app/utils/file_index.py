@@ -0,0 +1,167 @@
+import asyncio
+import os
+import re
+import stat
+import threading
+from collections import OrderedDict
+from typing import NamedTuple
+
+from fastapi.concurrency import run_in_threadpool
+
+from logs import logger
+from .common import get_settings
+from .invalidation import invalidation_bus
+
+try:
+    import watchfiles
+except ImportError:
+    watchfiles = None
+
+FILENAME_REGEX = r"(?P<name>.*?)\.(?P<hash>.{64})\.(?P<ext>.*)"
+FILENAME_RE = re.compile(FILENAME_REGEX)
+
+
+class FileEntry(NamedTuple):
+    path: str
+    name: str  # the name without the hash, sent to clients
+    hash: str
+    stat: os.stat_result
+
+
+def get_cache_dir() -> str:
+    # Absolute, offloading servers need absolute paths
+    return os.path.abspath(os.getenv('CACHE_DIR', 'cache'))
+
+
+def parse_hashed_name(file_name: str) -> re.Match | None:
+    # Temporary files of the content store look like hashed names, they must never be served
+    if file_name.endswith('.tmp'):
+        return None
+    return FILENAME_RE.fullmatch(file_name)
+
+
+class FileIndex:
+    """Worker-local index of the file cache dir, hashed name -> path and stat.
+
+    The dir is scanned on startup and again whenever a regen publishes new files, a watcher applies
+    single changes in between, and a name missing from the index is looked up on disk once before
+    a 404. Files up to `file_memory_max_size` bytes are also kept in memory, most recently used first,
+    up to `file_memory_cache_size` bytes in total.
+    """
+
+    def __init__(self):
+        self.cache_dir = None
+        self.entries = {}
+        self.memory = OrderedDict()  # hashed name -> content
+        self.memory_size = 0
+        self._memory_lock = threading.Lock()
+        self._task = None
+
+    def _stat_entry(self, file_name: str) -> FileEntry | None:
+        match = parse_hashed_name(file_name)
+        if not match:
+            return None
+        path = os.path.join(self.cache_dir, file_name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        return FileEntry(path, f"{match.group('name')}.{match.group('ext')}", match.group('hash'), st)
+
+    def scan(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        entries = {}
+        with os.scandir(self.cache_dir) as it:
+            for dir_entry in it:
+                match = parse_hashed_name(dir_entry.name)
+                if not match or not dir_entry.is_file():
+                    continue
+                entries[dir_entry.name] = FileEntry(
+                    dir_entry.path, f"{match.group('name')}.{match.group('ext')}", match.group('hash'), dir_entry.stat()
+                )
+        self.entries = entries
+        with self._memory_lock:
+            for file_name in [x for x in self.memory if x not in entries]:
+                self.memory_size -= len(self.memory.pop(file_name))
+        logger.info(f"Indexed {len(entries)} files in {self.cache_dir}")
+
+    def update(self, file_name: str):
+        entry = self._stat_entry(file_name)
+        if entry:
+            self.entries[file_name] = entry
+        else:
+            self.entries.pop(file_name, None)
+        with self._memory_lock:
+            if file_name in self.memory:
+                self.memory_size -= len(self.memory.pop(file_name))
+
+    async def lookup(self, file_name: str) -> FileEntry | None:
+        entry = self.entries.get(file_name)
+        if entry is None:
+            entry = await run_in_threadpool(self._stat_entry, file_name)
+            if entry:
+                self.entries[file_name] = entry
+        return entry
+
+    def _read(self, entry: FileEntry) -> bytes | None:
+        try:
+            with open(entry.path, 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    async def get_content(self, file_name: str, entry: FileEntry) -> bytes | None:
+        """The content of a small file from memory, None for files that are served from disk."""
+        settings = get_settings()
+        if entry.stat.st_size > settings.file_memory_max_size or entry.stat.st_size > settings.file_memory_cache_size:
+            return None
+        with self._memory_lock:
+            content = self.memory.get(file_name)
+            if content is not None:
+                self.memory.move_to_end(file_name)
+                return content
+        content = await run_in_threadpool(self._read, entry)
+        if content is None:
+            return None
+        with self._memory_lock:
+            if file_name not in self.memory:
+                self.memory[file_name] = content
+                self.memory_size += len(content)
+                while self.memory_size > settings.file_memory_cache_size:
+                    (_, evicted) = self.memory.popitem(last=False)
+                    self.memory_size -= len(evicted)
+        return content
+
+    async def invalidate(self, topic: str):
+        await run_in_threadpool(self.scan)
+
+    async def _watch(self):
+        try:
+            async for changes in watchfiles.awatch(self.cache_dir, recursive=False):
+                for (_, path) in changes:
+                    self.update(os.path.basename(path))
+        except Exception as e:
+            logger.error(f"Watching {self.cache_dir} failed, the file index is only refreshed after regen: {e}")
+
+    async def start(self):
+        self.cache_dir = get_cache_dir()
+        await run_in_threadpool(self.scan)
+        if watchfiles is None:
+            logger.warning("watchfiles is not installed, the file index is only refreshed after regen.")
+        elif get_settings().file_index_watch:
+            self._task = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+file_index = FileIndex()
+invalidation_bus.subscribe('files', file_index.invalidate)
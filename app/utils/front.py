@@ -2,7 +2,8 @@
 # cython:language_level=3
 
 from fastapi import Request
-from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.middleware.sessions import SessionMiddleware
+from starlette.types import ASGIApp, Receive, Scope, Send
 
 
 def flash(request: Request, category: str = "info", message: str = ""):
@@ -21,11 +22,36 @@ def get_flashed_messages(request: Request, with_categories: bool = True):
     return []
 
 
-class FlashMessageMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        if not hasattr(request, "session"):
-            raise RuntimeError("SessionMiddleware is required but not found.")
-        request.state.flashed_messages = []
-        request.state.flashed_messages.extend(get_flashed_messages(request))
-        response = await call_next(request)
-        return response
+class FlashMessageMiddleware:
+    """Moves the flashed messages of the session to `request.state.flashed_messages` for the templates."""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] == 'http':
+            if 'session' not in scope:
+                raise RuntimeError("SessionMiddleware is required but not found.")
+            scope.setdefault('state', {})['flashed_messages'] = scope['session'].pop('flash_messages', [])
+        await self.app(scope, receive, send)
+
+
+class AdminSessionMiddleware:
+    """Session and flash messages under `path_prefix` only.
+
+    Every other request, e.g. a download redirect, passes straight through without parsing or
+    signing a session cookie. The cookie is only sent back to the admin pages as well.
+    """
+
+    def __init__(self, app: ASGIApp, secret_key: str, path_prefix: str = '/admin'):
+        self.app = app
+        self.path_prefix = path_prefix.lower()
+        self.session_app = SessionMiddleware(FlashMessageMiddleware(app), secret_key=secret_key, path=path_prefix)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] == 'http':
+            path = scope['path'].lower()  # routes match case-insensitively
+            if path == self.path_prefix or path.startswith(self.path_prefix + '/'):
+                await self.session_app(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
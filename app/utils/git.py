@@ -2,6 +2,7 @@ import os
 import re
 import git
 from .common import get_settings
+from .tracing import span
 
 
 def get_git_hash(repo_path: str = '', short_sha: bool = True, check_dirty: bool = True):
@@ -45,9 +46,19 @@ def get_git_repo(git_url: str, shallow: bool = True):
 
 
 def update_git_repo(git_url: str):
-    repo = get_git_repo(git_url)
-    pull = repo.remotes.origin.pull(force=True)
+    with span('git pull', kind='client', repo=git_url):
+        repo = get_git_repo(git_url)
+        pull = repo.remotes.origin.pull(force=True)
     info = pull[0]
     assert info.flags & info.ERROR == 0, f"Error while pulling repo {git_url}"
     assert info.flags & info.REJECTED == 0, f"Rejected while pulling repo {git_url}"
     return info, repo
+
+
+def get_changed_paths(repo, old_commit: str, new_commit: str):
+    """Paths changed between two commits, or None if the old commit is not in the (shallow) clone."""
+    try:
+        diff = repo.git.diff('--name-only', '--no-renames', old_commit, new_commit)
+    except git.GitCommandError:
+        return None
+    return [x for x in diff.splitlines() if x]
@@ -0,0 +1,112 @@
+import asyncio
+import inspect
+import json
+import time
+
+from logs import logger
+from .common import get_settings
+
+
+def get_channel() -> str:
+    return f'{get_settings().redis_prefix}invalidate'
+
+
+def get_versions_key() -> str:
+    return f'{get_settings().redis_prefix}cache-versions'
+
+
+def publish_invalidation(redis_client, topic: str) -> int:
+    """Bump the version of a topic and tell every worker about it."""
+    version = redis_client.hincrby(get_versions_key(), topic, 1)
+    redis_client.publish(get_channel(), json.dumps({'topic': topic, 'version': version}))
+    return version
+
+
+class InvalidationBus:
+    """Delivers invalidation events to the local caches of a worker.
+
+    Events arrive over Redis pub/sub. Every `invalidation_check_interval` seconds, and after each
+    reconnect, the topic versions in Redis are compared with the last ones seen, so an event missed
+    while disconnected still reaches the caches.
+    """
+
+    def __init__(self):
+        self.handlers = []  # (topic prefix, handler)
+        self.versions = None  # topic -> last version seen
+        self.redis_client = None
+        self._task = None
+
+    def subscribe(self, prefix: str, handler):
+        """Call `handler(topic)` for the topic `prefix` and the topics `prefix|...`."""
+        self.handlers.append((prefix, handler))
+
+    async def dispatch(self, topic: str, version: int):
+        if self.versions is not None:
+            if version <= self.versions.get(topic, 0):
+                return
+            self.versions[topic] = version
+        for (prefix, handler) in self.handlers:
+            if topic != prefix and not topic.startswith(f'{prefix}|'):
+                continue
+            try:
+                result = handler(topic)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as e:
+                logger.error(f"Invalidation handler for {topic} failed: {e}")
+
+    async def check_versions(self):
+        versions = {topic: int(version) for (topic, version) in (await self.redis_client.hgetall(get_versions_key())).items()}
+        if self.versions is None:  # caches start empty, nothing to drop yet
+            self.versions = versions
+            return
+        for (topic, version) in versions.items():
+            await self.dispatch(topic, version)
+
+    async def _run(self):
+        interval = get_settings().invalidation_check_interval
+        pubsub = None
+        next_check = time.monotonic() + interval
+        while True:
+            try:
+                if pubsub is None:
+                    pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+                    await pubsub.subscribe(get_channel())
+                    await self.check_versions()
+                # An explicit timeout, the pool's socket timeout would break an idle listen()
+                message = await pubsub.get_message(timeout=1.0)
+                if message:
+                    event = json.loads(message['data'])
+                    await self.dispatch(event['topic'], int(event['version']))
+                if time.monotonic() >= next_check:
+                    next_check = time.monotonic() + interval
+                    await self.check_versions()
+            except asyncio.CancelledError:
+                if pubsub is not None:
+                    await pubsub.aclose()
+                raise
+            except Exception as e:
+                logger.warning(f"Invalidation bus disconnected: {e}")
+                if pubsub is not None:
+                    try:
+                        await pubsub.aclose()
+                    except Exception:
+                        pass
+                    pubsub = None
+                await asyncio.sleep(1)
+
+    def start(self, redis_client):
+        self.redis_client = redis_client
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+invalidation_bus = InvalidationBus()
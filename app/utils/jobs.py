@@ -0,0 +1,257 @@
+import concurrent.futures
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+from logs import logger
+from .common import get_settings
+from .redis import Redis
+from .tasks import regen, get_task_map
+from .tracing import get_traceparent, set_attributes, span, untraced
+
+# Tasks running the same regen function share a lock
+LOCK_GROUPS = {
+    'plugin_full': 'plugin',
+    'xl': 'xivlauncher',
+    'xivl': 'xivlauncher',
+}
+
+# Seconds a worker counts as alive after its last heartbeat, its taken jobs are queued again after that
+WORKER_HEARTBEAT_TTL = 30
+WORKER_HEARTBEAT_INTERVAL = 10
+
+# Delete a key only if it still holds the given value
+COMPARE_AND_DELETE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def get_queue_key() -> str:
+    return f'{get_settings().redis_prefix}regen-queue'
+
+
+def get_job_key(job_id: str) -> str:
+    return f'{get_settings().redis_prefix}regen-job|{job_id}'
+
+
+def get_pending_key(task: str) -> str:
+    return f'{get_settings().redis_prefix}regen-pending|{task}'
+
+
+def get_workers_key() -> str:
+    return f'{get_settings().redis_prefix}regen-workers'
+
+
+def get_processing_key(worker_id: str) -> str:
+    """Jobs a worker has taken off the queue and not finished yet."""
+    return f'{get_settings().redis_prefix}regen-processing|{worker_id}'
+
+
+def get_heartbeat_key(worker_id: str) -> str:
+    return f'{get_settings().redis_prefix}regen-worker|{worker_id}'
+
+
+def get_lock_key(task: str) -> str:
+    return f'{get_settings().redis_prefix}regen-lock|{LOCK_GROUPS.get(task, task)}'
+
+
+def is_valid_task(task: str) -> bool:
+    return task in get_task_map()
+
+
+async def enqueue_regen(redis_client, task_list: list[str]) -> str:
+    """Queue a regen job for the regen worker and return its id.
+
+    A task that already waits in a queued job is merged into that job instead of being queued
+    again; if every task is already waiting, the id of the job holding the first one is returned.
+    The job continues the trace of the request that queued it.
+    """
+    settings = get_settings()
+    job_id = uuid.uuid4().hex
+    new_tasks = []
+    pending_job_id = None
+    for task in dict.fromkeys(task_list):
+        while True:
+            if await redis_client.set(get_pending_key(task), job_id, nx=True, ex=settings.regen_pending_ttl):
+                new_tasks.append(task)
+                break
+            # The pending key may expire between SET and GET, then try again
+            existing_job_id = await redis_client.get(get_pending_key(task))
+            if existing_job_id and not await redis_client.exists(get_job_key(existing_job_id)):
+                # Left behind by a job that is gone, e.g. after a flush of the jobs
+                await redis_client.eval(COMPARE_AND_DELETE, 1, get_pending_key(task), existing_job_id)
+                continue
+            if existing_job_id:
+                pending_job_id = pending_job_id or existing_job_id
+                break
+    if not new_tasks:
+        logger.info(f"Regen tasks {task_list} merged into pending job {pending_job_id}.")
+        set_attributes(**{'regen.job_id': pending_job_id, 'regen.merged': True})
+        return pending_job_id
+    job_key = get_job_key(job_id)
+    job = {
+        'status': 'queued',
+        'tasks': json.dumps(new_tasks),
+        'created_at': int(time.time()),
+    }
+    if traceparent := get_traceparent():
+        job['traceparent'] = traceparent
+    await redis_client.hset(job_key, mapping=job)
+    await redis_client.expire(job_key, settings.regen_job_ttl)
+    await redis_client.lpush(get_queue_key(), job_id)
+    set_attributes(**{'regen.job_id': job_id})
+    logger.info(f"Queued regen job {job_id} for {new_tasks}.")
+    return job_id
+
+
+async def get_job(redis_client, job_id: str) -> dict | None:
+    job = await redis_client.hgetall(get_job_key(job_id))
+    if not job:
+        return None
+    return {
+        'job_id': job_id,
+        'status': job['status'],
+        'tasks': json.loads(job['tasks']),
+        'results': json.loads(job['results']) if 'results' in job else None,
+        'created_at': int(job['created_at']),
+        'started_at': int(job['started_at']) if 'started_at' in job else None,
+        'finished_at': int(job['finished_at']) if 'finished_at' in job else None,
+    }
+
+
+def extend_locks(locks: list, stop: threading.Event):
+    """Keep the acquired locks of a running job from expiring until `stop` is set."""
+    timeout = get_settings().regen_lock_timeout
+    while not stop.wait(timeout / 3):
+        for lock in list(locks):
+            try:
+                lock.extend(timeout, replace_ttl=True)
+            except Exception as e:
+                logger.warning(f"Extending {lock.name} failed: {e}")
+
+
+def run_regen_job(redis_client, job_id: str):
+    job_key = get_job_key(job_id)
+    (tasks_str, traceparent) = redis_client.hmget(job_key, 'tasks', 'traceparent')
+    if not tasks_str:
+        logger.error(f"Regen job {job_id} not found.")
+        return
+    task_list = json.loads(tasks_str)
+    try:
+        run_regen_tasks(redis_client, job_id, task_list, traceparent)
+    finally:
+        # Also when the job failed before it started, else its tasks would stay merged into it
+        for task in task_list:
+            redis_client.eval(COMPARE_AND_DELETE, 1, get_pending_key(task), job_id)
+
+
+def run_regen_tasks(redis_client, job_id: str, task_list: list[str], traceparent: str | None):
+    settings = get_settings()
+    job_key = get_job_key(job_id)
+    with span('regen job', traceparent=traceparent or '', sample_rate=settings.trace_regen_sample_rate,
+              **{'regen.job_id': job_id, 'tasks': ','.join(task_list)}):
+        # Sorted, so two workers never wait on each other's locks; not thread local, so
+        # extend_locks can extend them from its thread while the job runs
+        locks = [
+            redis_client.lock(lock_key, timeout=settings.regen_lock_timeout, thread_local=False)
+            for lock_key in sorted({get_lock_key(task) for task in task_list})
+        ]
+        acquired = []
+        stop = threading.Event()
+        threading.Thread(target=extend_locks, args=(acquired, stop), name=f'regen-locks-{job_id}',
+                         daemon=True).start()
+        try:
+            redis_client.hset(job_key, 'status', 'waiting')
+            with span('regen job wait'), untraced():  # not every poll of the locks
+                for lock in locks:
+                    lock.acquire()
+                    acquired.append(lock)
+            # Requests from now on need a new job, the sources may change after this point
+            for task in task_list:
+                redis_client.eval(COMPARE_AND_DELETE, 1, get_pending_key(task), job_id)
+            redis_client.hset(job_key, mapping={'status': 'running', 'started_at': int(time.time())})
+            logger.info(f"Started regen job {job_id} for {task_list}.")
+            results = regen(task_list)
+            status = 'done' if all(results.values()) else 'failed'
+        except Exception as e:
+            logger.error(f"Regen job {job_id} failed: {e}")
+            (results, status) = ({}, 'failed')
+        finally:
+            stop.set()
+            for lock in acquired:
+                try:
+                    lock.release()
+                except Exception as e:  # expired while running
+                    logger.warning(f"Releasing {lock.name} failed: {e}")
+        redis_client.hset(job_key, mapping={
+            'status': status,
+            'results': json.dumps(results),
+            'finished_at': int(time.time()),
+        })
+        redis_client.expire(job_key, settings.regen_job_ttl)
+        logger.info(f"Regen job {job_id} {status}.")
+
+
+def requeue_stale_jobs(redis_client, worker_id: str):
+    """Queue the jobs taken by workers without a heartbeat again, they died before finishing them."""
+    for other_id in redis_client.smembers(get_workers_key()):
+        if other_id == worker_id or redis_client.exists(get_heartbeat_key(other_id)):
+            continue
+        # Oldest first, to the end the queue is taken from; LMOVE moves each job once between racing workers
+        while job_id := redis_client.lmove(get_processing_key(other_id), get_queue_key(), 'RIGHT', 'RIGHT'):
+            if redis_client.exists(get_job_key(job_id)):
+                redis_client.hset(get_job_key(job_id), 'status', 'queued')
+            logger.warning(f"Requeued regen job {job_id} of the stopped worker {other_id}.")
+        redis_client.srem(get_workers_key(), other_id)
+
+
+def keep_worker_alive(redis_client, worker_id: str):
+    while True:
+        try:
+            redis_client.set(get_heartbeat_key(worker_id), int(time.time()), ex=WORKER_HEARTBEAT_TTL)
+            requeue_stale_jobs(redis_client, worker_id)
+        except Exception as e:
+            logger.warning(f"Regen worker heartbeat failed: {e}")
+        time.sleep(WORKER_HEARTBEAT_INTERVAL)
+
+
+def run_taken_job(redis_client, processing_key: str, job_id: str):
+    try:
+        run_regen_job(redis_client, job_id)
+    finally:
+        redis_client.lrem(processing_key, 1, job_id)
+
+
+def run_worker():
+    """Take jobs off the regen queue until interrupted, `regen_worker_concurrency` at a time.
+
+    A taken job stays in the processing list of this worker until it finishes, the jobs of a worker
+    that stops sending heartbeats are queued again by the others, or by the next worker that starts.
+    """
+    settings = get_settings()
+    redis_client = Redis.create_client()
+    worker_id = f'{socket.gethostname()}:{os.getpid()}'
+    processing_key = get_processing_key(worker_id)
+    redis_client.set(get_heartbeat_key(worker_id), int(time.time()), ex=WORKER_HEARTBEAT_TTL)
+    redis_client.sadd(get_workers_key(), worker_id)
+    requeue_stale_jobs(redis_client, worker_id)
+    threading.Thread(target=keep_worker_alive, args=(redis_client, worker_id), name='regen-heartbeat',
+                     daemon=True).start()
+    slots = threading.Semaphore(settings.regen_worker_concurrency)
+    logger.info(f"Regen worker {worker_id} started.")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=settings.regen_worker_concurrency) as executor:
+        while True:
+            # Only take a job when it can start, so idle workers on other nodes get the rest
+            slots.acquire()
+            job_id = redis_client.blmove(get_queue_key(), processing_key, 1, 'RIGHT', 'LEFT')
+            if not job_id:
+                slots.release()
+                continue
+            future = executor.submit(run_taken_job, redis_client, processing_key, job_id)
+            future.add_done_callback(lambda _: slots.release())
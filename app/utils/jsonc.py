@@ -0,0 +1,51 @@
+import hashlib
+import re
+import threading
+
+import commentjson
+import orjson
+
+# Strings are matched first so that comment markers and commas inside them are kept
+COMMENT_RE = re.compile(r'("(?:\\.|[^"\\])*")|//[^\n]*|/\*.*?\*/', re.S)
+TRAILING_COMMA_RE = re.compile(r'("(?:\\.|[^"\\])*")|,(?=\s*[}\]])')
+MAX_CACHED_MANIFESTS = 8192
+
+_cache = {}  # git blob sha -> canonical JSON bytes
+_cache_lock = threading.Lock()
+
+
+def git_blob_sha(data: bytes) -> str:
+    """The sha git uses for a file with this content."""
+    return hashlib.sha1(b'blob %d\0' % len(data) + data).hexdigest()
+
+
+def strip_jsonc(text: str) -> str:
+    text = COMMENT_RE.sub(lambda m: m.group(1) or '', text)
+    return TRAILING_COMMA_RE.sub(lambda m: m.group(1) or '', text)
+
+
+def loads(data: bytes):
+    """Parse JSON with comments and trailing commas, with or without a UTF-8 BOM."""
+    text = data.decode('utf-8-sig')
+    try:
+        return orjson.loads(strip_jsonc(text))
+    except orjson.JSONDecodeError:
+        return commentjson.loads(text)
+
+
+def load_file(path: str):
+    """Parse a JSONC file, reusing the result for any file with the same git blob sha.
+
+    Every call returns a fresh object, so callers may modify it.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    blob_sha = git_blob_sha(data)
+    canonical = _cache.get(blob_sha)
+    if canonical is None:
+        canonical = orjson.dumps(loads(data))
+        with _cache_lock:
+            if len(_cache) >= MAX_CACHED_MANIFESTS:
+                _cache.pop(next(iter(_cache)))
+            _cache[blob_sha] = canonical
+    return orjson.loads(canonical)
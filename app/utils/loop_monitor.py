@@ -0,0 +1,103 @@
+import asyncio
+import sys
+import threading
+import time
+import traceback
+
+from logs import logger
+from .common import get_settings
+from .metrics import get_route_label, observe_loop_block, observe_loop_lag
+
+# Innermost frames logged of a blocking stack
+STACK_LIMIT = 40
+
+
+def find_request_scope(frame) -> dict | None:
+    """The ASGI scope of the request a stack is handling, from the outermost frame that has one."""
+    scope = None
+    while frame is not None:
+        candidate = frame.f_locals.get('scope')
+        if isinstance(candidate, dict) and candidate.get('type') == 'http':
+            scope = candidate
+        frame = frame.f_back
+    return scope
+
+
+class LoopMonitor:
+    """Measures the event loop lag and reports what blocked the loop.
+
+    A task sleeps `loop_monitor_interval` seconds at a time and records how late it woke up. A
+    watchdog thread notices when that task has not run for `loop_block_threshold` seconds, takes
+    the stack of the loop thread at that moment and logs it with the route of the request once the
+    loop runs again.
+    """
+
+    def __init__(self):
+        self.beat = 0  # monotonic time the lag task last ran
+        self._loop_thread_id = None
+        self._task = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    async def _tick(self):
+        interval = get_settings().loop_monitor_interval
+        loop = asyncio.get_running_loop()
+        while True:
+            start_time = loop.time()
+            await asyncio.sleep(interval)
+            observe_loop_lag(max(0.0, loop.time() - start_time - interval))
+            self.beat = time.monotonic()
+
+    def _capture(self) -> tuple[str, str, str]:
+        """The route label, a description of the request and the stack the loop thread is running."""
+        frame = sys._current_frames().get(self._loop_thread_id)
+        if frame is None:
+            return ('background', 'background', '')
+        scope = find_request_scope(frame)
+        if scope is None:
+            route = where = 'background'
+        else:
+            route = get_route_label(scope)
+            where = f"{scope['method']} {route} ({scope['path']})"
+        return (route, where, ''.join(traceback.format_stack(frame, limit=STACK_LIMIT)))
+
+    def _watch(self):
+        settings = get_settings()
+        limit = settings.loop_monitor_interval + settings.loop_block_threshold
+        stall = None  # (beat, route, where, stack) of the current block
+        while not self._stop.wait(settings.loop_block_threshold / 4):
+            beat = self.beat
+            if stall and beat != stall[0]:  # the loop runs again
+                (stalled_beat, route, where, stack) = stall
+                seconds = beat - stalled_beat - settings.loop_monitor_interval
+                observe_loop_block(route)
+                logger.warning(f"Event loop blocked for {seconds:.3f}s by {where}:\n{stack.rstrip()}")
+                stall = None
+            if stall is None and time.monotonic() - beat > limit:
+                stall = (beat, *self._capture())
+
+    def start(self):
+        if not get_settings().loop_monitor:
+            return
+        self.beat = time.monotonic()
+        self._loop_thread_id = threading.get_ident()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._tick())
+        self._thread = threading.Thread(target=self._watch, name='loop-monitor', daemon=True)
+        self._thread.start()
+
+    async def stop(self):
+        if self._thread:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+loop_monitor = LoopMonitor()
@@ -0,0 +1,249 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+
+from fastapi import BackgroundTasks, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
+
+from logs import logger
+from .changes import ChangeSet, get_response_paths, get_response_tag, surrogate_key_headers
+from .common import get_settings
+from .invalidation import invalidation_bus, publish_invalidation
+from .redis import Redis
+from .responses import compact_json_dumps, etag_matches
+
+# Seconds a request waits for the cold publish of another worker before it gets a 503
+COLD_PUBLISH_WAIT = 10
+# Seconds the claim of a cold publish is held at most, should the worker die while publishing
+COLD_PUBLISH_TTL = 120
+
+_cold_publish_locks = {}  # claim key -> asyncio.Lock of this worker
+
+
+def get_response_key(group: str) -> str:
+    return f'{get_settings().redis_prefix}responses|{group}'
+
+
+def build_asset_responses(redis_client, settings) -> dict:
+    asset_str = redis_client.hget(f'{settings.redis_prefix}asset', 'meta')
+    return {'meta': json.loads(asset_str)} if asset_str else {}
+
+
+def build_dalamud_responses(redis_client, settings) -> dict:
+    dalamud = redis_client.hgetall(f'{settings.redis_prefix}dalamud')
+    responses = {}
+    for (field, version_str) in dalamud.items():
+        if field.startswith('dist-'):
+            responses[f"versioninfo-{field.removeprefix('dist-')}"] = json.loads(version_str)
+    responses['meta'] = {
+        track: json.loads(dalamud[f'dist-{track}'])
+        for track in ['release', 'stg', 'canary'] if dalamud.get(f'dist-{track}')
+    }
+    return responses
+
+
+def build_dalamud_changelog_responses(redis_client, settings) -> dict:
+    changelog_str = redis_client.hget(f'{settings.redis_prefix}dalamud', 'changelog')
+    return {'changelog': json.loads(changelog_str) if changelog_str else []}
+
+
+def build_xivlauncher_responses(redis_client, settings) -> dict:
+    release_meta_str = redis_client.hget(f'{settings.redis_prefix}xivlauncher', 'release-meta')
+    prerelease_meta_str = redis_client.hget(f'{settings.redis_prefix}xivlauncher', 'prerelease-meta')
+    (total_downloads, unique_installs) = redis_client.hmget(
+        f'{settings.redis_prefix}xivlauncher-count', 'XLStarts', 'XLUniqueInstalls'
+    )
+    return {'meta': {
+        'totalDownloads': int(total_downloads or 0),
+        'uniqueInstalls': int(unique_installs or 0),
+        'releaseVersion': json.loads(release_meta_str) if release_meta_str else {},
+        'prereleaseVersion': json.loads(prerelease_meta_str) if prerelease_meta_str else {},
+    }}
+
+
+def build_xlassets_responses(redis_client, settings) -> dict:
+    (assets_version, integrity_str) = redis_client.hmget(f'{settings.redis_prefix}xlassets', 'version', 'json')
+    return {f'integrity-{assets_version}': json.loads(integrity_str)} if integrity_str else {}
+
+
+def build_updater_responses(redis_client, settings) -> dict:
+    version_str = redis_client.hget(f'{settings.redis_prefix}updater', 'version')
+    if not version_str:
+        return {}
+    version_dict = json.loads(version_str)
+    responses = {}
+    for release_type in ['release', 'prerelease']:
+        hashed_name = redis_client.hget(f'{settings.redis_prefix}updater', f'{release_type}-asset')
+        responses[f'versioninfo-{release_type}'] = {
+            "version": version_dict[f'{release_type}'],
+            "downloadurl": f"https://aonyx.ffxiv.wang/File/Get/{hashed_name}",
+            "changelog": 'https://aonyx.ffxiv.wang/Updater/ChangeLog',
+            "config": {
+                "SafeMode": settings.updater_safe_mode,
+            }
+        }
+    return responses
+
+
+# Group -> builder of its responses from the data the regen task of the same name stored
+RESPONSE_BUILDERS = {
+    'asset': build_asset_responses,
+    'dalamud': build_dalamud_responses,
+    'dalamud_changelog': build_dalamud_changelog_responses,
+    'xivlauncher': build_xivlauncher_responses,
+    'xlassets': build_xlassets_responses,
+    'updater': build_updater_responses,
+}
+
+
+def read_response_etags(redis_client, group: str) -> dict:
+    response_key = get_response_key(group)
+    etag_fields = [x for x in redis_client.hkeys(response_key) if x.endswith('.etag')]
+    if not etag_fields:
+        return {}
+    return {k.removesuffix('.etag'): v for (k, v) in zip(etag_fields, redis_client.hmget(response_key, etag_fields))}
+
+
+def publish_responses(group: str, redis_client=None, change_set: ChangeSet | None = None) -> str:
+    """Serialize the responses of a group once and store the bytes with their ETags in Redis.
+
+    Items whose ETag changed are added to `change_set`.
+    """
+    if not redis_client:
+        redis_client = Redis.create_client()
+    settings = get_settings()
+    old_etags = read_response_etags(redis_client, group) if change_set is not None else {}
+    responses = RESPONSE_BUILDERS[group](redis_client, settings)
+    mapping = {}
+    for (item, content) in responses.items():
+        body = compact_json_dumps(content)
+        mapping[f'{item}.body'] = body
+        mapping[f'{item}.etag'] = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+    etags = sorted(v for (k, v) in mapping.items() if k.endswith('.etag'))
+    version = hashlib.sha256(''.join(etags).encode('utf-8')).hexdigest()[:16]
+    mapping['version'] = version
+    mapping['published_at'] = int(time.time())
+    response_key = get_response_key(group)
+    pipe = redis_client.pipeline()
+    pipe.delete(response_key)
+    pipe.hset(response_key, mapping=mapping)
+    pipe.execute()
+    publish_invalidation(redis_client, f'responses|{group}')
+    if change_set is not None:
+        etags = {item: mapping[f'{item}.etag'] for item in responses}
+        for item in old_etags.keys() | etags.keys():
+            if old_etags.get(item) != etags.get(item):
+                change_set.add_route(get_response_tag(group, item), get_response_paths(group, item))
+    logger.info(f"Published {len(responses)} {group} responses (version {version})")
+    return version
+
+
+def publish_all_responses(redis_client=None):
+    if not redis_client:
+        redis_client = Redis.create_client()
+    for group in RESPONSE_BUILDERS:
+        publish_responses(group, redis_client)
+
+
+class MaterializedResponseCache:
+    """Worker-local copy of the published responses.
+
+    A group is fetched again only when its version in Redis changes, which is checked on an
+    invalidation event and at most once per `response_check_interval` seconds otherwise.
+    """
+
+    def __init__(self):
+        self.groups = {}
+
+    def invalidate(self, topic: str):
+        cached = self.groups.get(topic.split('|', 1)[1])
+        if cached:
+            cached['checked_at'] = float('-inf')
+
+    async def get(self, redis_client, group: str, force: bool = False) -> dict | None:
+        settings = get_settings()
+        now = time.monotonic()
+        cached = self.groups.get(group)
+        if cached and not force and now - cached['checked_at'] < settings.response_check_interval:
+            return cached
+        response_key = get_response_key(group)
+        (version, published_at) = await redis_client.hmget(response_key, 'version', 'published_at')
+        if not version:
+            return None
+        if not cached or cached['version'] != version:
+            fields = await redis_client.hgetall(response_key)
+            if not fields:
+                return None
+            items = {}
+            for (field, value) in fields.items():
+                if field.endswith('.body'):
+                    item = field.removesuffix('.body')
+                    items[item] = (value.encode('utf-8'), fields[f'{item}.etag'])
+            cached = {'version': fields['version'], 'items': items}
+            self.groups[group] = cached
+        cached['published_at'] = int(published_at or 0)
+        cached['checked_at'] = now
+        return cached
+
+    @staticmethod
+    async def claim_refresh(redis_client, group: str, cached: dict, interval: int) -> bool:
+        """True for the one worker that should publish a group whose live counters are outdated."""
+        if interval <= 0 or time.time() - cached['published_at'] < interval:
+            return False
+        lock_key = f'{get_settings().redis_prefix}responses-lock|{group}'
+        return bool(await redis_client.set(lock_key, cached['version'], nx=True, ex=interval))
+
+
+materialized_responses = MaterializedResponseCache()
+invalidation_bus.subscribe('responses', materialized_responses.invalidate)
+
+
+async def publish_cold(redis_client, name: str, publish, get):
+    """Publish what is not published yet, e.g. right after an upgrade, once for all workers.
+
+    Requests of this worker wait on one lock, and only the worker that claims the Redis key
+    `{prefix}cold-publish|{name}` runs `publish` in the threadpool. The others poll `get` until
+    the claim is released and raise a 503 with Retry-After if that takes over `COLD_PUBLISH_WAIT`
+    seconds. Returns what `get` returns afterwards, None if the publish produced nothing.
+    """
+    claim_key = f'{get_settings().redis_prefix}cold-publish|{name}'
+    async with _cold_publish_locks.setdefault(claim_key, asyncio.Lock()):
+        cached = await get()  # published by a request that held the lock before
+        if cached:
+            return cached
+        if await redis_client.set(claim_key, os.getpid(), nx=True, ex=COLD_PUBLISH_TTL):
+            try:
+                await run_in_threadpool(publish)
+            finally:
+                await redis_client.delete(claim_key)
+            return await get()
+        deadline = time.monotonic() + COLD_PUBLISH_WAIT
+        while await redis_client.exists(claim_key):
+            if time.monotonic() > deadline:
+                raise HTTPException(status_code=503, detail="Publishing, try again later",
+                                    headers={'Retry-After': str(COLD_PUBLISH_WAIT)})
+            await asyncio.sleep(0.2)
+        return await get()
+
+
+async def materialized_response(request: Request, redis_client, group: str, item: str,
+                                background_tasks: BackgroundTasks | None = None,
+                                refresh_interval: int = 0) -> Response | None:
+    """The published response of an item, a 304 if the client has it already, None if there is none."""
+    cached = await materialized_responses.get(redis_client, group)
+    if not cached:  # not published yet, e.g. right after an upgrade
+        cached = await publish_cold(redis_client, f'responses|{group}', lambda: publish_responses(group),
+                                    lambda: materialized_responses.get(redis_client, group, force=True))
+        if not cached:
+            return None
+    if background_tasks and await materialized_responses.claim_refresh(redis_client, group, cached, refresh_interval):
+        background_tasks.add_task(publish_responses, group)
+    if item not in cached['items']:
+        return None
+    (body, etag) = cached['items'][item]
+    headers = {'ETag': etag, **surrogate_key_headers(get_response_tag(group, item))}
+    if etag_matches(request.headers.get('if-none-match'), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type='application/json', headers=headers)
@@ -0,0 +1,136 @@
+import gc
+import os
+import resource
+import time
+import tracemalloc
+from collections import OrderedDict
+
+from fastapi.concurrency import run_in_threadpool
+
+from .workers import worker_commands
+
+# Snapshots kept per worker, the oldest is dropped first; each costs about as much as the traces
+MAX_SNAPSHOTS = 4
+GROUP_BY = ('lineno', 'filename', 'traceback')
+# Allocations of the tracing itself
+SNAPSHOT_FILTERS = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    tracemalloc.Filter(False, '<unknown>'),
+]
+
+
+def get_rss() -> int:
+    """Resident set size in bytes, the peak where /proc is not available."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def format_stat(stat) -> dict:
+    frames = [f'{frame.filename}:{frame.lineno}' for frame in stat.traceback]
+    result = {'site': frames[0] if len(frames) == 1 else frames, 'size': stat.size, 'count': stat.count}
+    if hasattr(stat, 'size_diff'):
+        result.update(size_diff=stat.size_diff, count_diff=stat.count_diff)
+    return result
+
+
+class MemoryInspector:
+    """RSS, GC statistics and named tracemalloc snapshots of this worker.
+
+    Take a snapshot before e.g. a regen or a log analysis and diff it against the heap after it, the
+    top allocation sites by size growth come first. Tracing slows every allocation down, stop it
+    when done.
+    """
+
+    def __init__(self):
+        self.snapshots = OrderedDict()  # name -> (monotonic time, snapshot)
+
+    def stats(self) -> dict:
+        (current, peak) = tracemalloc.get_traced_memory()
+        return {
+            'pid': os.getpid(),
+            'rss': get_rss(),
+            'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            'gc': {
+                'counts': gc.get_count(),
+                'thresholds': gc.get_threshold(),
+                'generations': gc.get_stats(),
+                'objects': len(gc.get_objects()),
+                'garbage': len(gc.garbage),
+            },
+            'tracemalloc': {
+                'tracing': tracemalloc.is_tracing(),
+                'frames': tracemalloc.get_traceback_limit(),
+                'traced': current,
+                'traced_peak': peak,
+                'snapshots': list(self.snapshots),
+            },
+        }
+
+    def start(self, frames: int = 1) -> dict:
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        tracemalloc.start(frames)
+        self.snapshots.clear()
+        return self.stats()
+
+    def stop(self) -> dict:
+        tracemalloc.stop()
+        self.snapshots.clear()
+        return self.stats()
+
+    def _take(self):
+        if not tracemalloc.is_tracing():
+            raise RuntimeError("tracemalloc is not tracing, start it first")
+        return tracemalloc.take_snapshot().filter_traces(SNAPSHOT_FILTERS)
+
+    def snapshot(self, name: str) -> dict:
+        self.snapshots.pop(name, None)
+        self.snapshots[name] = (time.monotonic(), self._take())
+        while len(self.snapshots) > MAX_SNAPSHOTS:
+            self.snapshots.popitem(last=False)
+        return {'name': name, 'snapshots': list(self.snapshots), 'traced': tracemalloc.get_traced_memory()[0]}
+
+    def top(self, name: str = '', group_by: str = 'lineno', limit: int = 25) -> dict:
+        """The largest allocation sites of a snapshot, or of the heap now without a name."""
+        snapshot = self._get(name)[1] if name else self._take()
+        stats = snapshot.statistics(group_by)
+        return {
+            'total': sum(x.size for x in stats),
+            'top_by_size': [format_stat(x) for x in stats[:limit]],
+            'top_by_count': [format_stat(x) for x in sorted(stats, key=lambda x: x.count, reverse=True)[:limit]],
+        }
+
+    def diff(self, before: str, after: str = '', group_by: str = 'lineno', limit: int = 25) -> dict:
+        """Allocation sites that grew between two snapshots, `after` defaults to the heap now."""
+        (before_time, before_snapshot) = self._get(before)
+        (after_time, after_snapshot) = self._get(after) if after else (time.monotonic(), self._take())
+        stats = after_snapshot.compare_to(before_snapshot, group_by)
+        return {
+            'seconds': after_time - before_time,
+            'size_diff': sum(x.size_diff for x in stats),
+            'count_diff': sum(x.count_diff for x in stats),
+            'top_by_size': [format_stat(x) for x in stats[:limit]],
+            'top_by_count': [format_stat(x) for x in sorted(stats, key=lambda x: x.count_diff, reverse=True)[:limit]],
+        }
+
+    def _get(self, name: str) -> tuple:
+        if name not in self.snapshots:
+            raise ValueError(f"no snapshot {name!r}, this worker has {list(self.snapshots)}")
+        return self.snapshots[name]
+
+    async def command(self, action: str, **params) -> dict:
+        """Snapshots and diffs walk every trace, they run in the threadpool."""
+        if action not in ('stats', 'start', 'stop', 'snapshot', 'top', 'diff'):
+            raise ValueError(f"unknown action {action}")
+        if 'group_by' in params and params['group_by'] not in GROUP_BY:
+            raise ValueError(f"group_by must be one of {GROUP_BY}")
+        return await run_in_threadpool(getattr(self, action), **params)
+
+
+memory_inspector = MemoryInspector()
+worker_commands.register('memory', memory_inspector.command)
@@ -0,0 +1,139 @@
+import os
+import time
+from contextvars import ContextVar
+
+import redis.asyncio
+
+from logs import logger
+from .common import get_settings
+
+if get_settings().metrics_dir:
+    # Must be set before prometheus_client is imported, each process then writes its values to files in it
+    os.makedirs(get_settings().metrics_dir, exist_ok=True)
+    os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.abspath(get_settings().metrics_dir))
+
+try:
+    import prometheus_client
+    from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+    from prometheus_client import multiprocess
+except ImportError:
+    prometheus_client = None
+
+# Seconds, from a redirect served from memory to a regen
+LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+REDIS_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, 1)
+LAG_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+TASK_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600)
+
+# Redis commands of the current request, (command, seconds), labeled with its route once it is known
+redis_calls: ContextVar[list | None] = ContextVar('redis_calls', default=None)
+
+if prometheus_client:
+    http_requests = Counter('xlweb_http_requests', 'HTTP requests by route and status class',
+                            ['route', 'method', 'status'])
+    http_latency = Histogram('xlweb_http_request_duration_seconds', 'HTTP request latency by route',
+                             ['route', 'method'], buckets=LATENCY_BUCKETS)
+    redis_commands = Histogram('xlweb_redis_command_duration_seconds', 'Redis command latency by route',
+                               ['route', 'command'], buckets=REDIS_BUCKETS)
+    regen_tasks = Counter('xlweb_regen_tasks', 'Regeneration tasks by outcome', ['task', 'result'])
+    regen_latency = Histogram('xlweb_regen_task_duration_seconds', 'Regeneration task duration',
+                              ['task'], buckets=TASK_BUCKETS)
+    cdn_purges = Counter('xlweb_cdn_purges', 'CDN purges and warmups by outcome', ['cdn', 'stage', 'result'])
+    cdn_purge_latency = Histogram('xlweb_cdn_purge_duration_seconds', 'CDN purge and warmup duration',
+                                  ['cdn', 'stage'], buckets=TASK_BUCKETS)
+    cdn_requests = Counter('xlweb_cdn_api_requests', 'CDN API requests, retries included', ['cdn', 'stage'])
+    loop_lag = Histogram('xlweb_event_loop_lag_seconds', 'How late the event loop ran a timer', buckets=LAG_BUCKETS)
+    loop_blocks = Counter('xlweb_event_loop_blocks', 'Event loop blocks over loop_block_threshold by route', ['route'])
+    # Summed over the live processes, a dead worker's buffer is gone with it
+    counter_pending = Gauge('xlweb_download_counter_pending', 'Download counter increments not yet written to Redis',
+                            multiprocess_mode='livesum')
+    _children = {}  # (metric, labels) -> child, labels() takes a lock on every call
+
+
+def get_child(metric, *labels):
+    key = (metric, labels)
+    child = _children.get(key)
+    if child is None:
+        child = _children[key] = metric.labels(*labels)
+    return child
+
+
+def get_route_label(scope) -> str:
+    """The path template of the matched route, never the raw path, which would add a series per URL."""
+    route = scope.get('route')
+    return getattr(route, 'path', None) or 'other'
+
+
+class InstrumentedRedis(redis.asyncio.Redis):
+    """Times every command, attributed to the route of the request that sent it."""
+
+    async def execute_command(self, *args, **options):
+        start_time = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            seconds = time.perf_counter() - start_time
+            calls = redis_calls.get()
+            if calls is not None:
+                calls.append((args[0], seconds))
+            else:
+                get_child(redis_commands, 'background', args[0]).observe(seconds)
+
+
+def observe_regen_task(task: str, ok: bool, seconds: float):
+    if prometheus_client:
+        get_child(regen_tasks, task, 'ok' if ok else 'failed').inc()
+        get_child(regen_latency, task).observe(seconds)
+
+
+def observe_cdn_purge(cdn: str, ok: bool, seconds: float, requests: int, stage: str = 'purge'):
+    if prometheus_client:
+        get_child(cdn_purges, cdn, stage, 'ok' if ok else 'failed').inc()
+        get_child(cdn_purge_latency, cdn, stage).observe(seconds)
+        get_child(cdn_requests, cdn, stage).inc(requests)
+
+
+def set_counter_pending(pending: int):
+    if prometheus_client:
+        counter_pending.set(pending)
+
+
+def observe_loop_lag(seconds: float):
+    if prometheus_client:
+        loop_lag.observe(seconds)
+
+
+def observe_loop_block(route: str):
+    if prometheus_client:
+        get_child(loop_blocks, route).inc()
+
+
+def render_metrics() -> tuple[bytes, str] | None:
+    """The metrics of every process in the Prometheus text format, None without prometheus_client."""
+    if prometheus_client is None:
+        return None
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return (generate_latest(registry), CONTENT_TYPE_LATEST)
+
+
+def clear_metrics_dir():
+    """Remove the values of previous runs, called once before the workers start."""
+    path = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if not path or not os.path.isdir(path):
+        return
+    for name in os.listdir(path):
+        if name.endswith('.db'):
+            os.remove(os.path.join(path, name))
+
+
+def mark_process_dead(pid: int):
+    if prometheus_client and 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        multiprocess.mark_process_dead(pid)
+
+
+if prometheus_client is None:
+    logger.warning("prometheus_client is not installed, /metrics is disabled.")
@@ -0,0 +1,129 @@
+import secrets
+import time
+
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from logs import logger
+from . import metrics
+from .common import get_settings
+from .metrics import get_child, get_route_label, redis_calls
+from .profiler import Sampler, profiler, verify_profile_header
+from .tracing import span, tracer
+
+
+class MetricsMiddleware:
+    """Counts requests by route and status class and observes their latency, along with the Redis
+    commands sent while handling them.
+
+    Only wraps `send`, a streamed body is passed through as it is produced.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http' or metrics.prometheus_client is None:
+            await self.app(scope, receive, send)
+            return
+        start_time = time.perf_counter()
+        status = 500  # unless a response starts
+        calls = []
+        token = redis_calls.set(calls)
+
+        async def send_wrapper(message: Message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            redis_calls.reset(token)
+            route = get_route_label(scope)
+            method = scope['method']
+            get_child(metrics.http_requests, route, method, f'{status // 100}xx').inc()
+            get_child(metrics.http_latency, route, method).observe(time.perf_counter() - start_time)
+            for (command, seconds) in calls:
+                get_child(metrics.redis_commands, route, command).observe(seconds)
+
+
+class ProfileMiddleware:
+    """Profiles a request that carries a valid `X-Profile` header, see `sign_profile_header`.
+
+    The response gets an `X-Profile-Id` header, the stacks are at `/admin/profile/{id}` once the
+    request finished. Requests without the header only pay for a look at the header names.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http' or not get_settings().profile_key:
+            await self.app(scope, receive, send)
+            return
+        value = next((v for (k, v) in scope['headers'] if k == b'x-profile'), None)
+        if value is None or not verify_profile_header(value.decode('latin-1'), scope['path']):
+            await self.app(scope, receive, send)
+            return
+        if not profiler.acquire():  # another profile is running
+            await self.app(scope, receive, send)
+            return
+        profile_id = secrets.token_hex(8)
+        sampler = Sampler(get_settings().profile_interval, scope)
+
+        async def send_wrapper(message: Message):
+            if message['type'] == 'http.response.start':
+                MutableHeaders(scope=message).append('X-Profile-Id', profile_id)
+            await send(message)
+
+        sampler.start()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            collapsed = sampler.stop()
+            profiler.release()
+            try:
+                await profiler.store(scope['app'].state.redis, profile_id, collapsed)
+            except Exception as e:
+                logger.error(f"Storing profile {profile_id} failed: {e}")
+
+
+class TracingMiddleware:
+    """Records a server span per request, named after its route once the router matched it.
+
+    A sampled `traceparent` header continues the trace of the caller, other requests start a trace
+    `trace_sample_rate` of the time. Traced responses carry an `X-Trace-Id` header.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http' or not tracer.enabled:
+            await self.app(scope, receive, send)
+            return
+        traceparent = next((v for (k, v) in scope['headers'] if k == b'traceparent'), b'').decode('latin-1')
+        with span(scope['method'], kind='server', traceparent=traceparent,
+                  sample_rate=get_settings().trace_sample_rate) as current:
+            if current is None:
+                await self.app(scope, receive, send)
+                return
+
+            async def send_wrapper(message: Message):
+                if message['type'] == 'http.response.start':
+                    current.set_attribute('http.status_code', message['status'])
+                    MutableHeaders(scope=message).append('X-Trace-Id', current.trace_id)
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_wrapper)
+            finally:
+                route = get_route_label(scope)
+                current.name = f"{scope['method']} {route}"
+                current.attributes.update({
+                    'http.method': scope['method'],
+                    'http.route': route,
+                    'http.target': scope['path'],
+                })
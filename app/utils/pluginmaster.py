@@ -0,0 +1,234 @@
+import hashlib
+import json
+import time
+
+from redis.client import NEVER_DECODE
+
+from logs import logger
+from .changes import ChangeSet, get_pluginmaster_paths, get_pluginmaster_tag
+from .common import get_settings, get_apilevel_namespace_map
+from .compression import compress
+from .invalidation import invalidation_bus, publish_invalidation
+from .redis import Redis
+from .responses import pretty_json_dumps
+
+
+def get_snapshot_key(plugin_namespace: str) -> str:
+    return f'{get_settings().redis_prefix}pluginmaster-snapshot|{plugin_namespace}'
+
+
+def load_translations(redis_client, settings) -> dict:
+    if settings.default_pm_lang == 'en-US':
+        return {}
+    translations = {}
+    for field in ('name', 'description', 'punchline'):
+        field_str = redis_client.hget(f'{settings.redis_prefix}crowdin', f'plugin-{field}-{settings.default_pm_lang}') or '{}'
+        translations[field] = json.loads(field_str)
+    return translations
+
+
+def build_pluginmaster(redis_client, plugin_namespace: str) -> list | None:
+    """Final PluginMaster of a namespace, with download counts and the crowdin overlay applied."""
+    settings = get_settings()
+    pluginmaster_str = redis_client.hget(f'{settings.redis_prefix}{plugin_namespace}', 'pluginmaster')
+    if not pluginmaster_str:
+        return None
+    pluginmaster = json.loads(pluginmaster_str)
+    download_counts = redis_client.hgetall(f'{settings.redis_prefix}plugin-count')
+    translations = load_translations(redis_client, settings)
+    for plugin in pluginmaster:
+        plugin_name = plugin['InternalName']
+        plugin["DownloadCount"] = int(download_counts.get(plugin_name) or 0)
+        if translations:
+            for tkey, src_key, tr_field in (
+                ('NameLoc', 'Name', 'name'),
+                ('PunchlineLoc', 'Punchline', 'punchline'),
+                ('DescriptionLoc', 'Description', 'description'),
+            ):
+                translated = translations[tr_field].get(plugin_name, '')
+                original = plugin.get(src_key, '')
+                plugin[tkey] = translated if (translated and translated != original) else ''
+    return pluginmaster
+
+
+def get_plugin_hashes(pluginmaster: list) -> dict:
+    """InternalName -> content hash of each entry. Download counts are left out, they are not a change."""
+    plugin_hashes = {}
+    for plugin in pluginmaster:
+        entry = {k: v for (k, v) in plugin.items() if k != 'DownloadCount'}
+        entry_str = json.dumps(entry, sort_keys=True, ensure_ascii=True)
+        plugin_hashes[plugin['InternalName']] = hashlib.sha256(entry_str.encode('utf-8')).hexdigest()[:16]
+    return plugin_hashes
+
+
+def record_pluginmaster_version(redis_client, plugin_namespace: str, pluginmaster: list) -> tuple[str, dict]:
+    """Add the content version of a PluginMaster to the history and build the deltas from every kept version.
+
+    Returns the version and a map of `since` version -> delta body.
+    """
+    settings = get_settings()
+    history_key = f'{settings.redis_prefix}pluginmaster-history|{plugin_namespace}'
+    versions_key = f'{settings.redis_prefix}pluginmaster-versions|{plugin_namespace}'
+    plugin_hashes = get_plugin_hashes(pluginmaster)
+    version = hashlib.sha256(json.dumps(plugin_hashes, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    versions = redis_client.lrange(versions_key, 0, -1)
+    if not versions or versions[-1] != version:
+        redis_client.hset(history_key, version, json.dumps(plugin_hashes))
+        redis_client.lrem(versions_key, 0, version)
+        redis_client.rpush(versions_key, version)
+        versions = [x for x in versions if x != version] + [version]
+        limit = max(settings.pluginmaster_delta_history, 1)
+        if len(versions) > limit:
+            expired = versions[:-limit]
+            versions = versions[-limit:]
+            redis_client.ltrim(versions_key, -limit, -1)
+            redis_client.hdel(history_key, *expired)
+
+    entries = {plugin['InternalName']: plugin for plugin in pluginmaster}
+    deltas = {}
+    for (since, since_hashes_str) in zip(versions, redis_client.hmget(history_key, versions)):
+        if not since_hashes_str:
+            continue
+        since_hashes = json.loads(since_hashes_str)
+        deltas[since] = pretty_json_dumps({
+            'version': version,
+            'since': since,
+            'full': False,
+            'added': [entries[name] for name in plugin_hashes if name not in since_hashes],
+            'changed': [entries[name] for (name, plugin_hash) in plugin_hashes.items()
+                        if name in since_hashes and since_hashes[name] != plugin_hash],
+            'removed': [name for name in since_hashes if name not in plugin_hashes],
+        })
+    return version, deltas
+
+
+def publish_pluginmaster_snapshot(redis_client=None, plugin_namespace: str = '', change_set: ChangeSet | None = None) -> str | None:
+    """Serialize the PluginMaster of a namespace once and store the ready-to-send body in Redis.
+
+    A new content version is added to `change_set`; download counts alone are not a change.
+    """
+    if not redis_client:
+        redis_client = Redis.create_client()
+    pluginmaster = build_pluginmaster(redis_client, plugin_namespace)
+    if pluginmaster is None:
+        return None
+    settings = get_settings()
+    body = pretty_json_dumps(pluginmaster)
+    etag = hashlib.sha256(body).hexdigest()[:16]
+    (version, deltas) = record_pluginmaster_version(redis_client, plugin_namespace, pluginmaster)
+    mapping = {'body': body}
+    for encoding in settings.pluginmaster_encodings:
+        compressed = compress(body, encoding)
+        if compressed is not None:
+            mapping[f'body.{encoding}'] = compressed
+    encodings = [x.split('.', 1)[1] for x in mapping if x != 'body']
+    for (since, delta) in deltas.items():
+        mapping[f'delta.{since}'] = delta
+    snapshot_key = get_snapshot_key(plugin_namespace)
+    old_version = redis_client.hget(snapshot_key, 'version')
+    # Bodies first, so a worker that sees the new etag can always fetch them
+    redis_client.hset(snapshot_key, mapping=mapping)
+    redis_client.hset(snapshot_key, mapping={
+        'etag': etag,
+        'version': version,
+        'encodings': ','.join(encodings),
+        'built_at': int(time.time()),
+    })
+    expired_deltas = [x for x in redis_client.hkeys(snapshot_key) if x.startswith('delta.') and x not in mapping]
+    if expired_deltas:
+        redis_client.hdel(snapshot_key, *expired_deltas)
+    publish_invalidation(redis_client, f'pluginmaster|{plugin_namespace}')
+    if change_set is not None and old_version != version:
+        change_set.add_route(get_pluginmaster_tag(plugin_namespace), get_pluginmaster_paths(plugin_namespace))
+    logger.info(f"Published pluginmaster snapshot {etag} (version {version}) for {plugin_namespace}")
+    return etag
+
+
+def publish_pluginmaster_snapshots(redis_client=None):
+    if not redis_client:
+        redis_client = Redis.create_client()
+    for plugin_namespace in set(get_apilevel_namespace_map().values()):
+        publish_pluginmaster_snapshot(redis_client, plugin_namespace)
+
+
+class PluginMasterSnapshotCache:
+    """Worker-local copy of the published snapshots.
+
+    The body is only fetched again when the etag stored in Redis changes, which is checked on an
+    invalidation event and at most once per `pluginmaster_snapshot_check_interval` seconds otherwise.
+    Precompressed bodies and deltas are fetched on first use.
+    """
+
+    def __init__(self):
+        self.snapshots = {}
+
+    def invalidate(self, topic: str):
+        snapshot = self.snapshots.get(topic.split('|', 1)[1])
+        if snapshot:
+            snapshot['checked_at'] = float('-inf')
+
+    async def get(self, redis_client, plugin_namespace: str, force: bool = False) -> dict | None:
+        settings = get_settings()
+        now = time.monotonic()
+        snapshot = self.snapshots.get(plugin_namespace)
+        if snapshot and not force and now - snapshot['checked_at'] < settings.pluginmaster_snapshot_check_interval:
+            return snapshot
+        snapshot_key = get_snapshot_key(plugin_namespace)
+        (etag, version, encodings, built_at) = await redis_client.hmget(
+            snapshot_key, 'etag', 'version', 'encodings', 'built_at'
+        )
+        if not etag:
+            return None
+        if not snapshot or snapshot['etag'] != etag:
+            body = await self._fetch_body(redis_client, snapshot_key, 'body')
+            if not body:
+                return None
+            snapshot = {
+                'etag': etag,
+                'version': version,
+                'encodings': set(encodings.split(',')) if encodings else set(),
+                'bodies': {'identity': body},
+                'deltas': {},
+            }
+            self.snapshots[plugin_namespace] = snapshot
+        snapshot['built_at'] = int(built_at or 0)
+        snapshot['checked_at'] = now
+        return snapshot
+
+    async def get_body(self, redis_client, plugin_namespace: str, snapshot: dict, encoding: str) -> tuple[bytes, str]:
+        """Body of a snapshot in the given encoding, falling back to identity if it is not available."""
+        if encoding not in snapshot['bodies']:
+            body = None
+            if encoding in snapshot['encodings']:
+                body = await self._fetch_body(redis_client, get_snapshot_key(plugin_namespace), f'body.{encoding}')
+            if body is None:
+                return snapshot['bodies']['identity'], 'identity'
+            snapshot['bodies'][encoding] = body
+        return snapshot['bodies'][encoding], encoding
+
+    async def get_delta(self, redis_client, plugin_namespace: str, snapshot: dict, since: str) -> bytes:
+        """Changes since an older version, or a `full` signal if that version is no longer kept."""
+        if since not in snapshot['deltas']:
+            delta = await self._fetch_body(redis_client, get_snapshot_key(plugin_namespace), f'delta.{since}')
+            if delta is None:
+                return pretty_json_dumps({'version': snapshot['version'], 'since': since, 'full': True})
+            snapshot['deltas'][since] = delta
+        return snapshot['deltas'][since]
+
+    @staticmethod
+    async def _fetch_body(redis_client, snapshot_key: str, field: str) -> bytes | None:
+        return await redis_client.execute_command('HGET', snapshot_key, field, **{NEVER_DECODE: True})
+
+    @staticmethod
+    async def claim_refresh(redis_client, plugin_namespace: str, snapshot: dict) -> bool:
+        """True for the one worker that should rebuild a snapshot whose download counts are outdated."""
+        settings = get_settings()
+        interval = settings.pluginmaster_count_refresh_interval
+        if interval <= 0 or time.time() - snapshot['built_at'] < interval:
+            return False
+        lock_key = f'{settings.redis_prefix}pluginmaster-snapshot-lock|{plugin_namespace}'
+        return bool(await redis_client.set(lock_key, snapshot['etag'], nx=True, ex=interval))
+
+
+pluginmaster_snapshots = PluginMasterSnapshotCache()
+invalidation_bus.subscribe('pluginmaster', pluginmaster_snapshots.invalidate)
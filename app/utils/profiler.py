@@ -0,0 +1,139 @@
+import asyncio
+import hashlib
+import hmac
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from logs import logger
+from .common import get_settings
+from .loop_monitor import find_request_scope
+from .workers import worker_commands
+
+# Seconds a stored profile is kept for /admin/profile/{profile_id}
+PROFILE_TTL = 3600
+
+
+def get_profile_key(profile_id: str) -> str:
+    return f'{get_settings().redis_prefix}profile|{profile_id}'
+
+
+def format_frame(frame) -> str:
+    code = frame.f_code
+    path = code.co_filename.replace('\\', '/').rsplit('/', 2)
+    return f"{code.co_name} ({'/'.join(path[-2:])}:{frame.f_lineno})"
+
+
+class Sampler:
+    """Samples the stacks of the threads of this process every `interval` seconds from a thread.
+
+    The result is in the collapsed stack format of flamegraph.pl and speedscope, one line of
+    `root;caller;callee count` per stack. With a `scope`, only stacks handling that request count.
+    Functions that a sync endpoint runs in the threadpool are not part of its request then.
+    """
+
+    def __init__(self, interval: float, scope: dict | None = None):
+        self.interval = interval
+        self.scope = scope
+        self.counts = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        own_id = threading.get_ident()
+        names = {x.ident: x.name for x in threading.enumerate()}
+        for (thread_id, frame) in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            if self.scope is not None and find_request_scope(frame) is not self.scope:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(format_frame(frame))
+                frame = frame.f_back
+            stack.append(names.get(thread_id, str(thread_id)))
+            self.counts[';'.join(reversed(stack))] += 1
+        self.samples += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> str:
+        self._stop.set()
+        self._thread.join()
+        return ''.join(f'{stack} {count}\n' for (stack, count) in self.counts.most_common())
+
+
+def prefix_collapsed(collapsed: str, root: str) -> str:
+    return ''.join(f'{root};{line}\n' for line in collapsed.splitlines() if line)
+
+
+def sign_profile_header(path: str, ttl: int) -> str:
+    """An `X-Profile` header value that profiles requests to `path` for `ttl` seconds."""
+    expires = int(time.time()) + ttl
+    signature = hmac.new(get_settings().profile_key.encode(), f'{expires}:{path}'.encode(), hashlib.sha256).hexdigest()
+    return f'{expires}.{signature}'
+
+
+def verify_profile_header(value: str, path: str) -> bool:
+    key = get_settings().profile_key
+    (expires, _, signature) = value.partition('.')
+    if not key or not expires.isdigit() or int(expires) < time.time():
+        return False
+    expected = hmac.new(key.encode(), f'{expires}:{path}'.encode(), hashlib.sha256).hexdigest()
+    return hmac.compare_digest(signature, expected)
+
+
+class Profiler:
+    """Runs sampling profiles in this worker, one at a time.
+
+    The `profile` worker command profiles every worker at once, see `WorkerCommands`.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def acquire(self) -> bool:
+        return self._lock.acquire(blocking=False)
+
+    def release(self):
+        self._lock.release()
+
+    async def profile(self, seconds: float, interval: float) -> str | None:
+        """Profile this worker for `seconds`, None if a profile is running already."""
+        if not self.acquire():
+            return None
+        try:
+            sampler = Sampler(interval)
+            sampler.start()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                collapsed = sampler.stop()
+            logger.info(f"Profiled worker {os.getpid()} for {seconds}s, {sampler.samples} samples.")
+            return collapsed
+        finally:
+            self.release()
+
+    async def store(self, redis_client, profile_id: str, collapsed: str):
+        key = get_profile_key(profile_id)
+        await redis_client.hset(key, str(os.getpid()), collapsed)
+        await redis_client.expire(key, PROFILE_TTL)
+
+    async def profile_command(self, seconds: float, interval: float) -> str:
+        collapsed = await self.profile(seconds, interval)
+        if collapsed is None:
+            raise RuntimeError("a profile is running already")
+        return collapsed
+
+
+profiler = Profiler()
+worker_commands.register('profile', profiler.profile_command)
@@ -1,18 +1,86 @@
 import redis
+import redis.asyncio
+from fastapi import Request
+
 from .common import get_settings
+from .metrics import InstrumentedRedis, prometheus_client
+from .tracing import span
 from logs import logger
 
+AsyncRedis = redis.asyncio.Redis
+
+_sync_pools = {}
+
+
+def _get_sync_pool(db: int) -> redis.ConnectionPool:
+    # Shared by the threaded regen tasks, redis-py resets the pool in forked workers by itself.
+    if db not in _sync_pools:
+        settings = get_settings()
+        _sync_pools[db] = redis.BlockingConnectionPool(
+            host=settings.redis_host,
+            port=settings.redis_port,
+            db=db,
+            decode_responses=True,
+            max_connections=settings.redis_max_connections,
+            timeout=settings.redis_pool_timeout,
+            socket_timeout=settings.redis_socket_timeout,
+            socket_connect_timeout=settings.redis_socket_connect_timeout,
+        )
+    return _sync_pools[db]
+
+
+def create_async_client(db: int = 0) -> AsyncRedis:
+    settings = get_settings()
+    pool = redis.asyncio.BlockingConnectionPool(
+        host=settings.redis_host,
+        port=settings.redis_port,
+        db=db,
+        decode_responses=True,
+        max_connections=settings.redis_max_connections,
+        timeout=settings.redis_pool_timeout,
+        socket_timeout=settings.redis_socket_timeout,
+        socket_connect_timeout=settings.redis_socket_connect_timeout,
+    )
+    client_class = InstrumentedRedis if prometheus_client else redis.asyncio.Redis
+    return client_class(connection_pool=pool)
+
+
+class TracedRedis(redis.Redis):
+    """Records every command sent inside a trace as a client span, e.g. the writes of a regen."""
+
+    def execute_command(self, *args, **options):
+        # The first argument of EVAL and SCRIPT is a script, not a key
+        key = str(args[1]) if len(args) > 1 and not args[0].startswith(('EVAL', 'SCRIPT')) else ''
+        with span(f'redis {args[0]}', kind='client', **{'db.key': key}):
+            return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return TracedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+class TracedPipeline(redis.client.Pipeline):
+    def execute(self, raise_on_error=True):
+        with span('redis pipeline', kind='client', **{'db.commands': len(self.command_stack)}):
+            return super().execute(raise_on_error)
+
+
 class Redis():
     @staticmethod
     def create_client():
-        settings = get_settings()
-        return redis.Redis(host=settings.redis_host, port=settings.redis_port, db=0, decode_responses=True)
+        return TracedRedis(connection_pool=_get_sync_pool(0))
 
 class RedisFeedBack():
     @staticmethod
     def create_client():
-        settings = get_settings()
-        return redis.Redis(host=settings.redis_host, port=settings.redis_port, db=1, decode_responses=True)
+        return TracedRedis(connection_pool=_get_sync_pool(1))
+
+
+async def get_redis(request: Request) -> AsyncRedis:
+    return request.app.state.redis
+
+
+async def get_redis_feedback(request: Request) -> AsyncRedis:
+    return request.app.state.redis_feedback
 
 
 def load_plugin_count(plugin_count):
@@ -0,0 +1,102 @@
+import asyncio
+import time
+
+from .changes import DOWNLOAD_TABLES, ChangeSet, get_resolution_paths, get_resolution_tag
+from .common import get_settings
+from .file_index import parse_hashed_name
+from .invalidation import get_versions_key, invalidation_bus, publish_invalidation
+
+# Large fields of the resolved hashes that no redirect needs
+EXCLUDED_FIELDS = {'pluginmaster'}
+
+
+def get_topic(table: str) -> str:
+    return f'resolution|{table}'
+
+
+def read_resolution_table(redis_client, table: str) -> dict:
+    key = f'{get_settings().redis_prefix}{table}'
+    fields = [x for x in redis_client.hkeys(key) if x not in EXCLUDED_FIELDS]
+    return {k: v for (k, v) in zip(fields, redis_client.hmget(key, fields)) if v is not None} if fields else {}
+
+
+def publish_resolution_table(redis_client, table: str, before: dict | None = None, change_set: ChangeSet | None = None) -> int:
+    """Tell the workers that the Redis hash `{prefix}{table}` changed.
+
+    With the content from `before` the regen, the changed downloads are added to `change_set`.
+    """
+    if before is not None and change_set is not None:
+        after = read_resolution_table(redis_client, table)
+        for field in before.keys() | after.keys():
+            if before.get(field) == after.get(field):
+                continue
+            paths = get_resolution_paths(table, field)
+            if not paths:
+                continue
+            change_set.add_route(get_resolution_tag(table, field), paths)
+            if after.get(field) and parse_hashed_name(after[field]):
+                change_set.files.add(after[field])
+            if table not in DOWNLOAD_TABLES:
+                change_set.plugins.add(field.removesuffix('-testing'))
+    return publish_invalidation(redis_client, get_topic(table))
+
+
+class ResolutionTables:
+    """Worker-local copies of the Redis hashes that map download names to hashed file names.
+
+    A table is the hash `{prefix}{table}` without `EXCLUDED_FIELDS`, loaded again when the version
+    of its invalidation topic changes. That is checked on an event and at most once per
+    `resolution_check_interval` seconds otherwise. A name missing from a versioned table does not
+    exist, only a table that no publish has versioned yet is asked in Redis for it.
+    """
+
+    def __init__(self):
+        self.tables = {}  # table -> {'version', 'fields', 'checked_at'}
+        self._locks = {}
+
+    def invalidate(self, topic: str):
+        table = topic.split('|', 1)[1]
+        cached = self.tables.get(table)
+        if cached:
+            cached['checked_at'] = float('-inf')
+
+    async def _load(self, redis_client, table: str, version: str | None) -> dict:
+        key = f'{get_settings().redis_prefix}{table}'
+        fields = [x for x in await redis_client.hkeys(key) if x not in EXCLUDED_FIELDS]
+        values = await redis_client.hmget(key, fields) if fields else []
+        return {
+            'version': version,
+            'fields': {k: v for (k, v) in zip(fields, values) if v is not None},
+        }
+
+    async def get(self, redis_client, table: str) -> dict:
+        settings = get_settings()
+        now = time.monotonic()
+        cached = self.tables.get(table)
+        if cached and now - cached['checked_at'] < settings.resolution_check_interval:
+            return cached['fields']
+        lock = self._locks.setdefault(table, asyncio.Lock())
+        async with lock:
+            cached = self.tables.get(table)
+            if cached and now - cached['checked_at'] < settings.resolution_check_interval:
+                return cached['fields']
+            version = await redis_client.hget(get_versions_key(), get_topic(table))
+            if not cached or cached['version'] != version or version is None:
+                cached = await self._load(redis_client, table, version)
+                self.tables[table] = cached
+            cached['checked_at'] = time.monotonic()
+            return cached['fields']
+
+    async def resolve(self, redis_client, table: str, field: str) -> str | None:
+        fields = await self.get(redis_client, table)
+        value = fields.get(field)
+        if value is not None or field in EXCLUDED_FIELDS:
+            return value
+        if self.tables[table]['version'] is not None:
+            return None  # the version check is current, events load a changed table again
+        # No publish versioned the table yet, so no event tells when it changes
+        return await redis_client.hget(f'{get_settings().redis_prefix}{table}', field)
+
+
+resolution_tables = ResolutionTables()
+invalidation_bus.subscribe('resolution', resolution_tables.invalidate)
@@ -1,14 +1,40 @@
 import json
 from fastapi.responses import Response
 
+
+def pretty_json_dumps(content) -> bytes:
+    return json.dumps(
+        content,
+        ensure_ascii=True,
+        allow_nan=False,
+        indent=2,
+        separators=(", ", ": "),
+    ).encode("utf-8")
+
+
+def compact_json_dumps(content) -> bytes:
+    """Same bytes as FastAPI's default JSONResponse."""
+    return json.dumps(
+        content,
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """Weak comparison of an If-None-Match header against an ETag, as RFC 9110 wants for GET."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    etag = etag.removeprefix('W/')
+    return any(x.strip().removeprefix('W/') == etag for x in if_none_match.split(','))
+
+
 class PrettyJSONResponse(Response):
     media_type = "application/json"
 
     def render(self, content) -> bytes:
-        return json.dumps(
-            content,
-            ensure_ascii=True,
-            allow_nan=False,
-            indent=2,
-            separators=(", ", ": "),
-        ).encode("utf-8")
+        return pretty_json_dumps(content)
@@ -1,8 +1,11 @@
+import os
+
 import boto3
 from botocore.client import Config
 
 from logs import logger
 from ..config import Settings
+from .tracing import span
 
 
 def create_client(settings: Settings):
@@ -30,4 +33,5 @@ def create_client(settings: Settings):
 
 def upload_file(client, file_path: str, bucket: str, object_key: str):
     logger.info(f"Uploading {file_path} -> s3://{bucket}/{object_key}")
-    client.upload_file(file_path, bucket, object_key)
+    with span('s3 upload', kind='client', bucket=bucket, key=object_key, size=os.path.getsize(file_path)):
+        client.upload_file(file_path, bucket, object_key)
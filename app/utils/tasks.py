@@ -1,125 +1,199 @@
 import codecs
 import concurrent.futures
-import hashlib
 import json
+import multiprocessing
 import os
 import re
 import secrets
 import string
+import time
 from datetime import datetime
-from itertools import product
-from typing import Union, Tuple
+from functools import partial
 
-import commentjson
 from github import Github
 from termcolor import colored
 
 from logs import logger
+from .cdn import CDN
 from .cdn.cloudflare import CloudFlareCDN
 from .cdn.ctcdn import CTCDN
 from .cdn.ottercloudcdn import OtterCloudCDN
-from .common import get_settings, cache_file, download_file
-from .git import update_git_repo, get_repo_dir, get_user_repo_name
+from .changes import DOWNLOAD_TABLES, ChangeSet
+from .common import get_settings, download_file
+from .content_store import cache_file, get_content_store
+from .downloads import get_download_url
+from .git import update_git_repo, get_repo_dir, get_user_repo_name, get_changed_paths
+from .invalidation import publish_invalidation
+from .jsonc import load_file as load_jsonc_file
+from .materialized import publish_responses
+from .metrics import observe_cdn_purge, observe_regen_task
+from .pluginmaster import publish_pluginmaster_snapshot
 from .redis import Redis
+from .resolution import publish_resolution_table, read_resolution_table
 from .s3 import create_client as create_s3_client, upload_file
+from .tracing import bind_context, record_error, set_attributes, span
 
 
-def regen(task_list: list[str]):
+def regen(task_list: list[str]) -> dict[str, bool]:
     settings = get_settings()
+    with span('regen', sample_rate=settings.trace_regen_sample_rate, tasks=','.join(task_list)):
+        change_sets = {task: ChangeSet() for task in task_list}
+
+        logger.info(f"Started regeneration tasks: {task_list}.")
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            task_results = dict(zip(task_list, executor.map(bind_context(regen_task), task_list, [change_sets[x] for x in task_list])))
+            results_str = ""
+            for (task, result) in task_results.items():
+                ok = colored("ok", "green") if result else colored("failed", "red")
+                results_str += f"{task}: {ok}\n"
+            logger.info(f"Regeneration tasks finished with results: {results_str.strip()}")
+        # The tasks may have added files to the cache dir, workers rescan it
+        publish_invalidation(Redis.create_client(), 'files')
+
+        # One purge per CDN for the changes of all tasks
+        change_set = ChangeSet()
+        for task_change_set in change_sets.values():
+            change_set.update(task_change_set)
+        cdn_client_list = get_cdn_clients(settings.cdn_list)
+        warmup_paths = []
+        if settings.cdn_warmup and change_set and any(x.supports_prefetch for x in cdn_client_list):
+            try:
+                with span('cdn warmup paths'):
+                    warmup_paths = get_warmup_paths(Redis.create_client(), change_set)
+            except Exception as e:
+                logger.error(f"Collecting the CDN warmup urls failed: {e}")
 
-    logger.info(f"Started regeneration tasks: {task_list}.")
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        results = executor.map(regen_task, task_list)
-        results_str = ""
-        for (task, result) in zip(task_list, results):
-            ok = colored("ok", "green") if result else colored("failed", "red")
-            results_str += f"{task}: {ok}\n"
-        logger.info(f"Regeneration tasks finished with results: {results_str.strip()}")
+        logger.info(f"Started CDN refresh tasks: {[str(cdn) for cdn in cdn_client_list]} ({change_set}).")
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            results = executor.map(bind_context(partial(refresh_cdn_task, change_set=change_set, warmup_paths=warmup_paths)),
+                                   cdn_client_list)
+            for (cdn, result) in zip(cdn_client_list, results):
+                ok = colored("ok", "green") if result else colored("failed", "red")
+                logger.info(f"CDN refresh task finished with result: {cdn}: {ok}")
+        return task_results
 
+
+def get_cdn_clients(cdn_list: list[str]) -> list[CDN]:
     cdn_client_list = []
-    for cdn in settings.cdn_list:
+    for cdn in cdn_list:
         if cdn == 'cloudflare':
             cdn_client_list.append(CloudFlareCDN())
         elif cdn == 'ctcdn':
             cdn_client_list.append(CTCDN())
         elif cdn == 'ottercloudcdn':
             cdn_client_list.append(OtterCloudCDN())
-    task_cdn_list = list(product(task_list, cdn_client_list))
-
-    logger.info(f"Started CDN refresh tasks: {task_cdn_list}.")
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        results = executor.map(refresh_cdn_task,
-                               task_cdn_list)  # an iterator of for i in task_cdn_list -> refresh_cdn_task(i)
-        results_list = []
-        for (task_cdn, result) in zip(task_cdn_list, results):
-            task, cdn = task_cdn
-            ok = colored("ok", "green") if result else colored("failed", "red")
-            results_list.append(f"{task}-{cdn}: {ok}")
-        for i in results_list:
-            logger.info(f"CDN refresh tasks finished with results: {i.strip()}")
-
-
-def regen_task(task: str):
-    logger.info(f"Started regeneration task: {task}.")
-    try:
-        redis_client = Redis.create_client()
-        task_map = {
-            'dalamud': regen_dalamud,
-            'dalamud_changelog': regen_dalamud_changelog,
-            'plugin': regen_pluginmaster,
-            'asset': regen_asset,
-            'xl': regen_xivlauncher,
-            'xivl': regen_xivlauncher,
-            'xivlauncher': regen_xivlauncher,
-            'updater': regen_updater,
-            'xlassets': regen_xlassets,
-        }
-        if task in task_map:
-            func = task_map[task]
-            func(redis_client)
-        else:
-            raise RuntimeError("Invalid task")
-        logger.info(f"Regeneration task {task} finished.")
-        return True
-    except Exception as e:
-        logger.error(e)
-        logger.error(f"Regeneration task {task} failed.")
-        return False
+    return cdn_client_list
+
+
+def get_task_map() -> dict:
+    return {
+        'dalamud': regen_dalamud,
+        'dalamud_changelog': regen_dalamud_changelog,
+        'plugin': regen_pluginmaster,
+        'plugin_full': partial(regen_pluginmaster, full=True),
+        'asset': regen_asset,
+        'xl': regen_xivlauncher,
+        'xivl': regen_xivlauncher,
+        'xivlauncher': regen_xivlauncher,
+        'updater': regen_updater,
+        'xlassets': regen_xlassets,
+    }
 
 
-def refresh_cdn_task(task_cdn: Tuple[str, Union[CloudFlareCDN, CTCDN, OtterCloudCDN]]):
-    task, cdn = task_cdn
-    logger.info(f"Started CDN refresh task: {cdn}-{task}.")
-    try:
-        settings = get_settings()
-        path_map = {
-            'dalamud': ['/Dalamud/Release/VersionInfo', '/Dalamud/Release/Meta'] + \
-                       [f'/Release/VersionInfo?track={x}' for x in ['release', 'staging', 'stg', 'canary']],
-            'dalamud_changelog': ['/Plugin/CoreChangelog'],
-            'plugin': ['/Plugin/PluginMaster', f'/Plugin/PluginMaster?apiLevel={settings.plugin_api_level}',
-                       f'/Plugin/PluginMaster?apiLevel={settings.plugin_api_level_test}'],
-            'asset': ['/Dalamud/Asset/Meta'],
-            'xl': ['/Proxy/Meta', '/Launcher/GetLease'],
-            'xivl': ['/Proxy/Meta', '/Launcher/GetLease'],
-            'xivlauncher': ['/Proxy/Meta', '/Launcher/GetLease',
-                            'https://s3.ffxiv.wang/xivlauncher-cn/releases.win.json', 'https://s3.ffxiv.wang/xivlauncher-cn/releases.beta.json',
-                            'https://s3.ffxiv.wang/xivlauncher-cn/XIVLauncherCN-win-Setup.exe', 'https://s3.ffxiv.wang/xivlauncher-cn/XIVLauncherCN-beta-Setup.exe',
-                            'https://s3.ffxiv.wang/xivlauncher-cn/XIVLauncherCN-win-Portable.7z', 'https://s3.ffxiv.wang/xivlauncher-cn/XIVLauncherCN-beta-Portable.7z'],
-            'updater': ['/Updater/Release/VersionInfo', '/Updater/ChangeLog'],
-            'xlassets': ['/XLAssets/integrity', 'https://s3.ffxiv.wang/xlassets/patchinfo/latest.json'],
-        }
-        if task in path_map:
-            cdn.purge(path_map[task])
-        else:
-            raise RuntimeError("Invalid task")
-        logger.info(f"CDN refresh task {cdn}-{task} finished.")
+def regen_task(task: str, change_set: ChangeSet | None = None):
+    with span(f'regen {task}', task=task):
+        logger.info(f"Started regeneration task: {task}.")
+        start_time = time.perf_counter()
+        try:
+            redis_client = Redis.create_client()
+            task_map = get_task_map()
+            if task in task_map:
+                func = task_map[task]
+                func(redis_client, change_set=change_set)
+            else:
+                raise RuntimeError("Invalid task")
+            logger.info(f"Regeneration task {task} finished.")
+            observe_regen_task(task, True, time.perf_counter() - start_time)
+            return True
+        except Exception as e:
+            record_error(e)
+            logger.error(e)
+            logger.error(f"Regeneration task {task} failed.")
+            if task in get_task_map():  # no series for invalid task names
+                observe_regen_task(task, False, time.perf_counter() - start_time)
+            return False
+
+
+def get_warmup_paths(redis_client, change_set: ChangeSet) -> list[str]:
+    """What clients fetch first after a regen: the changed routes, then the hot newly published files.
+
+    Files keep their hashed names and are never purged, only new ones are cold. Those of the
+    runtime, launcher and updater tables come first, plugin files follow by download count, up to
+    `cdn_warmup_files` in total.
+    """
+    settings = get_settings()
+    paths = sorted({x for route_paths in change_set.routes.values() for x in route_paths if not x.endswith('*')})
+    if not change_set.files or settings.cdn_warmup_files <= 0:
+        return paths
+    counts = redis_client.hgetall(f'{settings.redis_prefix}plugin-count')
+    ranks = {}
+    for table in [*DOWNLOAD_TABLES, *sorted(set(settings.api_namespace.values()))]:
+        for (field, hashed_name) in read_resolution_table(redis_client, table).items():
+            if hashed_name not in change_set.files:
+                continue
+            rank = float('inf') if table in DOWNLOAD_TABLES else int(counts.get(field.removesuffix('-testing'), 0))
+            ranks[hashed_name] = max(rank, ranks.get(hashed_name, rank))
+    files = sorted(ranks, key=lambda x: ranks[x], reverse=True)[:settings.cdn_warmup_files]
+    return paths + [get_download_url(x) for x in files]
+
+
+def refresh_cdn_task(cdn: CDN, change_set: ChangeSet, warmup_paths: list[str] | None = None):
+    with span(f'cdn refresh {cdn}', cdn=str(cdn)):
+        if not change_set:
+            logger.info(f"CDN refresh task {cdn} skipped, nothing changed.")
+            return True
+        logger.info(f"Started CDN refresh task: {cdn} ({change_set}).")
+        start_time = time.perf_counter()
+        try:
+            with span('cdn purge'):
+                stats = cdn.purge_changes(change_set)
+                set_attributes(requests=stats['requests'], retries=stats['retries'])
+            logger.info(f"CDN refresh task {cdn} finished in {stats['seconds']:.2f}s "
+                        f"with {stats['requests']} requests, {stats['retries']} retried.")
+            observe_cdn_purge(str(cdn), True, stats['seconds'], stats['requests'])
+        except Exception as e:
+            record_error(e)
+            logger.error(e)
+            logger.error(f"CDN refresh task {cdn} failed after {cdn.request_count} requests.")
+            observe_cdn_purge(str(cdn), False, time.perf_counter() - start_time, cdn.request_count)
+            return False
+        if warmup_paths and cdn.supports_prefetch:
+            # A failed warmup only costs origin requests, the purge is done
+            request_count = cdn.request_count
+            start_time = time.perf_counter()
+            try:
+                with span('cdn warmup', urls=len(warmup_paths)):
+                    stats = cdn.warm(warmup_paths)
+                logger.info(f"CDN warmup of {cdn} finished in {stats['seconds']:.2f}s, "
+                            f"{len(warmup_paths)} urls in {stats['requests']} requests.")
+                observe_cdn_purge(str(cdn), True, stats['seconds'], stats['requests'], stage='warmup')
+            except Exception as e:
+                logger.error(f"CDN warmup of {cdn} failed: {e}")
+                observe_cdn_purge(str(cdn), False, time.perf_counter() - start_time,
+                                  cdn.request_count - request_count, stage='warmup')
         return True
-    except Exception as e:
-        logger.error(e)
-        logger.error(f"CDN refresh task {cdn}-{task} failed.")
-        return False
 
 
+# Files on S3 that change along with a task, they carry no surrogate keys
+S3_URLS = {
+    'xivlauncher': [
+        'https://s3.ffxiv.wang/xivlauncher-cn/releases.win.json', 'https://s3.ffxiv.wang/xivlauncher-cn/releases.beta.json',
+        'https://s3.ffxiv.wang/xivlauncher-cn/XIVLauncherCN-win-Setup.exe', 'https://s3.ffxiv.wang/xivlauncher-cn/XIVLauncherCN-beta-Setup.exe',
+        'https://s3.ffxiv.wang/xivlauncher-cn/XIVLauncherCN-win-Portable.7z', 'https://s3.ffxiv.wang/xivlauncher-cn/XIVLauncherCN-beta-Portable.7z',
+    ],
+    'xlassets': ['https://s3.ffxiv.wang/xlassets/patchinfo/latest.json'],
+}
+
 DEFAULT_META = {
     "Changelog": "",
     "Tags": [],
@@ -142,24 +216,111 @@ PLUGIN_CACHE_FILES = [
 ]
 
 
-def parsing_pluginmaster(redis_client, settings, repo_url, plugin_list=None) -> tuple[list[dict], list[str], str]:
-    if plugin_list is None:
-        plugin_list = list()
-    plugin_list_length = len(plugin_list)
+PLUGIN_ENTRY_FORMAT = 1  # bump when load_plugin_entry output changes, cached entries are then rebuilt
+PROCESS_POOL_MIN_BATCH = 64  # smaller batches are processed in the regen thread
+
+
+def load_plugin_entry(settings, plugin_dir: str, plugin: str, is_testing: bool) -> dict | None:
+    """Manifest of one plugin dir with the computed fields, and the cached name of its latest.zip.
+
+    Download count and last update are placeholders here, they are filled on every regen.
+    """
+    manifest_path = os.path.join(plugin_dir, f'{plugin}/{plugin}.json')
+    try:
+        plugin_meta = load_jsonc_file(manifest_path)
+    except FileNotFoundError:
+        logger.error(f"Cannot find plugin meta file for {plugin}")
+        return None
+    except Exception as e:
+        logger.error(f"Cannot parse plugin meta file for {plugin}")
+        return None
+    api_level = int(plugin_meta.get("DalamudApiLevel", 0))
+    if settings.plugin_api_level - api_level > 1:
+        return None
+    for key, value in DEFAULT_META.items():
+        if key not in plugin_meta:
+            plugin_meta[key] = value
+    plugin_meta["IsTestingExclusive"] = is_testing
+    plugin_meta["DownloadCount"] = 0
+    plugin_meta["LastUpdate"] = plugin_meta.get("LastUpdate", 0)
+    plugin_meta["DownloadLinkInstall"] = settings.hosted_url.rstrip('/') \
+                                         + '/Plugin/Download/' + f"{plugin}?isUpdate=False&isTesting=False&branch=api{api_level}"
+    plugin_meta["DownloadLinkUpdate"] = settings.hosted_url.rstrip('/') \
+                                        + '/Plugin/Download/' + f"{plugin}?isUpdate=True&isTesting=False&branch=api{api_level}"
+    plugin_meta["DownloadLinkTesting"] = settings.hosted_url.rstrip('/') \
+                                         + '/Plugin/Download/' + f"{plugin}?isUpdate=False&isTesting=True&branch=api{api_level}"
+    plugin_latest_path = os.path.join(plugin_dir, f'{plugin}/latest.zip')
+    plugin_meta["IconUrl"] = f"https://s3test.ffxiv.wang/plugindistd17/stable/{plugin}/images/icon.png"
+
+    if is_testing:
+        plugin_meta["TestingAssemblyVersion"] = plugin_meta["AssemblyVersion"]
+        plugin_meta["TestingChangelog"] = plugin_meta["Changelog"]
+        plugin_meta["TestingDalamudApiLevel"] = api_level
+        plugin_meta["IconUrl"] = f"https://s3test.ffxiv.wang/plugindistd17/testing-live/{plugin}/images/icon.png"
+
+    cached = cache_file(plugin_latest_path)
+    if not cached:
+        return None
+    (hashed_name, _) = cached
+    return {'meta': plugin_meta, 'hashed_name': hashed_name}
+
+
+def get_plugin_entry_fingerprint(settings) -> str:
+    return f'{PLUGIN_ENTRY_FORMAT}|{settings.plugin_api_level}|{settings.hosted_url}'
+
+
+def get_changed_plugin_dirs(redis_client, settings, repo, repo_key: str, head_commit: str) -> set[str] | None:
+    """`<channel>/<plugin>` dirs changed since the last regen of a repo, None when a full rebuild is needed."""
+    state_str = redis_client.hget(f'{settings.redis_prefix}plugin-regen-state', repo_key)
+    if not state_str:
+        return None
+    state = json.loads(state_str)
+    if state.get('fingerprint') != get_plugin_entry_fingerprint(settings):
+        return None
+    if state['commit'] == head_commit:
+        return set()
+    changed_paths = get_changed_paths(repo, state['commit'], head_commit)
+    if changed_paths is None:
+        logger.warning(f"Last processed commit {state['commit']} is missing in {repo_key}, rebuilding all plugins.")
+        return None
+    changed_dirs = set()
+    for path in changed_paths:
+        parts = path.split('/')
+        if len(parts) > 1 and parts[0] in ('stable', 'testing-live'):
+            changed_dirs.add(f'{parts[0]}/{parts[1]}')
+    return changed_dirs
+
+
+def load_plugin_entry_task(args: tuple[str, str, bool]) -> dict | None:
+    """Process pool entry point of load_plugin_entry, the worker loads its own settings."""
+    (plugin_dir, plugin, is_testing) = args
+    return load_plugin_entry(get_settings(), plugin_dir, plugin, is_testing)
+
+
+def create_regen_process_pool(settings) -> concurrent.futures.ProcessPoolExecutor | None:
+    workers = settings.regen_process_workers or os.cpu_count() or 1
+    if workers <= 1:
+        return None
+    # spawn, forking the threaded server process could copy a held lock into the workers
+    return concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+
+def scan_plugin_repo(redis_client, settings, repo_url, process_pool=None, full: bool = False) -> dict:
+    """Pull a dist repo and load the entries of all its plugin dirs.
+
+    Processed entries are kept in Redis with the commit they were built from, so only the plugin
+    dirs touched by the git diff since then are processed again. `full` rebuilds every entry.
+    """
     (_, repo_name) = get_user_repo_name(repo_url)
     (_, repo) = update_git_repo(repo_url)
     branch = repo.active_branch.name
     plugin_namespace = f"plugin-{repo_name}-{branch}"
     logger.info(f"plugin_namespace: {plugin_namespace}")
     plugin_repo_dir = get_repo_dir(repo_url)
-    pluginmaster = []
-    plugin_name_list = []
-    stable_plugin_map = {}
     channel_map = {
         'stable': 'stable',
         'testing': 'testing-live'
     }
-    jsonc = commentjson
     stable_dir = os.path.join(plugin_repo_dir, channel_map['stable'])
     testing_dir = os.path.join(plugin_repo_dir, channel_map['testing'])
     if not os.path.exists(testing_dir):
@@ -173,119 +334,155 @@ def parsing_pluginmaster(redis_client, settings, repo_url, plugin_list=None) ->
     for (channel, channel_meta) in state['Channels'].items():
         for (plugin, plugin_meta) in channel_meta['Plugins'].items():
             last_updated[plugin] = int(datetime.fromisoformat(re.sub(r'(\.\d{6})\d+(?=[+-]\d{2}:\d{2}$)', r'\1', plugin_meta['TimeBuilt'])).timestamp())
-    # Generate pluginmaster
+
+    # Find the plugin dirs changed since the last regen
+    repo_key = os.path.basename(plugin_repo_dir)
+    entries_key = f'{settings.redis_prefix}plugin-entries|{repo_key}'
+    head_commit = repo.head.commit.hexsha
+    changed_dirs = None if full else get_changed_plugin_dirs(redis_client, settings, repo, repo_key, head_commit)
+    cached_entries = {} if changed_dirs is None else redis_client.hgetall(entries_key)
+    cache_dir = os.path.join(settings.root_path, settings.file_cache_dir)
+    entries = {}
+    tasks = {}
     for plugin_dir in [stable_dir, testing_dir]:
+        is_testing = plugin_dir == testing_dir
         for plugin in os.listdir(plugin_dir):
-            try:
-                with codecs.open(os.path.join(plugin_dir, f'{plugin}/{plugin}.json'), 'r', 'utf8') as f:
-                    plugin_meta = jsonc.load(f)
-            except FileNotFoundError:
-                logger.error(f"Cannot find plugin meta file for {plugin}")
-                continue
-            except Exception as e:
-                try:
-                    with codecs.open(os.path.join(plugin_dir, f'{plugin}/{plugin}.json'), 'r', 'utf-8-sig') as f:
-                        plugin_meta = jsonc.load(f)
-                except Exception as e:
-                    logger.error(f"Cannot parse plugin meta file for {plugin}")
-                    continue
-            api_level = int(plugin_meta.get("DalamudApiLevel", 0))
-            if settings.plugin_api_level - api_level > 1:
-                continue
-            if plugin_list_length > 0 and plugin in plugin_list:
-                continue
-            for key, value in DEFAULT_META.items():
-                if key not in plugin_meta:
-                    plugin_meta[key] = value
-            is_testing = plugin_dir == testing_dir
-            plugin_meta["IsTestingExclusive"] = is_testing
-            download_count = redis_client.hget(f'{settings.redis_prefix}plugin-count', plugin) or 0
-            plugin_meta["DownloadCount"] = int(download_count)
-            plugin_meta["LastUpdate"] = last_updated.get(plugin, plugin_meta.get("LastUpdate", 0))
-            plugin_meta["DownloadLinkInstall"] = settings.hosted_url.rstrip('/') \
-                                                 + '/Plugin/Download/' + f"{plugin}?isUpdate=False&isTesting=False&branch=api{api_level}"
-            plugin_meta["DownloadLinkUpdate"] = settings.hosted_url.rstrip('/') \
-                                                + '/Plugin/Download/' + f"{plugin}?isUpdate=True&isTesting=False&branch=api{api_level}"
-            plugin_meta["DownloadLinkTesting"] = settings.hosted_url.rstrip('/') \
-                                                 + '/Plugin/Download/' + f"{plugin}?isUpdate=False&isTesting=True&branch=api{api_level}"
-            plugin_latest_path = os.path.join(plugin_dir, f'{plugin}/latest.zip')
-            plugin_meta["IconUrl"] = f"https://s3test.ffxiv.wang/plugindistd17/stable/{plugin}/images/icon.png"
-
-            if is_testing:
-                plugin_meta["TestingAssemblyVersion"] = plugin_meta["AssemblyVersion"]
-                plugin_meta["TestingChangelog"] = plugin_meta["Changelog"]
-                plugin_meta["TestingDalamudApiLevel"] = api_level
-                plugin_meta["IconUrl"] = f"https://s3test.ffxiv.wang/plugindistd17/testing-live/{plugin}/images/icon.png"
-
-            (hashed_name, _) = cache_file(plugin_latest_path)
-            plugin_name = f"{plugin}-testing" if is_testing else plugin
-            redis_client.hset(f'{settings.redis_prefix}{plugin_namespace}', plugin_name, hashed_name)
-            if is_testing and plugin in stable_plugin_map:
-                stable_meta = stable_plugin_map[plugin]
-                stable_meta["TestingAssemblyVersion"] = plugin_meta["TestingAssemblyVersion"]
-                stable_meta["TestingChangelog"] = plugin_meta["TestingChangelog"]
-                stable_meta["TestingDalamudApiLevel"] = plugin_meta["TestingDalamudApiLevel"]
-                if "_Dip17Channel" in plugin_meta:
-                    stable_meta["_Dip17Channel"] = plugin_meta["_Dip17Channel"]
-                plugin_name_list.append(plugin)
-                continue
-            if not is_testing:
-                stable_plugin_map[plugin] = plugin_meta
-            pluginmaster.append(plugin_meta)
-            plugin_name_list.append(plugin)
+            entry_key = f'{os.path.basename(plugin_dir)}/{plugin}'
+            entry_str = None if entry_key in (changed_dirs or ()) else cached_entries.get(entry_key)
+            entry = json.loads(entry_str) if entry_str else None
+            if entry_str is None or (entry and not os.path.isfile(os.path.join(cache_dir, entry['hashed_name']))):
+                tasks[entry_key] = (plugin_dir, plugin, is_testing)
+            entries[entry_key] = entry_str
+
+    # Manifest parsing and hashing are CPU-bound, small batches are not worth starting the pool for
+    use_pool = bool(process_pool) and len(tasks) >= PROCESS_POOL_MIN_BATCH
+    with span('parse manifests', repo=repo_key, plugins=len(tasks), process_pool=use_pool):
+        if use_pool:
+            results = process_pool.map(load_plugin_entry_task, tasks.values(), chunksize=8)
+        else:
+            results = map(load_plugin_entry_task, tasks.values())
+        for (entry_key, entry) in zip(tasks, results):
+            entries[entry_key] = json.dumps(entry)
+
+    pipe = redis_client.pipeline()
+    pipe.delete(entries_key)
+    if entries:
+        pipe.hset(entries_key, mapping=entries)
+    pipe.hset(f'{settings.redis_prefix}plugin-regen-state', repo_key, json.dumps({
+        'commit': head_commit,
+        'fingerprint': get_plugin_entry_fingerprint(settings),
+    }))
+    pipe.execute()
+    logger.info(f"Processed {len(tasks)} of {len(entries)} plugin dirs in {repo_key} at {head_commit[:7]}"
+                + (" (full rebuild)" if changed_dirs is None else ""))
+
+    # Stable first, so its version is kept when a plugin is in both channels
+    versions = {}
+    for (entry_key, entry_str) in entries.items():
+        entry = json.loads(entry_str)
+        plugin = entry_key.split('/', 1)[1]
+        if entry and plugin not in versions and entry['meta'].get('AssemblyVersion'):
+            versions[plugin] = entry['meta']['AssemblyVersion']
+    return {
+        'namespace': plugin_namespace,
+        'entries': entries,
+        'last_updated': last_updated,
+        'versions': versions,
+    }
 
-    return pluginmaster, plugin_name_list, plugin_namespace
 
+def merge_plugin_entries(scan: dict, download_counts: dict, plugin_list=None) -> tuple[list[dict], list[str], dict]:
+    """Pluginmaster of a scanned repo, leaving out the plugins in `plugin_list`.
 
-def get_repo_plugin_versions(repo_url: str) -> dict:
-    """Map InternalName -> AssemblyVersion for all plugins in a dist repo (stable preferred over testing-live)."""
-    repo_dir = get_repo_dir(repo_url)
-    versions = {}
-    for channel in ('stable', 'testing-live'):
-        channel_dir = os.path.join(repo_dir, channel)
-        if not os.path.isdir(channel_dir):
+    Returns the pluginmaster, the plugin names in it and the cached file of each plugin.
+    """
+    if plugin_list is None:
+        plugin_list = set()
+    pluginmaster = []
+    plugin_name_list = []
+    hashed_names = {}
+    stable_plugin_map = {}
+    for (entry_key, entry_str) in scan['entries'].items():
+        (channel, plugin) = entry_key.split('/', 1)
+        if plugin in plugin_list:
             continue
-        for plugin in os.listdir(channel_dir):
-            if plugin in versions:  # stable processed first, keep it
-                continue
-            manifest_path = os.path.join(channel_dir, plugin, f'{plugin}.json')
-            if not os.path.isfile(manifest_path):
-                continue
-            meta = None
-            for enc in ('utf8', 'utf-8-sig'):
-                try:
-                    with codecs.open(manifest_path, 'r', enc) as f:
-                        meta = commentjson.load(f)
-                    break
-                except Exception:
-                    continue
-            if meta:
-                ver = meta.get('AssemblyVersion')
-                if ver:
-                    versions[plugin] = ver
-    return versions
+        entry = json.loads(entry_str)
+        if entry is None:
+            continue
+        is_testing = channel == 'testing-live'
+        plugin_meta = entry['meta']
+        plugin_meta["DownloadCount"] = int(download_counts.get(plugin) or 0)
+        plugin_meta["LastUpdate"] = scan['last_updated'].get(plugin, plugin_meta["LastUpdate"])
+        plugin_name = f"{plugin}-testing" if is_testing else plugin
+        hashed_names[plugin_name] = entry['hashed_name']
+        if is_testing and plugin in stable_plugin_map:
+            stable_meta = stable_plugin_map[plugin]
+            stable_meta["TestingAssemblyVersion"] = plugin_meta["TestingAssemblyVersion"]
+            stable_meta["TestingChangelog"] = plugin_meta["TestingChangelog"]
+            stable_meta["TestingDalamudApiLevel"] = plugin_meta["TestingDalamudApiLevel"]
+            if "_Dip17Channel" in plugin_meta:
+                stable_meta["_Dip17Channel"] = plugin_meta["_Dip17Channel"]
+            plugin_name_list.append(plugin)
+            continue
+        if not is_testing:
+            stable_plugin_map[plugin] = plugin_meta
+        pluginmaster.append(plugin_meta)
+        plugin_name_list.append(plugin)
+    return pluginmaster, plugin_name_list, hashed_names
 
 
-def regen_pluginmaster(redis_client=None, repo_url: str = ''):
-    logger.info("Start regenerating pluginmaster.")
+def regen_pluginmaster(redis_client=None, repo_url: str = '', full: bool = False, change_set: ChangeSet | None = None):
+    logger.info("Start regenerating pluginmaster" + (" (full rebuild)." if full else "."))
     settings = get_settings()
     if not redis_client:
         redis_client = Redis.create_client()
+    if change_set is None:
+        change_set = ChangeSet()
     if not repo_url:
         repo_url = settings.plugin_repo
 
     repo_url_goatcorp = settings.plugin_repo_goatcorp
+    repo_urls = [repo_url] if repo_url == repo_url_goatcorp else [repo_url, repo_url_goatcorp]
 
-    pluginmaster_cn, plugin_name_list_cn, plugin_namespace = parsing_pluginmaster(redis_client, settings, repo_url)
-    pluginmaster, _, _ = parsing_pluginmaster(redis_client, settings, repo_url_goatcorp, plugin_name_list_cn)
-    upload_plugin_icons(settings, repo_url_goatcorp)
-    if repo_url != repo_url_goatcorp:
-        upload_plugin_icons(settings, repo_url)
+    def scan_and_upload_icons(url):
+        with span('scan plugin repo', repo=url):
+            scan = scan_plugin_repo(redis_client, settings, url, process_pool, full)
+        with span('upload plugin icons', repo=url):
+            upload_plugin_icons(settings, url)
+        return scan
+
+    # Both repos are pulled and scanned at the same time, sharing one process pool
+    process_pool = create_regen_process_pool(settings)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(repo_urls)) as executor:
+            scans = list(executor.map(bind_context(scan_and_upload_icons), repo_urls))
+    finally:
+        if process_pool:
+            process_pool.shutdown()
+
+    download_counts = redis_client.hgetall(f'{settings.redis_prefix}plugin-count')
+    scan_cn = scans[0]
+    plugin_namespace = scan_cn['namespace']
+    pluginmaster_cn, plugin_name_list_cn, hashed_names_cn = merge_plugin_entries(scan_cn, download_counts)
+    pluginmaster = []
+    goatcorp_versions = {}
+    if len(scans) > 1:
+        scan_goatcorp = scans[1]
+        goatcorp_versions = scan_goatcorp['versions']
+        # ottercorp takes precedence over goatcorp for plugins in both repos
+        pluginmaster, _, hashed_names = merge_plugin_entries(scan_goatcorp, download_counts, set(plugin_name_list_cn))
+        if hashed_names:
+            before = read_resolution_table(redis_client, scan_goatcorp['namespace'])
+            redis_client.hset(f"{settings.redis_prefix}{scan_goatcorp['namespace']}", mapping=hashed_names)
+            publish_resolution_table(redis_client, scan_goatcorp['namespace'], before, change_set)
+    if hashed_names_cn:
+        before = read_resolution_table(redis_client, plugin_namespace)
+        redis_client.hset(f'{settings.redis_prefix}{plugin_namespace}', mapping=hashed_names_cn)
+        publish_resolution_table(redis_client, plugin_namespace, before, change_set)
 
     # Mark source: _cn (CN maintained) = served by the ottercorp (CN) repo, i.e. a CN-exclusive
     # plugin or a CN override of an upstream plugin (vs plugins coming purely from goatcorp upstream).
     # For CN overrides whose version differs from upstream, record the upstream version in _uv.
-    goatcorp_versions = {} if repo_url == repo_url_goatcorp else get_repo_plugin_versions(repo_url_goatcorp)
     for plugin in pluginmaster:  # goatcorp upstream
         plugin["_cn"] = False
     for plugin in pluginmaster_cn:  # ottercorp/CN maintained
@@ -297,6 +494,7 @@ def regen_pluginmaster(redis_client=None, repo_url: str = ''):
     pluginmaster += pluginmaster_cn
 
     redis_client.hset(f'{settings.redis_prefix}{plugin_namespace}', 'pluginmaster', json.dumps(pluginmaster))
+    publish_pluginmaster_snapshot(redis_client, plugin_namespace, change_set)
     plugin_name_list = []
     for plugin in pluginmaster:
         plugin_name = plugin['InternalName']
@@ -338,7 +536,7 @@ def upload_plugin_icons(settings, repo_url):
             upload_file(s3_client, icon_path, 'plugindistd17', object_key)
 
 
-def regen_asset(redis_client=None):
+def regen_asset(redis_client=None, change_set: ChangeSet | None = None):
     logger.info("Start regenerating dalamud assets.")
     if not redis_client:
         redis_client = Redis.create_client()
@@ -362,16 +560,19 @@ def regen_asset(redis_client=None):
     redis_client.hset(f'{settings.redis_prefix}asset', 'meta', json.dumps(asset_json))
     if cheatplugin_hash:
         redis_client.hset(f'{settings.redis_prefix}asset', 'cheatplugin_hash', cheatplugin_hash)
-        with open(os.path.join(asset_repo_dir, "UIRes/cheatplugin.json"), "rb") as f:
-            bs = f.read()
-            cheatplugin_hash_sha256 = hashlib.sha256(bs).hexdigest().upper()
-            redis_client.hset(f'{settings.redis_prefix}asset', 'cheatplugin_hash_sha256', cheatplugin_hash_sha256)
+        cheatplugin_path = os.path.join(asset_repo_dir, "UIRes/cheatplugin.json")
+        cheatplugin_hash_sha256 = get_content_store().hash_file(cheatplugin_path).upper()
+        redis_client.hset(f'{settings.redis_prefix}asset', 'cheatplugin_hash_sha256', cheatplugin_hash_sha256)
+    publish_responses('asset', redis_client, change_set)
 
 
-def regen_dalamud(redis_client=None):
+def regen_dalamud(redis_client=None, change_set: ChangeSet | None = None):
     logger.info("Start regenerating dalamud distribution.")
     if not redis_client:
         redis_client = Redis.create_client()
+    if change_set is None:
+        change_set = ChangeSet()
+    runtime_before = read_resolution_table(redis_client, 'runtime')
     settings = get_settings()
     (__, repo) = update_git_repo(settings.distrib_repo)
     branch_prefix = ''
@@ -411,66 +612,74 @@ def regen_dalamud(redis_client=None):
         version = re.search(r'(?P<ver>.*)\.json$', hash_file).group('ver')
         (hashed_name, _) = cache_file(os.path.join(distrib_repo_dir, f'runtimehashes/{hash_file}'))
         redis_client.hset(f'{settings.redis_prefix}runtime', f'hashes-{version}', hashed_name)
+    publish_resolution_table(redis_client, 'runtime', runtime_before, change_set)
+    publish_responses('dalamud', redis_client, change_set)
     # return release_version
 
 
-def regen_dalamud_changelog(redis_client=None):
+def regen_dalamud_changelog(redis_client=None, change_set: ChangeSet | None = None):
     logger.info("Start regenerating dalamud changelog.")
     if not redis_client:
         redis_client = Redis.create_client()
     settings = get_settings()
     dalamud_repo_url = settings.dalamud_repo
     user, repo_name = get_user_repo_name(dalamud_repo_url)
-    gh = Github(None if not settings.github_token else settings.github_token)
-    repo = gh.get_repo(f'{user}/{repo_name}')
-    tags = repo.get_tags()
-    sliced_tags = list(tags[:11])  # only care about latest 10 tags
-    changelogs = []
-    skip_prefix = ['build:', 'Merge pull request', 'Merge branch']
-    for (idx, tag) in enumerate(sliced_tags[:-1]):
-        next_tag = sliced_tags[idx + 1]
-        changes = []
-        diff = repo.compare(next_tag.commit.sha, tag.commit.sha)
-        for commit in diff.commits:
-            msg = commit.commit.message
-            if any([msg.startswith(x) for x in skip_prefix]):
-                continue
-            changes.append({
-                'author': commit.commit.author.name,
-                'message': msg.split('\n')[0],
-                'sha': commit.sha,
-                'date': commit.commit.author.date.isoformat()
+    with span('github changelog', kind='client', repo=f'{user}/{repo_name}'):
+        gh = Github(None if not settings.github_token else settings.github_token)
+        repo = gh.get_repo(f'{user}/{repo_name}')
+        tags = repo.get_tags()
+        sliced_tags = list(tags[:11])  # only care about latest 10 tags
+        changelogs = []
+        skip_prefix = ['build:', 'Merge pull request', 'Merge branch']
+        for (idx, tag) in enumerate(sliced_tags[:-1]):
+            next_tag = sliced_tags[idx + 1]
+            changes = []
+            diff = repo.compare(next_tag.commit.sha, tag.commit.sha)
+            for commit in diff.commits:
+                msg = commit.commit.message
+                if any([msg.startswith(x) for x in skip_prefix]):
+                    continue
+                changes.append({
+                    'author': commit.commit.author.name,
+                    'message': msg.split('\n')[0],
+                    'sha': commit.sha,
+                    'date': commit.commit.author.date.isoformat()
+                })
+            changelogs.append({
+                'version': tag.name,
+                'date': tag.commit.commit.author.date.isoformat(),
+                'changes': changes,
             })
-        changelogs.append({
-            'version': tag.name,
-            'date': tag.commit.commit.author.date.isoformat(),
-            'changes': changes,
-        })
     redis_client.hset(f'{settings.redis_prefix}dalamud', 'changelog', json.dumps(changelogs))
+    publish_responses('dalamud_changelog', redis_client, change_set)
 
 
-def regen_xivlauncher(redis_client=None):
+def regen_xivlauncher(redis_client=None, change_set: ChangeSet | None = None):
     logger.info("Start regenerating xivlauncher distribution.")
     if not redis_client:
         redis_client = Redis.create_client()
+    if change_set is None:
+        change_set = ChangeSet()
+    xivlauncher_before = read_resolution_table(redis_client, 'xivlauncher')
     settings = get_settings()
     xivl_repo_url = settings.xivl_repo
     s = re.search(r'github.com[\/:](?P<user>.+)\/(?P<repo>.+)\.git', xivl_repo_url)
     user, repo_name = s.group('user'), s.group('repo')
-    gh = Github(None if not settings.github_token else settings.github_token)
-    repo = gh.get_repo(f'{user}/{repo_name}')
-    releases = repo.get_releases()
-    pre_release = None
-    release = None
-    latest_release = releases[0]
-    if latest_release.prerelease:
-        pre_release = latest_release
-        for r in releases:
-            if not r.prerelease:
-                release = r
-                break
-    else:
-        pre_release = release = latest_release
+    with span('github releases', kind='client', repo=f'{user}/{repo_name}'):
+        gh = Github(None if not settings.github_token else settings.github_token)
+        repo = gh.get_repo(f'{user}/{repo_name}')
+        releases = repo.get_releases()
+        pre_release = None
+        release = None
+        latest_release = releases[0]
+        if latest_release.prerelease:
+            pre_release = latest_release
+            for r in releases:
+                if not r.prerelease:
+                    release = r
+                    break
+        else:
+            pre_release = release = latest_release
 
     for (idx, rel) in enumerate([pre_release, release]):
         release_type = 'prerelease' if idx == 0 else 'release'
@@ -505,25 +714,33 @@ def regen_xivlauncher(redis_client=None):
             f'{release_type}-meta',
             json.dumps(meta)
         )
+    publish_resolution_table(redis_client, 'xivlauncher', xivlauncher_before, change_set)
+    publish_responses('xivlauncher', redis_client, change_set)
+    if change_set:
+        change_set.urls.update(S3_URLS['xivlauncher'])
 
 
-def regen_updater(redis_client=None):
+def regen_updater(redis_client=None, change_set: ChangeSet | None = None):
     logger.info("Start regenerating Updater distribution.")
     if not redis_client:
         redis_client = Redis.create_client()
+    if change_set is None:
+        change_set = ChangeSet()
+    updater_before = read_resolution_table(redis_client, 'updater')
     settings = get_settings()
     redis_client.delete(f'{settings.redis_prefix}updater')
     updater_repo_url = settings.updater_repo
     s = re.search(r'github.com[\/:](?P<user>.+)\/(?P<repo>.+)\.git', updater_repo_url)
     user, repo_name = s.group('user'), s.group('repo')
-    gh = Github(None if not settings.github_token else settings.github_token)
-    repo = gh.get_repo(f'{user}/{repo_name}')
-    releases = repo.get_releases()
-    last_release = next((r for r in releases if not r.prerelease), None)
-    pre_release = next((r for r in releases if r.prerelease), None)
-    if last_release is None or pre_release is None:
-        last_release = last_release or pre_release
-        pre_release = pre_release or last_release
+    with span('github releases', kind='client', repo=f'{user}/{repo_name}'):
+        gh = Github(None if not settings.github_token else settings.github_token)
+        repo = gh.get_repo(f'{user}/{repo_name}')
+        releases = repo.get_releases()
+        last_release = next((r for r in releases if not r.prerelease), None)
+        pre_release = next((r for r in releases if r.prerelease), None)
+        if last_release is None or pre_release is None:
+            last_release = last_release or pre_release
+            pre_release = pre_release or last_release
     for release in (last_release, pre_release):
         release_type = 'prerelease' if release.prerelease else 'release'
         assets = release.get_assets()
@@ -546,9 +763,11 @@ def regen_updater(redis_client=None):
         f'version',
         json.dumps(version_dict)
     )
+    publish_resolution_table(redis_client, 'updater', updater_before, change_set)
+    publish_responses('updater', redis_client, change_set)
 
 
-def regen_xlassets(redis_client=None):
+def regen_xlassets(redis_client=None, change_set: ChangeSet | None = None):
     logger.info("Start regenerating XLAssets distribution")
     if not redis_client:
         redis_client = Redis.create_client()
@@ -571,6 +790,9 @@ def regen_xlassets(redis_client=None):
         f'json',
         json.dumps(integrity_json)
     )
+    publish_responses('xlassets', redis_client, change_set)
+    if change_set:
+        change_set.urls.update(S3_URLS['xlassets'])
 
 
 def flush_stg_code(redis_client=None) -> str:
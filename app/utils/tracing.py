@@ -0,0 +1,313 @@
+import atexit
+import json
+import os
+import queue
+import random
+import re
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+
+from logs import logger
+from .common import get_settings
+
+# Finished spans waiting for the exporter, more are dropped when it falls behind
+QUEUE_SIZE = 10000
+TRACEPARENT_RE = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+OTLP_SPAN_KINDS = {'internal': 1, 'server': 2, 'client': 3}
+
+
+class Span:
+    """A timed operation of a trace, its parent is the span that was current when it started."""
+
+    __slots__ = ('name', 'kind', 'trace_id', 'span_id', 'parent_id', 'attributes', 'start_ns', 'end_ns', 'error')
+
+    def __init__(self, name: str, kind: str, trace_id: str, parent_id: str, attributes: dict):
+        self.name = name
+        self.kind = kind
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+        self.error = ''
+
+    @property
+    def traceparent(self) -> str:
+        """The W3C `traceparent` of this span, to continue its trace elsewhere."""
+        return f'00-{self.trace_id}-{self.span_id}-01'
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def set_error(self, e: BaseException):
+        self.error = f'{type(e).__name__}: {e}'
+
+    def to_dict(self) -> dict:
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'kind': self.kind,
+            'start_ns': self.start_ns,
+            'end_ns': self.end_ns,
+            'duration_ms': round((self.end_ns - self.start_ns) / 1e6, 3),
+            'error': self.error,
+            'attributes': self.attributes,
+        }
+
+
+current_span: ContextVar[Span | None] = ContextVar('current_span', default=None)
+
+
+def parse_traceparent(value: str) -> tuple[str, str, bool] | None:
+    """Trace id, parent span id and sampled flag of a W3C `traceparent`, None if it is malformed."""
+    match = TRACEPARENT_RE.match(value.strip().lower())
+    if not match or match.group(1) == '0' * 32 or match.group(2) == '0' * 16:
+        return None
+    return (match.group(1), match.group(2), bool(int(match.group(3), 16) & 1))
+
+
+def strip_query(url: str) -> str:
+    """A URL without its query, which may carry secrets such as the GA api_secret."""
+    parts = urlsplit(url)
+    return f'{parts.scheme}://{parts.netloc}{parts.path}'
+
+
+def format_otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+class JsonlExporter:
+    """Appends one JSON object per span to a file, each batch in one write so processes can share it."""
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def export(self, spans: list[Span]):
+        resource = {'service': get_settings().app_name, 'pid': os.getpid()}
+        lines = ''.join(json.dumps({**span.to_dict(), **resource}, default=str) + '\n' for span in spans)
+        with open(self.path, 'a', encoding='utf8') as f:
+            f.write(lines)
+
+
+class OtlpExporter:
+    """Posts spans to an OTLP/HTTP collector in the JSON encoding, e.g. `scripts/trace_standin.py`."""
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.session = requests.Session()
+
+    def export(self, spans: list[Span]):
+        resource = {'service.name': get_settings().app_name, 'process.pid': os.getpid()}
+        body = {'resourceSpans': [{
+            'resource': {'attributes': [{'key': k, 'value': format_otlp_value(v)} for (k, v) in resource.items()]},
+            'scopeSpans': [{
+                'scope': {'name': 'xlweb'},
+                'spans': [{
+                    'traceId': span.trace_id,
+                    'spanId': span.span_id,
+                    'parentSpanId': span.parent_id,
+                    'name': span.name,
+                    'kind': OTLP_SPAN_KINDS[span.kind],
+                    'startTimeUnixNano': str(span.start_ns),
+                    'endTimeUnixNano': str(span.end_ns),
+                    'attributes': [{'key': k, 'value': format_otlp_value(v)} for (k, v) in span.attributes.items()],
+                    'status': {'code': 2, 'message': span.error} if span.error else {'code': 0},
+                } for span in spans],
+            }],
+        }]}
+        response = self.session.post(self.endpoint, json=body, timeout=10)
+        response.raise_for_status()
+
+
+def create_exporter(settings):
+    if settings.trace_exporter == 'jsonl':
+        return JsonlExporter(settings.trace_file)
+    if settings.trace_exporter == 'otlp':
+        return OtlpExporter(settings.trace_otlp_endpoint)
+    if settings.trace_exporter:
+        logger.warning(f"Unknown trace exporter {settings.trace_exporter}, tracing is disabled.")
+    return None
+
+
+class Tracer:
+    """Records spans and exports them from a thread every `trace_export_interval` seconds.
+
+    A span is only recorded inside a sampled trace. Traces start at the roots that pass a
+    `sample_rate`, the HTTP requests and the regen runs, or continue a sampled `traceparent`;
+    anywhere else `span` costs one context variable lookup.
+    """
+
+    def __init__(self):
+        self.exporter = create_exporter(get_settings())
+        self.dropped = 0
+        self._queue = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._export_lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.exporter is not None
+
+    def start(self, name: str, kind: str, traceparent: str, sample_rate: float | None, attributes: dict) -> Span | None:
+        if self.exporter is None:
+            return None
+        remote = parse_traceparent(traceparent) if traceparent else None
+        parent = current_span.get()
+        if remote:
+            (trace_id, parent_id, sampled) = remote
+            if not sampled:
+                return None
+        elif parent is not None:
+            (trace_id, parent_id) = (parent.trace_id, parent.span_id)
+        elif sample_rate is not None and random.random() < sample_rate:
+            (trace_id, parent_id) = (secrets.token_hex(16), '')
+        else:
+            return None
+        return Span(name, kind, trace_id, parent_id, attributes)
+
+    def end(self, span: Span):
+        span.end_ns = time.time_ns()
+        if self._pid != os.getpid():
+            self._start_thread()
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def _start_thread(self):
+        # Once per process, a forked worker does not inherit the thread
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(QUEUE_SIZE)
+            threading.Thread(target=self._run, name='tracer', daemon=True).start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        interval = get_settings().trace_export_interval
+        while True:
+            time.sleep(interval)
+            self.flush()
+
+    def flush(self):
+        """Export the finished spans now, e.g. before the process exits."""
+        if self._queue is None:
+            return
+        with self._export_lock:
+            spans = []
+            while True:
+                try:
+                    spans.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if self.dropped:
+                logger.warning(f"Dropped {self.dropped} spans, the trace exporter fell behind.")
+                self.dropped = 0
+            if not spans:
+                return
+            try:
+                self.exporter.export(spans)
+            except Exception as e:
+                logger.warning(f"Exporting {len(spans)} spans failed: {e}")
+
+
+tracer = Tracer()
+atexit.register(tracer.flush)
+
+
+@contextmanager
+def span(name: str, kind: str = 'internal', traceparent: str = '', sample_rate: float | None = None, **attributes):
+    """Record the block as a span of the current trace, yields the span or None when not traced.
+
+    `traceparent` continues a trace from another process, `sample_rate` makes this a root that
+    starts a new trace that often when there is no current one. An exception is recorded as the
+    error of the span and raised on.
+    """
+    current = tracer.start(name, kind, traceparent, sample_rate, attributes)
+    if current is None:
+        yield None
+        return
+    token = current_span.set(current)
+    try:
+        yield current
+    except Exception as e:
+        current.set_error(e)
+        raise
+    finally:
+        current_span.reset(token)
+        tracer.end(current)
+
+
+@contextmanager
+def untraced():
+    """Record no spans in the block, e.g. for the commands of a polling loop."""
+    token = current_span.set(None)
+    try:
+        yield
+    finally:
+        current_span.reset(token)
+
+
+def get_traceparent() -> str:
+    current = current_span.get()
+    return current.traceparent if current else ''
+
+
+def set_attributes(**attributes):
+    current = current_span.get()
+    if current is not None:
+        current.attributes.update(attributes)
+
+
+def record_error(e: BaseException):
+    """Mark the current span failed for an exception that is handled, not raised through it."""
+    current = current_span.get()
+    if current is not None:
+        current.set_error(e)
+
+
+def bind_context(func):
+    """`func` in the trace of the caller, for thread pools, which do not carry context variables over."""
+    parent = current_span.get()
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        token = current_span.set(parent)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            current_span.reset(token)
+    return wrapper
+
+
+class TracedTransport(httpx.AsyncHTTPTransport):
+    """Records the requests of an httpx client as client spans."""
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        with span(f'{request.method} {request.url.host}', kind='client', **{
+            'http.method': request.method,
+            'http.url': strip_query(str(request.url)),
+        }) as current:
+            response = await super().handle_async_request(request)
+            if current is not None:
+                current.set_attribute('http.status_code', response.status_code)
+            return response
@@ -0,0 +1,95 @@
+import asyncio
+import json
+import os
+import secrets
+import time
+
+from fastapi.concurrency import run_in_threadpool
+
+from logs import logger
+from .common import get_settings
+from .invalidation import invalidation_bus, publish_invalidation
+from .redis import Redis
+
+# Seconds the results of a command are kept
+RESULT_TTL = 3600
+# Seconds to wait for the workers to pick up a command before its results are complete
+SETTLE_SECONDS = 1
+
+
+def get_request_key(command: str) -> str:
+    return f'{get_settings().redis_prefix}worker-command|{command}'
+
+
+def get_result_key(request_id: str) -> str:
+    return f'{get_settings().redis_prefix}worker-result|{request_id}'
+
+
+class WorkerCommands:
+    """Runs a command on every web worker and collects the results, e.g. for the admin diagnostics.
+
+    The parameters are stored in Redis and the topic `worker|{command}` is bumped on the
+    invalidation bus. Each worker first adds an empty result under its pid to the hash
+    `{prefix}worker-result|{id}`, then runs the handler and stores what it returned, or the error.
+    """
+
+    def __init__(self):
+        self.redis_client = None
+        self.handlers = {}  # command -> async handler(**params)
+        self._tasks = set()
+
+    def register(self, command: str, handler):
+        self.handlers[command] = handler
+
+    async def run_local(self, command: str, params: dict) -> dict:
+        try:
+            return {'result': await self.handlers[command](**params)}
+        except Exception as e:
+            return {'error': str(e)}
+
+    async def _run(self, command: str, request: dict):
+        key = get_result_key(request['id'])
+        pid = str(os.getpid())
+        await self.redis_client.hset(key, pid, '')
+        await self.redis_client.expire(key, RESULT_TTL)
+        result = await self.run_local(command, request['params'])
+        await self.redis_client.hset(key, pid, json.dumps(result))
+
+    async def handle_event(self, topic: str):
+        command = topic.split('|', 1)[-1]
+        if command not in self.handlers:
+            return
+        raw = await self.redis_client.get(get_request_key(command))
+        if not raw:
+            return
+        request = json.loads(raw)
+        if request['expires'] < time.time():  # an old command, seen after a reconnect
+            return
+        task = asyncio.create_task(self._run(command, request))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def run_all(self, redis_client, command: str, params: dict, seconds: float = 0, timeout: float = 10) -> dict:
+        """Run a command that takes about `seconds` on every worker, the results by pid."""
+        request_id = secrets.token_hex(8)
+        request = {'id': request_id, 'params': params, 'expires': time.time() + SETTLE_SECONDS + timeout}
+        await redis_client.set(get_request_key(command), json.dumps(request), ex=int(seconds + timeout) + 60)
+        await run_in_threadpool(publish_invalidation, Redis.create_client(), f'worker|{command}')
+        deadline = time.monotonic() + seconds + timeout
+        await asyncio.sleep(max(seconds, SETTLE_SECONDS))
+        while True:
+            results = await redis_client.hgetall(get_result_key(request_id))
+            if (results and all(results.values())) or time.monotonic() > deadline:
+                break
+            await asyncio.sleep(0.5)
+        pending = [pid for (pid, value) in results.items() if not value]
+        if pending:
+            logger.warning(f"Workers {pending} did not finish {command} {request_id}.")
+        return {pid: json.loads(value) if value else {'error': 'did not finish'} for (pid, value) in sorted(results.items())}
+
+    def start(self, redis_client):
+        self.redis_client = redis_client
+
+
+worker_commands = WorkerCommands()
+invalidation_bus.subscribe('worker', worker_commands.handle_event)
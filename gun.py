@@ -20,3 +20,14 @@ worker_class = 'uvicorn.workers.UvicornH11Worker'
 preload_app = True
 
 x_forwarded_for_header = 'X-FORWARDED-FOR'
+
+
+def on_starting(server):
+    # Metrics of the previous run would be added to the new ones
+    from app.utils.metrics import clear_metrics_dir
+    clear_metrics_dir()
+
+
+def child_exit(server, worker):
+    from app.utils.metrics import mark_process_dead
+    mark_process_dead(worker.pid)
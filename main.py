@@ -16,6 +16,9 @@ def cli():
     init_server = subparsers.add_parser('init', help='初始化服务器')
     init_server.set_defaults(handle=init_server_func)
 
+    regen_worker = subparsers.add_parser('worker', help='启动重建任务处理进程')
+    regen_worker.set_defaults(handle=regen_worker_func)
+
     args = parser.parse_args()
     if hasattr(args, 'handle'):
         args.handle(args)
@@ -36,5 +39,10 @@ def init_server_func(args):
     regen_pluginmaster(repo_url="https://github.com/ottercorp/PluginDistD17.git")
 
 
+def regen_worker_func(args):
+    from app.utils.jobs import run_worker
+    run_worker()
+
+
 if __name__ == '__main__':
     cli()
@@ -0,0 +1,89 @@
+"""Micro-benchmark of plugin manifest loading: commentjson (old path) vs app.utils.jsonc.
+
+Usage: python scripts/bench_jsonc.py [dist repo dir]
+
+Without a dist repo dir, synthetic manifests with line comments, trailing commas and BOMs are used.
+"""
+import codecs
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import commentjson  # noqa: E402
+
+from app.utils import jsonc  # noqa: E402
+
+
+def find_manifests(repo_dir: str) -> list[str]:
+    paths = []
+    for channel in ('stable', 'testing-live'):
+        channel_dir = os.path.join(repo_dir, channel)
+        if not os.path.isdir(channel_dir):
+            continue
+        for plugin in os.listdir(channel_dir):
+            path = os.path.join(channel_dir, plugin, f'{plugin}.json')
+            if os.path.isfile(path):
+                paths.append(path)
+    return paths
+
+
+def make_manifests(tmp_dir: str, count: int = 500) -> list[str]:
+    paths = []
+    for i in range(count):
+        path = os.path.join(tmp_dir, f'Plugin{i}.json')
+        text = (
+            '{\n'
+            f'  "Author": "Author {i}", // inline comment\n'
+            f'  "Name": "Plugin {i}",\n'
+            f'  "InternalName": "Plugin{i}",\n'
+            '  "AssemblyVersion": "1.2.3.4",\n'
+            '  "Description": "Uses http://example.com // not a comment",\n'
+            '  "Tags": ["ui", "combat", "utility",],\n'
+            '  "DalamudApiLevel": 9,\n'
+            '  "Changelog": "' + 'Fixed things. ' * 40 + '",\n'
+            '}\n'
+        )
+        with open(path, 'wb') as f:
+            f.write((codecs.BOM_UTF8 if i % 10 == 0 else b'') + text.encode('utf-8'))
+        paths.append(path)
+    return paths
+
+
+def load_commentjson(path: str):
+    """The previous loader: utf8 first, then retry the whole file as utf-8-sig."""
+    try:
+        with codecs.open(path, 'r', 'utf8') as f:
+            return commentjson.load(f)
+    except Exception:
+        with codecs.open(path, 'r', 'utf-8-sig') as f:
+            return commentjson.load(f)
+
+
+def bench(name: str, func, paths: list[str], rounds: int = 3):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for path in paths:
+            func(path)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f'{name:<24} {best * 1000:9.1f} ms  {best / len(paths) * 1e6:8.1f} us/manifest')
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = find_manifests(sys.argv[1]) if len(sys.argv) > 1 else make_manifests(tmp_dir)
+        print(f'{len(paths)} manifests')
+        for path in paths:
+            assert jsonc.loads(open(path, 'rb').read()) == load_commentjson(path), path
+        bench('commentjson', load_commentjson, paths)
+        bench('jsonc.loads (no cache)', lambda p: jsonc.loads(open(p, 'rb').read()), paths)
+        jsonc._cache.clear()
+        bench('jsonc.load_file (cached)', jsonc.load_file, paths)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""Benchmark of the CDN purge after a regen against the local stand-in APIs of scripts/cdn_standin.py.
+
+Usage: python scripts/bench_purge.py [plugins per task] [--latency 0.02] [--fail-rate 0.05] [--tag-purge]
+
+Compares one purge per task with fresh tokens and zone ids (the old path) to one purge of the merged
+changes per CDN, and prints the seconds and requests per CDN.
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from cdn_standin import start_server  # noqa: E402
+
+TASKS = ('plugin', 'dalamud', 'xivlauncher', 'asset')
+
+
+def configure(port: int, tag_purge: bool):
+    # Read by the settings on import
+    base = f'http://127.0.0.1:{port}'
+    os.environ.update({
+        'HOSTED_URL': 'https://example.com',
+        'CF_API_BASE': f'{base}/client/v4',
+        'CF_TOKEN': 'standin',
+        'CF_ZONE_ID': '',
+        'CTCDN_API_HOST': base,
+        'CTCDN_AK': 'standin',
+        'CTCDN_SK': 'c3RhbmRpbg',
+        'OTTERCLOUD_CDN_HOST': base,
+        'OTTERCLOUD_CDN_ID': 'standin',
+        'OTTERCLOUD_CDN_KEY': 'standin',
+        'CDN_TAG_PURGE': str(tag_purge).lower(),
+        'CDN_RETRY_BACKOFF': '0.05',
+    })
+    from logs import logger
+    logger.logger.setLevel(logging.ERROR)  # purges log every URL
+
+
+def make_change_sets(plugin_count: int) -> dict:
+    from app.utils.changes import (
+        ChangeSet, get_pluginmaster_paths, get_pluginmaster_tag, get_resolution_paths, get_resolution_tag,
+        get_response_paths, get_response_tag,
+    )
+    change_sets = {task: ChangeSet() for task in TASKS}
+    for task in TASKS:
+        change_set = change_sets[task]
+        # Tasks share some responses, e.g. every regen touches the PluginMaster
+        change_set.add_route(get_pluginmaster_tag('stable'), get_pluginmaster_paths('stable'))
+        for i in range(plugin_count):
+            field = f'{task.capitalize()}Plugin{i}'
+            change_set.add_route(get_resolution_tag('stable', field), get_resolution_paths('stable', field))
+        change_set.add_route(get_response_tag('dalamud', 'meta'), get_response_paths('dalamud', 'meta'))
+    return change_sets
+
+
+def clear_caches():
+    from app.utils.cdn.cloudflare import CloudFlareCDN
+    from app.utils.cdn.ottercloudcdn import OtterCloudCDN
+    CloudFlareCDN._zone_ids.clear()
+    OtterCloudCDN._tokens.clear()
+
+
+def run(cdn_class, change_sets: dict, merged: bool, state) -> dict:
+    from app.utils.changes import ChangeSet
+    state.reset()
+    start = time.perf_counter()
+    if merged:
+        change_set = ChangeSet()
+        for task_change_set in change_sets.values():
+            change_set.update(task_change_set)
+        cdn_class().purge_changes(change_set)
+    else:
+        for change_set in change_sets.values():
+            clear_caches()
+            cdn_class().purge_changes(change_set)
+    seconds = time.perf_counter() - start
+    stats = state.stats()
+    return {'seconds': seconds, 'requests': sum(stats['requests'].values())}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('plugins', type=int, nargs='?', default=200, help='changed plugins per task')
+    parser.add_argument('--port', type=int, default=8790)
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds added to each stand-in request')
+    parser.add_argument('--fail-rate', type=float, default=0, help='fraction of stand-in requests answered with 503')
+    parser.add_argument('--tag-purge', action='store_true', help='purge CloudFlare by Cache-Tag')
+    args = parser.parse_args()
+
+    (server, state) = start_server(args.port, 'example.com', args.latency, args.fail_rate)
+    configure(server.server_port, args.tag_purge)
+    from app.utils.cdn.cloudflare import CloudFlareCDN
+    from app.utils.cdn.ctcdn import CTCDN
+    from app.utils.cdn.ottercloudcdn import OtterCloudCDN
+
+    change_sets = make_change_sets(args.plugins)
+    print(f'{len(TASKS)} tasks x {args.plugins} plugins, {args.latency * 1000:.0f}ms per request, '
+          f'{args.fail_rate:.0%} failing')
+    print(f"{'cdn':<15}{'per task':>22}{'merged':>22}")
+    for cdn_class in (CloudFlareCDN, CTCDN, OtterCloudCDN):
+        results = [run(cdn_class, change_sets, merged, state) for merged in (False, True)]
+        cells = [f"{x['seconds']:7.3f}s {x['requests']:5d} req" for x in results]
+        print(f'{cdn_class.__name__:<15}{cells[0]:>22}{cells[1]:>22}')
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+"""Local stand-in for the purge APIs of CloudFlare, CTCDN and OtterCloud, to test and benchmark purges offline.
+
+Usage: python scripts/cdn_standin.py [--port 8790] [--latency 0.05] [--fail-rate 0.1]
+
+Point the clients at it with
+    CF_API_BASE=http://127.0.0.1:8790/client/v4 CF_ZONE_ID=
+    CTCDN_API_HOST=http://127.0.0.1:8790 OTTERCLOUD_CDN_HOST=http://127.0.0.1:8790
+Requests over the documented limits are rejected, `--fail-rate` of them answer 503 to exercise retries,
+and `GET /_stats` returns the requests and keys received per API.
+"""
+import argparse
+import json
+import random
+import secrets
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CF_LIMITS = {'files': 30, 'tags': 30, 'prefixes': 30, 'hosts': 30}
+CTCDN_LIMITS = {1: 1000, 2: 50, 3: 50}  # task_type -> values
+CTCDN_PRELOAD_LIMIT = 50
+OTTERCLOUD_LIMITS = {'key': 1000, 'prefix': 50}
+TOKEN_TTL = 3600
+
+
+class StandInState:
+    def __init__(self, zone: str, latency: float, fail_rate: float):
+        self.zone = zone
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.tokens = {}  # token -> expiry
+        self.requests = Counter()
+        self.keys = Counter()
+        self.lock = threading.Lock()
+
+    def record(self, api: str, keys: int = 0):
+        with self.lock:
+            self.requests[api] += 1
+            self.keys[api] += keys
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'requests': dict(self.requests), 'keys': dict(self.keys)}
+
+    def reset(self):
+        with self.lock:
+            self.requests.clear()
+            self.keys.clear()
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, as the real APIs
+    state: StandInState = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, body: dict, status: int = 200):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def read_json(self) -> dict:
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}') if length else {}
+
+    def handle_request(self, method: str):
+        path = self.path.split('?', 1)[0]
+        body = self.read_json() if method == 'POST' else {}
+        if path == '/_stats':
+            return self.send_json(self.state.stats())
+        if self.state.latency:
+            time.sleep(self.state.latency)
+        if random.random() < self.state.fail_rate:
+            self.state.record('failed')
+            return self.send_json({'message': 'unavailable'}, 503)
+        if path.startswith('/client/v4/'):
+            return self.handle_cloudflare(method, path.removeprefix('/client/v4'), body)
+        if path.startswith('/v1/'):
+            return self.handle_ctcdn(path, body)
+        if path.startswith('/APIAccessTokenService/') or path.startswith('/HTTPCacheTaskService/'):
+            return self.handle_ottercloud(path, body)
+        self.send_json({'message': 'not found'}, 404)
+
+    def handle_cloudflare(self, method: str, path: str, body: dict):
+        if not self.headers.get('Authorization', '').startswith('Bearer '):
+            return self.send_json({'success': False, 'errors': [{'code': 10000, 'message': 'Authentication error'}]}, 403)
+        if method == 'GET' and path == '/zones':
+            self.state.record('cloudflare/zones')
+            return self.send_json({'success': True, 'result': [{'id': 'standin-zone', 'name': self.state.zone}]})
+        if method == 'POST' and path.endswith('/purge_cache'):
+            for (kind, limit) in CF_LIMITS.items():
+                if len(body.get(kind, [])) > limit:
+                    return self.send_json({'success': False, 'errors': [{'code': 1047, 'message': f'More than {limit} {kind}'}]}, 400)
+            self.state.record('cloudflare/purge_cache', sum(len(body.get(x, [])) for x in CF_LIMITS))
+            return self.send_json({'success': True, 'result': {'id': secrets.token_hex(16)}})
+        self.send_json({'success': False, 'errors': [{'code': 7003, 'message': 'No route'}]}, 404)
+
+    def handle_ctcdn(self, path: str, body: dict):
+        if not self.headers.get('x-alogic-signature'):
+            return self.send_json({'message': 'signature required'}, 401)
+        values = body.get('values', [])
+        if path == '/v1/refreshmanage/create':
+            limit = CTCDN_LIMITS.get(body.get('task_type'))
+            if limit is None or len(values) > limit:
+                return self.send_json({'message': f'too many values for task_type {body.get("task_type")}'})
+            self.state.record('ctcdn/refresh', len(values))
+        elif path == '/v1/preloadmanage/create':
+            if len(values) > CTCDN_PRELOAD_LIMIT:
+                return self.send_json({'message': 'too many values'})
+            self.state.record('ctcdn/preload', len(values))
+        else:
+            self.state.record(f'ctcdn{path}')
+        self.send_json({'message': 'success'})
+
+    def handle_ottercloud(self, path: str, body: dict):
+        if path == '/APIAccessTokenService/getAPIAccessToken':
+            self.state.record('ottercloud/token')
+            token = secrets.token_hex(16)
+            with self.state.lock:
+                self.state.tokens[token] = time.time() + TOKEN_TTL
+            return self.send_json({'code': 200, 'message': 'ok', 'data': {'token': token, 'expiresAt': int(time.time()) + TOKEN_TTL}})
+        expiry = self.state.tokens.get(self.headers.get('X-Edge-Access-Token', ''), 0)
+        if expiry < time.time():
+            return self.send_json({'code': 401, 'message': 'invalid access token'})
+        if path == '/HTTPCacheTaskService/createHTTPCacheTask':
+            keys = body.get('keys', [])
+            if len(keys) > OTTERCLOUD_LIMITS.get(body.get('keyType'), 0):
+                return self.send_json({'code': 400, 'message': f"too many keys for keyType {body.get('keyType')}"})
+            self.state.record(f"ottercloud/{body.get('type')}", len(keys))
+            return self.send_json({'code': 200, 'message': 'ok', 'data': {'httpCacheTaskId': secrets.randbelow(1 << 31)}})
+        self.send_json({'code': 404, 'message': 'not found'})
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+
+def start_server(port: int = 8790, zone: str = 'example.com', latency: float = 0, fail_rate: float = 0):
+    """Serve in a daemon thread, returns the server and its state."""
+    state = StandInState(zone, latency, fail_rate)
+    handler = type('Handler', (StandInHandler,), {'state': state})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return (server, state)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8790)
+    parser.add_argument('--zone', default='example.com', help='zone name listed by the CloudFlare API')
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to each request')
+    parser.add_argument('--fail-rate', type=float, default=0, help='fraction of requests answered with 503')
+    args = parser.parse_args()
+    (server, _) = start_server(args.port, args.zone, args.latency, args.fail_rate)
+    print(f'CDN stand-in listening on http://127.0.0.1:{server.server_port}')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+"""Local stand-in for an OTLP/HTTP collector, and a viewer for the spans of the jsonl trace exporter.
+
+Usage: python scripts/trace_standin.py [--port 4318] [--output logs/traces.jsonl]
+       python scripts/trace_standin.py --show logs/traces.jsonl [trace_id]
+
+Point the app at it with TRACE_EXPORTER=otlp TRACE_OTLP_ENDPOINT=http://127.0.0.1:4318/v1/traces.
+Spans posted as OTLP JSON are kept in memory, and appended to `--output` in the format of the jsonl
+exporter. `GET /_traces` lists the traces received, `GET /_traces/<trace_id>` shows one as a tree.
+"""
+import argparse
+import json
+import sys
+import threading
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def parse_otlp_value(value: dict):
+    (kind, raw) = next(iter(value.items()))
+    return int(raw) if kind == 'intValue' else raw
+
+
+def parse_otlp(body: dict) -> list[dict]:
+    """Spans of an OTLP JSON export in the format of the jsonl exporter."""
+    spans = []
+    for resource_spans in body.get('resourceSpans', []):
+        resource = {x['key']: parse_otlp_value(x['value']) for x in resource_spans['resource']['attributes']}
+        for scope_spans in resource_spans['scopeSpans']:
+            for span in scope_spans['spans']:
+                (start_ns, end_ns) = (int(span['startTimeUnixNano']), int(span['endTimeUnixNano']))
+                spans.append({
+                    'trace_id': span['traceId'],
+                    'span_id': span['spanId'],
+                    'parent_id': span.get('parentSpanId', ''),
+                    'name': span['name'],
+                    'kind': {1: 'internal', 2: 'server', 3: 'client'}.get(span.get('kind'), 'internal'),
+                    'start_ns': start_ns,
+                    'end_ns': end_ns,
+                    'duration_ms': round((end_ns - start_ns) / 1e6, 3),
+                    'error': span.get('status', {}).get('message', ''),
+                    'attributes': {x['key']: parse_otlp_value(x['value']) for x in span.get('attributes', [])},
+                    'service': resource.get('service.name', ''),
+                    'pid': resource.get('process.pid', 0),
+                })
+    return spans
+
+
+def format_trace(spans: list[dict]) -> str:
+    """A trace as an indented tree, each span with its offset from the start of the trace and duration."""
+    children = defaultdict(list)
+    span_ids = {x['span_id'] for x in spans}
+    for span in sorted(spans, key=lambda x: x['start_ns']):
+        # The parent of a root is in another process that does not export, e.g. a traced client
+        children[span['parent_id'] if span['parent_id'] in span_ids else ''].append(span)
+    start_ns = min(x['start_ns'] for x in spans)
+    lines = []
+
+    def add(span: dict, depth: int):
+        error = f"  ERROR {span['error']}" if span['error'] else ''
+        attributes = ' '.join(f'{k}={v}' for (k, v) in span['attributes'].items())
+        lines.append(f"{(span['start_ns'] - start_ns) / 1e6:10.1f}ms {span['duration_ms']:10.1f}ms  "
+                     f"{'  ' * depth}{span['name']} [{span['pid']}] {attributes}{error}")
+        for child in children[span['span_id']]:
+            add(child, depth + 1)
+
+    for root in children['']:
+        add(root, 0)
+    return '\n'.join(lines) + '\n'
+
+
+class TraceStore:
+    def __init__(self, output: str = ''):
+        self.output = output
+        self.traces = defaultdict(list)  # trace_id -> spans
+        self.lock = threading.Lock()
+
+    def add(self, spans: list[dict]):
+        with self.lock:
+            for span in spans:
+                self.traces[span['trace_id']].append(span)
+            if self.output:
+                with open(self.output, 'a', encoding='utf8') as f:
+                    f.write(''.join(json.dumps(x) + '\n' for x in spans))
+
+    def summary(self) -> list[dict]:
+        with self.lock:
+            return [{
+                'trace_id': trace_id,
+                'spans': len(spans),
+                'root': min(spans, key=lambda x: x['start_ns'])['name'],
+                'duration_ms': round((max(x['end_ns'] for x in spans) - min(x['start_ns'] for x in spans)) / 1e6, 3),
+                'errors': sum(1 for x in spans if x['error']),
+            } for (trace_id, spans) in self.traces.items()]
+
+    def get(self, trace_id: str) -> list[dict]:
+        with self.lock:
+            return list(self.traces.get(trace_id, []))
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    store: TraceStore = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, content: bytes, content_type: str = 'application/json', status: int = 200):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path != '/v1/traces':
+            self.send_body(b'{}', status=404)
+            return
+        try:
+            spans = parse_otlp(json.loads(body))
+        except (ValueError, KeyError, StopIteration) as e:
+            self.send_body(json.dumps({'error': str(e)}).encode(), status=400)
+            return
+        self.store.add(spans)
+        self.send_body(b'{}')
+
+    def do_GET(self):
+        if self.path == '/_traces':
+            self.send_body(json.dumps(self.store.summary()).encode())
+        elif self.path.startswith('/_traces/') and (spans := self.store.get(self.path.removeprefix('/_traces/'))):
+            self.send_body(format_trace(spans).encode(), 'text/plain; charset=utf-8')
+        else:
+            self.send_body(b'{}', status=404)
+
+
+def start_server(port: int = 4318, output: str = ''):
+    """Serve in a daemon thread, returns the server and its store."""
+    store = TraceStore(output)
+    handler = type('Handler', (StandInHandler,), {'store': store})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return (server, store)
+
+
+def show(path: str, trace_id: str = ''):
+    traces = defaultdict(list)
+    with open(path, encoding='utf8') as f:
+        for line in f:
+            span = json.loads(line)
+            traces[span['trace_id']].append(span)
+    for (current_id, spans) in traces.items():
+        if trace_id and current_id != trace_id:
+            continue
+        sys.stdout.write(f'trace {current_id}\n{format_trace(spans)}\n')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=4318)
+    parser.add_argument('--output', default='', help='append the received spans to this jsonl file')
+    parser.add_argument('--show', metavar='FILE', help='print the traces of a jsonl file as trees and exit')
+    parser.add_argument('trace_id', nargs='?', default='', help='only this trace, with --show')
+    args = parser.parse_args()
+    if args.show:
+        show(args.show, args.trace_id)
+        return
+    (server, _) = start_server(args.port, args.output)
+    print(f'Trace collector stand-in listening on http://127.0.0.1:{server.server_port}/v1/traces')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()